@@ -1,6 +1,5 @@
 import xlwings as xw
 
-import requests
 from aruba import Config, switch
 
 
@@ -10,8 +9,9 @@ def vlans(data):
     wb, row, col, api_host = splitExcel(data)
 
     # Y ahora, obtengo los datos del switch
-    with switch.session(Config(), api_host=api_host, verify=False) as session:
-        vlans = requests.get(session.api_url + "/vlans", headers=session.headers(), verify=False)
+    # persist=True reutiliza la cookie entre llamadas, sin login ni logout cada vez
+    with switch.session(Config(), api_host=api_host, verify=False, persist=True) as session:
+        vlans = session.get("/vlans")
         if vlans.status_code != 200:
             wb.sheets[0].range("%s%d"%(col, row)).value = "Error leyendo switch, "+vlans.text
             return
@@ -3,4 +3,4 @@
 
 # importo readConfig aquí para que no haga falta importar aruba.common o aruba.errors
 from aruba.common import Config
-from aruba.errors import RequestError, FormatError
+from aruba.errors import RequestError, FormatError, CommandError
@@ -2,79 +2,374 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import time
+import hashlib
+import logging
+import asyncio
+import threading
+import weakref
 import requests
+import aiohttp
 
+from concurrent.futures import ThreadPoolExecutor, Future
 from contextlib import contextmanager
 from collections import namedtuple
-from typing import Dict, Mapping, Optional, Iterator, cast
+from typing import Dict, Mapping, Optional, Iterator, AsyncIterator, Any, Tuple, Callable, Awaitable, Sequence, cast
 
 from aruba.errors import RequestError, FormatError
 from aruba.common import _ask_input, _ask_pass, _fill, Config, Settings
-from aruba import common
+from aruba import codec, common, trace
 
 
 def _api_url(api_host: str) -> str:
     """Obtiene la URL de la API de clearpass, a partir del hostname"""
     return "https://{}/api".format(api_host)
 
+
+# Validez (segundos) que se asume para un token si el servidor no devuelve expires_in
+EXPIRES_IN = 3600
+
+# Token de acceso y su validez en segundos, tal como lo devuelve /oauth
+Token = Tuple[str, float]
+
+# Clave de la caché de tokens: (api_host, client_id, grant_type, username, huella de las credenciales)
+TokenKey = Tuple[str, str, str, str, str]
+
+
+def _fingerprint(*fields: str) -> str:
+    """Huella (blake2b) de las credenciales, para la clave de la caché de tokens.
+
+    Así una sesión con un client_secret o password incorrectos no recibe el
+    token que obtuvo otra con los buenos, y los secretos no se guardan en
+    claro en el fichero de SharedTokenCache.
+    """
+    data = "\0".join(fields).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16, person=b"aruba.clearpass").hexdigest()
+
+
+def _attrib(oauth_url: str, credentials: Mapping[str, str], data: Mapping[str, Any], attrib: str) -> Mapping[str, Any]:
+    """Comprueba que la respuesta de /oauth contiene el atributo indicado"""
+    if not attrib in data:
+        raise FormatError(oauth_url, None, credentials, data, attrib)
+    return data
+
+
+def _token(data: Mapping[str, Any]) -> Token:
+    """Extrae el access_token y su validez de la respuesta de /oauth"""
+    return (data["access_token"], float(data.get("expires_in", None) or EXPIRES_IN))
+
+
+class _Entry(object):
+
+    """Token almacenado en la caché, con sus instantes de renovación y caducidad"""
+
+    def __init__(self, token: str, expires_in: float, renew_ratio: float) -> None:
+        now = time.monotonic()
+        self.token = token
+        self.expires = now + expires_in
+        self.renew = now + expires_in * renew_ratio
+
+
+class TokenCache(object):
+
+    """Caché de tokens OAuth, compartida entre sesiones de ClearPass.
+
+    Los tokens se indexan por (api_host, client_id, grant_type, username) y
+    una huella del client_secret y el password, y se conservan durante el tiempo indicado por el expires_in del servidor.
+    Cuando se ha consumido renew_ratio de su vida, las sesiones asíncronas
+    lo renuevan en segundo plano mientras siguen usando el actual; las
+    síncronas lo renuevan en el momento.
+
+    Si muchas corrutinas piden a la vez un token que no está en la caché,
+    sólo una de ellas lo solicita al servidor, y el resto esperan su resultado.
+    """
+
+    def __init__(self, renew_ratio: float = 0.8) -> None:
+        self._renew_ratio = renew_ratio
+        self._entries: Dict[TokenKey, _Entry] = dict()
+        self._renewing: Dict[TokenKey, asyncio.Future] = dict()
+        self._lock = threading.Lock()
+        # Los asyncio.Lock van asociados a un bucle de eventos, guardo uno por bucle y clave
+        self._locks: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def _valid(self, key: TokenKey) -> Optional[_Entry]:
+        entry = self._entries.get(key, None)
+        if entry is None or entry.expires <= time.monotonic():
+            return None
+        return entry
+
+    def _store(self, key: TokenKey, token: Token) -> _Entry:
+        entry = _Entry(token[0], token[1], self._renew_ratio)
+        self._entries[key] = entry
+        return entry
+
+    def _lock_for(self, key: TokenKey) -> asyncio.Lock:
+        locks = self._locks.setdefault(asyncio.get_running_loop(), dict())
+        lock = locks.get(key, None)
+        if lock is None:
+            lock = asyncio.Lock()
+            locks[key] = lock
+        return lock
+
+    def _fetch(self, key: TokenKey, fetch: Callable[[], Token]) -> _Entry:
+        """Obtiene un token nuevo y lo guarda"""
+        return self._store(key, fetch())
+
+    async def _afetch(self, key: TokenKey, fetch: Callable[[], Awaitable[Token]]) -> _Entry:
+        """Versión asíncrona de _fetch"""
+        return self._store(key, await fetch())
+
+    def due(self, key: TokenKey, token: str) -> bool:
+        """Indica si una sesión que usa 'token' debe volver a pedirlo a la caché.
+
+        Es así si en la caché hay otro (o ninguno), o si toca renovarlo y no
+        hay ya una renovación en curso. Las sesiones lo comprueban antes de
+        cada petición, para renovar el token antes de que caduque.
+        """
+        entry = self._entries.get(key, None)
+        if entry is None or entry.token != token:
+            return True
+        return entry.renew <= time.monotonic() and key not in self._renewing
+
+    def get(self, key: TokenKey, fetch: Callable[[], Token]) -> str:
+        """Devuelve el token de la caché, o lo obtiene con fetch() si ha caducado o va a caducar"""
+        with self._lock:
+            entry = self._valid(key)
+            if entry is None:
+                entry = self._fetch(key, fetch)
+            elif entry.renew <= time.monotonic():
+                try:
+                    entry = self._fetch(key, fetch)
+                except Exception as err:
+                    # El token actual sigue siendo válido hasta que caduque
+                    logging.warning("TokenCache - error renovando token para {}: {}".format(key[0], err))
+            return entry.token
+
+    async def aget(self, key: TokenKey, fetch: Callable[[], Awaitable[Token]]) -> str:
+        """Devuelve el token de la caché, o lo obtiene con await fetch() si ha caducado.
+
+        Si el token está próximo a caducar, lanza su renovación en segundo plano.
+        """
+        entry = self._valid(key)
+        if entry is None:
+            async with self._lock_for(key):
+                entry = self._valid(key)
+                if entry is None:
+                    entry = await self._afetch(key, fetch)
+        elif entry.renew <= time.monotonic() and key not in self._renewing:
+            self._renewing[key] = asyncio.ensure_future(self._renew(key, fetch))
+        return entry.token
+
+    async def _renew(self, key: TokenKey, fetch: Callable[[], Awaitable[Token]]) -> None:
+        # La renovación no forma parte de la traza de la petición que la provocó
+        trace.detach()
+        try:
+            async with self._lock_for(key):
+                entry = self._entries.get(key, None)
+                if entry is None or entry.renew <= time.monotonic():
+                    await self._afetch(key, fetch)
+        except Exception as err:
+            # El token actual sigue siendo válido hasta que caduque
+            logging.warning("TokenCache - error renovando token para {}: {}".format(key[0], err))
+        finally:
+            del self._renewing[key]
+
+    async def settle(self, key: TokenKey) -> None:
+        """Espera a que termine la renovación en segundo plano del token, si hay alguna en curso"""
+        renewing = self._renewing.get(key, None)
+        if renewing is not None:
+            await asyncio.shield(renewing)
+
+    def invalidate(self, key: TokenKey, token: str) -> None:
+        """Descarta el token de la caché, si sigue siendo el indicado (p.ej. porque el servidor lo rechaza)"""
+        entry = self._entries.get(key, None)
+        if entry is not None and entry.token == token:
+            del self._entries[key]
+
+
+# Caché compartida por defecto por todas las sesiones del proceso
+TOKENS = TokenCache()
+
+# Fichero donde SharedTokenCache guarda los tokens, por defecto
+TOKENS_FILE = "~/.aruba.tokens"
+
+
+class SharedTokenCache(TokenCache):
+
+    """TokenCache compartida entre procesos a través de un fichero (common.FileStore).
+
+    Cuando un proceso necesita un token nuevo, bloquea el fichero mientras
+    hace login, y lo deja guardado. Los demás procesos esperan al bloqueo y
+    reutilizan ese token, así que N workers hacen un solo login en lugar de N.
+    Los tokens que el servidor rechaza no se vuelven a tomar del fichero,
+    hasta que caducan (entonces ya no se tomarían de todas formas).
+    """
+
+    def __init__(self, path: str = TOKENS_FILE, renew_ratio: float = 0.8) -> None:
+        super().__init__(renew_ratio)
+        self.store = common.FileStore(path)
+        # Tokens rechazados, y su caducidad (reloj de pared)
+        self._rejected: Dict[str, float] = dict()
+
+    def _prune(self, now: float) -> None:
+        for token, expires in tuple(self._rejected.items()):
+            if expires <= now:
+                del self._rejected[token]
+
+    def _shared(self, key: TokenKey, data: Dict[str, Any]) -> Optional[_Entry]:
+        """Entrada guardada en el fichero por otro proceso, si aún no hay que renovarla"""
+        item = data.get("|".join(key), None)
+        now = time.time()
+        self._prune(now)
+        if item is None or item["renew"] <= now:
+            return None
+        if item["token"] in self._rejected:
+            # El fichero dice cuándo caduca, a partir de entonces ya no hace falta recordarlo
+            self._rejected[item["token"]] = item["expires"]
+            return None
+        entry = self._store(key, (item["token"], item["expires"] - now))
+        # Las marcas del fichero son de reloj de pared, las paso a monotonic
+        entry.renew = time.monotonic() + item["renew"] - now
+        return entry
+
+    def _save(self, key: TokenKey, data: Dict[str, Any], token: Token) -> _Entry:
+        now = time.time()
+        data["|".join(key)] = {
+            "token": token[0],
+            "expires": now + token[1],
+            "renew": now + token[1] * self._renew_ratio,
+        }
+        return self._store(key, token)
+
+    def _fetch(self, key: TokenKey, fetch: Callable[[], Token]) -> _Entry:
+        with self.store.locked() as data:
+            entry = self._shared(key, data)
+            if entry is None:
+                entry = self._save(key, data, fetch())
+            return entry
+
+    async def _afetch(self, key: TokenKey, fetch: Callable[[], Awaitable[Token]]) -> _Entry:
+        # El bloqueo del fichero es bloqueante, lo tomo y lo suelto en el executor.
+        # flock no va ligado a un hilo, así que da igual en cuál se haga cada parte.
+        loop = asyncio.get_running_loop()
+        locked = self.store.locked()
+        # Si fetch falla, el contenido no cambia y el fichero no se reescribe.
+        data = await loop.run_in_executor(None, locked.__enter__)
+        try:
+            entry = self._shared(key, data)
+            if entry is None:
+                entry = self._save(key, data, await fetch())
+            return entry
+        finally:
+            await loop.run_in_executor(None, locked.__exit__, None, None, None)
+
+    def invalidate(self, key: TokenKey, token: str) -> None:
+        now = time.time()
+        self._prune(now)
+        entry = self._entries.get(key, None)
+        if entry is not None and entry.token == token:
+            expires = now + entry.expires - time.monotonic()
+        else:
+            # No sé cuándo caduca, lo recuerdo hasta que _shared lo lea del fichero
+            expires = self._rejected.get(token, now + EXPIRES_IN)
+        self._rejected[token] = expires
+        super().invalidate(key, token)
+
 # ------------------------
 # Métodos de autenticación
 # ------------------------
 
-class Session(common.Session):
+class _Grant(object):
+
+    """Credenciales OAuth, comunes a las sesiones síncronas y asíncronas"""
 
     def __init__(self, grant_type: str, api_host: str, client_id: str, client_secret: str,
-        username: str, password: str, verify: bool = True) -> None:
+        username: str, password: str) -> None:
         self._api_host: str = api_host
         self._grant_type: str = grant_type
         self._client_id: str = client_id
         self._client_secret: str = client_secret
         self._username: str = username
         self._password: str = password
-        self._verify: bool = verify
         self._refresh_token: Optional[str] = None
-        token = self._auth()
-        headers = { "Authorization": f"Bearer {token}" }
-        super().__init__(_api_url(api_host), token, headers=headers)
+        self._token_key: TokenKey = (api_host, client_id, grant_type, username,
+            _fingerprint(api_host, client_id, username, client_secret, password))
 
-    def _auth_request(self, attrib: str, credentials: Mapping[str, str]) -> str:
-        oauth_url = _api_url(self._api_host) + "/oauth"
-        response = requests.post(oauth_url, verify=self._verify, json=credentials)
-        if response.status_code != 200:
-            raise RequestError(oauth_url, None, credentials, response)
-        # No error, accedo a los tokens
-        data = response.json()
-        if not attrib in data:
-            raise FormatError(oauth_url, None, credentials, data, attrib)
-        return data[attrib]
+    def _key(self) -> TokenKey:
+        return self._token_key
 
-    def _client_auth(self) -> str:
-        return self._auth_request("access_token", {
+    def _client_grant(self) -> Dict[str, str]:
+        return {
             "grant_type": "client_credentials",
             "client_id": self._client_id,
             "client_secret": self._client_secret,
-        })
+        }
 
-    def _password_auth(self) -> str:
-        """Obtiene un refresh_token para el tipo de autenticacion password"""
-        return self._auth_request("refresh_token", {
+    def _password_grant(self) -> Dict[str, str]:
+        return {
             "grant_type": "password",
             "client_id": self._client_id,
             "client_secret": self._client_secret,
             "username": self._username,
             "password": self._password,
-        })
+        }
 
-    def _refresh_auth(self) -> str:
+    def _refresh_grant(self) -> Dict[str, str]:
         assert(self._refresh_token is not None)
-        return self._auth_request("access_token", {
+        return {
             "grant_type": "refresh_token",
             "client_id": self._client_id,
             "client_secret": self._client_secret,
             "refresh_token": self._refresh_token,
-        })
+        }
+
+
+class Session(_Grant, common.Session):
+
+    device = "clearpass"
+
+    def __init__(self, grant_type: str, api_host: str, client_id: str, client_secret: str,
+        username: str, password: str, verify: bool = True,
+        http: Optional[requests.Session] = None, pool_size: int = common.POOL_SIZE,
+        tokens: Optional[TokenCache] = TOKENS) -> None:
+        _Grant.__init__(self, grant_type, api_host, client_id, client_secret, username, password)
+        self._tokens = tokens
+        common.Session.__init__(self, _api_url(api_host), "", headers=dict(), verify=verify,
+            http=http, pool_size=pool_size)
+        self._authenticate()
+
+    def _send(self, method: str, path: str, params: common.Attribs, headers: common.Headers,
+        kwargs: Dict[str, Any]) -> requests.Response:
+        # Renueva el token antes de que caduque, sin esperar a que el servidor lo rechace
+        if self._tokens is not None and self._tokens.due(self._key(), self.secret):
+            self._authenticate()
+        return super()._send(method, path, params, headers, kwargs)
+
+    def _reauth(self, stale: str) -> None:
+        # El servidor ha rechazado el token, lo saco de la caché para que no lo use nadie más
+        if self._tokens is not None:
+            self._tokens.invalidate(self._key(), stale)
+        super()._reauth(stale)
+
+    def _auth_request(self, attrib: str, credentials: Mapping[str, str]) -> Mapping[str, Any]:
+        oauth_url = _api_url(self._api_host) + "/oauth"
+        response = self.http.post(oauth_url, verify=self._verify, json=credentials)
+        if response.status_code != 200:
+            raise RequestError(oauth_url, None, credentials, response)
+        # No error, accedo a los tokens
+        return _attrib(oauth_url, credentials, codec.load(response), attrib)
 
-    def _auth(self) -> str:
+    def _client_auth(self) -> Token:
+        return _token(self._auth_request("access_token", self._client_grant()))
+
+    def _password_auth(self) -> str:
+        """Obtiene un refresh_token para el tipo de autenticacion password"""
+        return self._auth_request("refresh_token", self._password_grant())["refresh_token"]
+
+    def _refresh_auth(self) -> Token:
+        return _token(self._auth_request("access_token", self._refresh_grant()))
+
+    def _auth(self) -> Token:
         "Autentica la sesion, almacena el refresh token más reciente"
         # Si el grant_type es client_credentials, autentico tal cual
         if self._grant_type == "client_credentials":
@@ -92,17 +387,89 @@ class Session(common.Session):
         return self._refresh_auth()
 
     def refresh(self) -> None:
-        token = self._auth()
+        if self._tokens is None:
+            token, _ = self._auth()
+        else:
+            token = self._tokens.get(self._key(), self._auth)
         headers = cast(Dict[str, str], self._headers)
         headers["Authorization"] = f"Bearer {token}"
         self.secret = token
 
 
-@contextmanager
-def session(config: Settings, grant_type: Optional[str] = None, api_host: Optional[str] = None,
-    client_id: Optional[str] = None, client_secret: Optional[str] = None,
-    username: Optional[str] = None, password: Optional[str] = None, verify: bool = True) -> Iterator[Session]:
-    """Obtiene un token para ClearPass. Si grant_type=="password", necesita un refresh_token en la config"""
+class AsyncSession(_Grant, common.AsyncSession):
+
+    """Versión asíncrona de Session, para usar con async with"""
+
+    device = "clearpass"
+
+    def __init__(self, grant_type: str, api_host: str, client_id: str, client_secret: str,
+        username: str, password: str, verify: bool = True,
+        http: Optional[aiohttp.ClientSession] = None, pool_size: int = common.POOL_SIZE,
+        tokens: Optional[TokenCache] = TOKENS) -> None:
+        _Grant.__init__(self, grant_type, api_host, client_id, client_secret, username, password)
+        self._tokens = tokens
+        common.AsyncSession.__init__(self, _api_url(api_host), headers=dict(), verify=verify,
+            http=http, pool_size=pool_size)
+
+    async def _send(self, method: str, path: str, params: common.Attribs, headers: common.Headers,
+        kwargs: Dict[str, Any]) -> aiohttp.ClientResponse:
+        # Si toca renovar el token, aget lanza la renovación en segundo plano
+        # y devuelve el actual, así que la petición no espera al login
+        if self._tokens is not None and self._tokens.due(self._key(), self.secret):
+            await self._authenticate()
+        return await super()._send(method, path, params, headers, kwargs)
+
+    async def _reauth(self, stale: str) -> None:
+        # El servidor ha rechazado el token, lo saco de la caché para que no lo use nadie más
+        if self._tokens is not None:
+            self._tokens.invalidate(self._key(), stale)
+        await super()._reauth(stale)
+
+    async def _auth_request(self, attrib: str, credentials: Mapping[str, str]) -> Mapping[str, Any]:
+        oauth_url = _api_url(self._api_host) + "/oauth"
+        async with self.http.post(oauth_url, json=credentials, **self._ssl) as response:
+            if response.status != 200:
+                raise RequestError(oauth_url, None, credentials, response, await response.text())
+            data = await codec.aload(response)
+        return _attrib(oauth_url, credentials, data, attrib)
+
+    async def _auth(self) -> Token:
+        "Autentica la sesion, almacena el refresh token más reciente"
+        if self._grant_type == "client_credentials":
+            return _token(await self._auth_request("access_token", self._client_grant()))
+        if self._refresh_token is not None:
+            try:
+                return _token(await self._auth_request("access_token", self._refresh_grant()))
+            except RequestError:
+                pass
+        self._refresh_token = (await self._auth_request("refresh_token", self._password_grant()))["refresh_token"]
+        if self._refresh_token is None:
+            raise ValueError("Invalid credentials for password authentication")
+        return _token(await self._auth_request("access_token", self._refresh_grant()))
+
+    async def refresh(self) -> None:
+        if self._tokens is None:
+            token, _ = await self._auth()
+        else:
+            token = await self._tokens.aget(self._key(), self._auth)
+        headers = cast(Dict[str, str], self._headers)
+        headers["Authorization"] = f"Bearer {token}"
+        self.secret = token
+
+    async def close(self) -> None:
+        # La renovación en segundo plano del token puede estar usando el pool de esta sesión
+        if self._tokens is not None:
+            await self._tokens.settle(self._key())
+        await super().close()
+
+
+Params = namedtuple('Params', ('username', 'password', 'grant_type', 'api_host', 'client_id', 'client_secret'))
+
+
+def _settings(config: Settings, grant_type: Optional[str], api_host: Optional[str],
+    client_id: Optional[str], client_secret: Optional[str],
+    username: Optional[str], password: Optional[str]) -> Params:
+    """Completa los parámetros de conexión con los valores por defecto de la config"""
     # Cargo de la config valores por defecto para todos los parámetros
     defaults = config["clearpass"]
     provided = _fill({
@@ -121,14 +488,337 @@ def session(config: Settings, grant_type: Optional[str] = None, api_host: Option
         str_username = cast(str, username)
         str_password = cast(str, password)
     # Meto todos los valores en una estructura, por comodidad
-    Params = namedtuple('Params', ('username', 'password', 'grant_type', 'api_host', 'client_id', 'client_secret'))
-    asserted = Params(
+    return Params(
         str_username, str_password, provided["grant_type"], provided["api_host"],
         provided["client_id"], provided["client_secret"]
     )
+
+
+@contextmanager
+def session(config: Settings, grant_type: Optional[str] = None, api_host: Optional[str] = None,
+    client_id: Optional[str] = None, client_secret: Optional[str] = None,
+    username: Optional[str] = None, password: Optional[str] = None, verify: bool = True,
+    http: Optional[requests.Session] = None, pool_size: int = common.POOL_SIZE,
+    tokens: Optional[TokenCache] = TOKENS) -> Iterator[Session]:
+    """Obtiene un token para ClearPass. Si grant_type=="password", necesita un refresh_token en la config"""
+    asserted = _settings(config, grant_type, api_host, client_id, client_secret, username, password)
     # Todo OK, podemos autenticar
-    yield Session(asserted.grant_type, asserted.api_host,  asserted.client_id, asserted.client_secret,
-        asserted.username, asserted.password, verify)
+    curr = Session(asserted.grant_type, asserted.api_host,  asserted.client_id, asserted.client_secret,
+        asserted.username, asserted.password, verify, http=http, pool_size=pool_size, tokens=tokens)
+    try:
+        yield curr
+    finally:
+        curr.close()
+
+
+def async_session(config: Settings, grant_type: Optional[str] = None, api_host: Optional[str] = None,
+    client_id: Optional[str] = None, client_secret: Optional[str] = None,
+    username: Optional[str] = None, password: Optional[str] = None, verify: bool = True,
+    http: Optional[aiohttp.ClientSession] = None, pool_size: int = common.POOL_SIZE,
+    tokens: Optional[TokenCache] = TOKENS) -> AsyncSession:
+    """Prepara una sesión asíncrona con ClearPass. El token se obtiene al entrar en async with."""
+    asserted = _settings(config, grant_type, api_host, client_id, client_secret, username, password)
+    return AsyncSession(asserted.grant_type, asserted.api_host,  asserted.client_id, asserted.client_secret,
+        asserted.username, asserted.password, verify, http=http, pool_size=pool_size, tokens=tokens)
+
+
+# ------------------------
+# Colecciones paginadas
+# ------------------------
+
+# Número de elementos que se piden en cada página de una colección
+PAGE_SIZE = 100
+
+# Página de una colección: elementos, y si hay más páginas detrás
+Page = Tuple[Sequence[Dict[str, Any]], bool]
+
+
+def _page_query(offset: int, limit: int, filter: Any, sort: Optional[str], params: Optional[Mapping[str, Any]]) -> Dict[str, Any]:
+    """Construye los parámetros para pedir una página de una colección"""
+    query: Dict[str, Any] = dict(params) if params else dict()
+    query.update({ "offset": offset, "limit": limit, "calculate_count": "false" })
+    if filter is not None:
+        query["filter"] = filter if isinstance(filter, str) else codec.dumps_text(filter)
+    if sort is not None:
+        query["sort"] = sort
+    return query
+
+
+def _page(url: str, query: Mapping[str, Any], data: Mapping[str, Any], limit: int) -> Page:
+    """Extrae los elementos de una página, y comprueba si hay otra a continuación"""
+    embedded = data.get("_embedded", None)
+    if embedded is None or "items" not in embedded:
+        raise FormatError(url, None, query, data, "_embedded.items")
+    items = embedded["items"]
+    links = data.get("_links", None)
+    more = len(items) >= limit and (links is None or "next" in links)
+    return (items, more)
+
+
+def items(session: Session, path: str, filter: Any = None, sort: Optional[str] = None,
+    page_size: int = PAGE_SIZE, params: Optional[Mapping[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+    """Recorre todos los elementos de una colección paginada (/guest, /session, /endpoint...)
+
+    filter puede ser un diccionario con la sintaxis de filtros de ClearPass, o
+    la cadena JSON equivalente. sort es el campo de ordenación, p.ej. "-acctstarttime".
+
+    La siguiente página se descarga en segundo plano mientras se consume la
+    actual, y nunca hay más de dos páginas en memoria:
+
+    >>> for item in clearpass.items(session, "/session", filter={ "acctstoptime": { "$exists": False } }):
+    >>>     print(item["mac_address"])
+    """
+    url = session.api_url + path
+    def fetch(offset: int) -> Page:
+        query = _page_query(offset, page_size, filter, sort, params)
+        response = session.get(path, params=query)
+        if response.status_code != 200:
+            raise RequestError(url, None, query, response)
+        return _page(url, query, codec.load(response), page_size)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        offset, current = 0, cast(Optional[Future], executor.submit(fetch, 0))
+        try:
+            while current is not None:
+                page, more = current.result()
+                offset += len(page)
+                current = executor.submit(fetch, offset) if more else None
+                yield from page
+        finally:
+            # Si se deja de iterar a medias, descarto la página pedida
+            if current is not None:
+                current.cancel()
+
+
+async def aitems(session: AsyncSession, path: str, filter: Any = None, sort: Optional[str] = None,
+    page_size: int = PAGE_SIZE, params: Optional[Mapping[str, Any]] = None) -> AsyncIterator[Dict[str, Any]]:
+    """Versión asíncrona de items, para usar con async for"""
+    url = session.api_url + path
+    async def fetch(offset: int) -> Page:
+        query = _page_query(offset, page_size, filter, sort, params)
+        async with session.get(path, params=query) as response:
+            if response.status != 200:
+                raise RequestError(url, None, query, response, await response.text())
+            data = await codec.aload(response)
+        return _page(url, query, data, page_size)
+    offset, current = 0, cast(Optional[asyncio.Future], asyncio.ensure_future(fetch(0)))
+    try:
+        while current is not None:
+            page, more = await current
+            offset += len(page)
+            current = asyncio.ensure_future(fetch(offset)) if more else None
+            for item in page:
+                yield item
+    finally:
+        if current is not None:
+            current.cancel()
+
+
+# ------------------------
+# Consultas a Insight
+# ------------------------
+
+class EndpointInsight(object):
+
+    """Consultas a /insight/endpoint/mac/{mac}, con caché por MAC.
+
+    Cada respuesta se guarda 'ttl' segundos, las consultas simultáneas a
+    la misma MAC comparten una única petición, y nunca hay más de
+    'concurrency' peticiones en vuelo contra el ClearPass.
+    """
+
+    def __init__(self, session: AsyncSession, ttl: float = 300, concurrency: int = 8, maxsize: int = 4096) -> None:
+        self.session = session
+        self._cache = common.TTLCache(ttl, maxsize)
+        self._limit = asyncio.Semaphore(concurrency)
+        self._pending: Dict[str, asyncio.Future] = dict()
+
+    async def _fetch(self, mac: str) -> Dict[str, Any]:
+        path = "/insight/endpoint/mac/{}".format(mac)
+        async with self._limit:
+            async with self.session.get(path) as response:
+                if response.status != 200:
+                    raise RequestError(self.session.api_url + path, None, None, response, await response.text())
+                data = await codec.aload(response)
+        self._cache.set(mac, data)
+        return data
+
+    async def get(self, mac: str) -> Dict[str, Any]:
+        """Devuelve la información de Insight de la MAC, de la caché si es reciente"""
+        data = self._cache.get(mac, None)
+        if data is not None:
+            return data
+        pending = self._pending.get(mac, None)
+        if pending is None:
+            pending = asyncio.ensure_future(self._fetch(mac))
+            self._pending[mac] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(mac, None))
+        return await asyncio.shield(pending)
+
+    async def many(self, macs: Sequence[str]) -> Tuple[Dict[str, Any], ...]:
+        """Devuelve la información de Insight de varias MACs, en el mismo orden"""
+        return tuple(await asyncio.gather(*(self.get(mac) for mac in macs)))
+
+    def forget(self, mac: str) -> None:
+        """Descarta la información de la MAC guardada en la caché"""
+        self._cache.discard(mac)
+
+
+# ------------------------
+# Caché de sesiones activas
+# ------------------------
+
+# Segundos entre consultas de sesiones iniciadas o cerradas, por defecto
+SESSION_INTERVAL = 10.0
+
+# Antigüedad máxima (segundos) de una sesión sin acctstoptime para considerarla activa
+SESSION_MAX_AGE = 28800
+
+# Margen (segundos) que se vuelve a consultar en cada poll, para no perder
+# sesiones por diferencias de reloj o por registros que llegan con retraso
+SESSION_OVERLAP = 5
+
+
+def _epoch(value: Any) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+class SessionCache(object):
+
+    """Copia local de las sesiones activas de ClearPass, indexada por MAC y por NAS.
+
+    Al entrar en el contexto descarga todas las sesiones abiertas, y luego
+    cada 'interval' segundos pide sólo las que han empezado o terminado
+    desde la consulta anterior, para mantener la tabla al día:
+
+    >>> async with clearpass.SessionCache(session) as cache:
+    >>>     item = cache.find("00:62:6e:70:4f:1d", nas_ip="10.0.0.1")
+    >>>     if item is not None:
+    >>>         print(item["id"])
+
+    Las búsquedas no hacen ninguna petición al ClearPass. Las sesiones sin
+    acctstoptime más antiguas que 'max_age' se dan por terminadas.
+    """
+
+    def __init__(self, session: AsyncSession, interval: float = SESSION_INTERVAL,
+        max_age: float = SESSION_MAX_AGE, overlap: float = SESSION_OVERLAP, page_size: int = PAGE_SIZE) -> None:
+        self.session = session
+        self.interval = interval
+        self.max_age = max_age
+        self.overlap = overlap
+        self.page_size = page_size
+        # Sesiones activas por id, y los ids de cada MAC y de cada NAS
+        self._sessions: Dict[str, Dict[str, Any]] = dict()
+        self._by_mac: Dict[str, Dict[str, None]] = dict()
+        self._by_nas: Dict[str, Dict[str, None]] = dict()
+        # Marca de tiempo (del ClearPass) más reciente que se ha visto
+        self._since = 0
+        self._task: Optional[asyncio.Future] = None
+        # Último error en la actualización en segundo plano, o None si fue bien
+        self.error: Optional[Exception] = None
+
+    async def __aenter__(self) -> "SessionCache":
+        await self.load()
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _remove(self, sid: str) -> None:
+        item = self._sessions.pop(sid, None)
+        if item is None:
+            return
+        for index, key in ((self._by_mac, common.normalize_mac(item.get("mac_address", None) or "")),
+                           (self._by_nas, item.get("nasipaddress", None) or "")):
+            ids = index.get(key, None)
+            if ids is not None:
+                ids.pop(sid, None)
+                if not ids:
+                    del index[key]
+
+    def _apply(self, item: Dict[str, Any], now: float) -> None:
+        """Añade, actualiza o elimina una sesión según su estado"""
+        sid = str(item.get("id", ""))
+        start, stop = _epoch(item.get("acctstarttime", None)), _epoch(item.get("acctstoptime", None))
+        self._since = max(self._since, start, stop)
+        self._remove(sid)
+        if stop or now - start > self.max_age:
+            return
+        self._sessions[sid] = item
+        self._by_mac.setdefault(common.normalize_mac(item.get("mac_address", None) or ""), dict())[sid] = None
+        self._by_nas.setdefault(item.get("nasipaddress", None) or "", dict())[sid] = None
+
+    async def load(self) -> None:
+        """Descarga de nuevo todas las sesiones activas"""
+        now = time.time()
+        query = {
+            "acctstoptime": { "$exists": False },
+            "acctstarttime": { "$gt": int(now - self.max_age) },
+        }
+        items = [item async for item in aitems(self.session, "/session", filter=query, page_size=self.page_size)]
+        self._sessions, self._by_mac, self._by_nas = dict(), dict(), dict()
+        self._since = int(now)
+        for item in items:
+            self._apply(item, now)
+
+    async def poll(self) -> int:
+        """Aplica las sesiones iniciadas o terminadas desde la última consulta. Devuelve cuántas"""
+        now = time.time()
+        since = int(self._since - self.overlap)
+        query = { "$or": [
+            { "acctstarttime": { "$gt": since } },
+            { "acctstoptime": { "$gt": since } },
+        ]}
+        count = 0
+        async for item in aitems(self.session, "/session", filter=query, page_size=self.page_size):
+            self._apply(item, now)
+            count += 1
+        # Las sesiones que nunca reciben acctstoptime caducan por antigüedad
+        for sid, item in tuple(self._sessions.items()):
+            if now - _epoch(item.get("acctstarttime", None)) > self.max_age:
+                self._remove(sid)
+        return count
+
+    async def _run(self) -> None:
+        trace.detach()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.poll()
+                self.error = None
+            except Exception as err:
+                logging.error("SessionCache - error actualizando sesiones: %s", err)
+                self.error = err
+
+    def _sorted(self, ids: Optional[Mapping[str, None]]) -> Tuple[Dict[str, Any], ...]:
+        if not ids:
+            return tuple()
+        items = (self._sessions[sid] for sid in ids)
+        return tuple(sorted(items, key=lambda item: _epoch(item.get("acctstarttime", None)), reverse=True))
+
+    def by_mac(self, mac: str) -> Tuple[Dict[str, Any], ...]:
+        """Sesiones activas de la MAC (en cualquier formato), de la más reciente a la más antigua"""
+        return self._sorted(self._by_mac.get(common.normalize_mac(mac), None))
+
+    def by_nas(self, nas_ip: str) -> Tuple[Dict[str, Any], ...]:
+        """Sesiones activas en el NAS, de la más reciente a la más antigua"""
+        return self._sorted(self._by_nas.get(nas_ip, None))
+
+    def find(self, mac: str, nas_ip: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Sesión activa más reciente de la MAC, en un NAS cuya IP contenga 'nas_ip' si se indica"""
+        for item in self.by_mac(mac):
+            if nas_ip is None or nas_ip in (item.get("nasipaddress", None) or ""):
+                return item
+        return None
+
+    def __len__(self) -> int:
+        return len(self._sessions)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Codificación JSON de los mensajes NATS y de las respuestas de las APIs.
+#
+# Todo trabaja con bytes, para no pasar por str en cada mensaje. Si está
+# instalado orjson se usa como backend; si no (o si la variable de entorno
+# ARUBA_CODEC vale "json"), se usa el módulo json de la librería estándar.
+# Los errores de decodificación son siempre ValueError.
+
+import os
+import json
+
+from typing import Any, Union
+
+import aiohttp
+import requests
+
+# Datos JSON que se pueden decodificar
+Data = Union[bytes, bytearray, memoryview, str]
+
+try:
+    if os.environ.get("ARUBA_CODEC", "") == "json":
+        raise ImportError("ARUBA_CODEC=json")
+    import orjson # type: ignore
+
+    BACKEND = "orjson"
+
+    # Las claves que no son str (p.ej. enteros) se convierten, igual que en json
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj: Any) -> bytes:
+        """Codifica el objeto como JSON compacto en UTF-8"""
+        return orjson.dumps(obj, option=_OPTIONS)
+
+    def loads(data: Data) -> Any:
+        """Decodifica un documento JSON"""
+        return orjson.loads(data)
+
+except ImportError:
+    BACKEND = "json"
+
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+    _decoder = json.JSONDecoder()
+
+    def dumps(obj: Any) -> bytes:
+        """Codifica el objeto como JSON compacto en UTF-8"""
+        return _encoder.encode(obj).encode("utf-8")
+
+    def loads(data: Data) -> Any:
+        """Decodifica un documento JSON"""
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        elif not isinstance(data, str):
+            data = bytes(data).decode("utf-8")
+        return _decoder.decode(data)
+
+
+def dumps_text(obj: Any) -> str:
+    """Igual que dumps, pero devuelve str (para parámetros de URL, json_serialize de aiohttp...)"""
+    return dumps(obj).decode("utf-8")
+
+
+def load(response: requests.Response) -> Any:
+    """Decodifica el cuerpo de una respuesta de requests"""
+    return loads(response.content)
+
+
+async def aload(response: aiohttp.ClientResponse) -> Any:
+    """Decodifica el cuerpo de una respuesta de aiohttp. Como load, falla (ValueError) si no es JSON"""
+    return loads(await response.read())
@@ -1,13 +1,24 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import re
 import sys
+import json
 import configparser
 import getpass
 import os.path
+import time
+import asyncio
+import threading
+import requests
+import aiohttp
 
+from requests.adapters import HTTPAdapter
+from aruba import codec, metrics, trace
 from abc import ABC, abstractmethod
-from typing import Mapping, Dict, Optional, Any, Iterator, Callable, cast
+from collections import OrderedDict, deque
+from contextlib import contextmanager, asynccontextmanager
+from typing import Mapping, Dict, Optional, Any, Iterator, AsyncIterator, Callable, AsyncContextManager, Deque, Hashable, Set, Tuple, Union, cast
 
 Settings = Mapping[str, Mapping[str, Any]]
 Headers  = Optional[Dict[str, str]]
@@ -16,6 +27,14 @@ Attribs  = Optional[Dict[str, Any]]
 # Nombre del fichero de settings donde se guardarán los tokens
 SETTINGS_FILE = ".aruba.config"
 
+# Códigos de estado con los que el servidor indica que la sesión ha caducado
+EXPIRED_STATUS = (401, 403)
+
+# Número de hosts distintos para los que se mantiene un pool de conexiones,
+# y número de conexiones keep-alive que se conservan por cada host.
+POOL_HOSTS = 32
+POOL_SIZE = 8
+
 class Config(Settings):
 
     """Interfaz para gestionar el acceso a las configuraciones"""
@@ -66,10 +85,58 @@ class Config(Settings):
         return config
 
 
-class Session(ABC):
+def transport(pool_size: int = POOL_SIZE, pool_hosts: int = POOL_HOSTS) -> requests.Session:
+    """Crea un transporte HTTP con conexiones keep-alive reutilizables.
+
+    pool_size es el número máximo de conexiones que se conservan abiertas
+    contra cada host, y pool_hosts el número de hosts distintos para
+    los que se mantiene pool. Un mismo transporte puede compartirse
+    entre varias sesiones (por ejemplo, una por switch).
+    """
+    http = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size)
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+    return http
+
+
+def async_transport(pool_size: int = POOL_SIZE, verify: bool = True, limit: int = 100) -> aiohttp.ClientSession:
+    """Equivalente asíncrono (aiohttp) de transport. Debe crearse dentro del bucle de eventos.
+
+    limit es el número máximo de conexiones simultáneas en total (0 = sin límite).
+    """
+    ssl: Dict[str, Any] = {} if verify else { "ssl": False }
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit, limit_per_host=pool_size, **ssl))
+
+
+def _body(headers: Headers, kwargs: Dict[str, Any]) -> Headers:
+    """Codifica con aruba.codec el cuerpo json= de una petición, en lugar del json de requests o aiohttp"""
+    if "json" not in kwargs:
+        return headers
+    body = kwargs.pop("json")
+    if body is None:
+        return headers
+    kwargs["data"] = codec.dumps(body)
+    headers = dict(headers) if headers else dict()
+    headers.setdefault("Content-Type", "application/json")
+    return headers
+
+
+def _traced(span: trace.Span, status: int, body: Callable[[], Any]) -> None:
+    """Anota en el span el resultado de una petición, y su cuerpo si la traza está muestreada"""
+    span.set("status", status)
+    if status >= 400:
+        span.fail("status {}".format(status))
+    span.capture("response", body)
+
+
+class Credentials(object):
 
     """Objeto que encapsula la URL de la API, y el secreto de autenticación (token, cookie...)"""
 
+    # Tipo de dispositivo, para etiquetar las métricas
+    device = "device"
+
     def __init__(self, api_url: str, secret: str, params: Attribs = None, headers: Headers = None):
         self.api_url = api_url
         self.secret = secret
@@ -94,11 +161,610 @@ class Session(ABC):
         headers.update(self._headers)
         return headers
 
+    def _expired(self, status: int, content_type: str) -> bool:
+        """Comprueba si la respuesta indica que la sesión ha caducado"""
+        return status in EXPIRED_STATUS
+
+
+class Session(Credentials, ABC):
+
+    """Sesión síncrona contra la API de un dispositivo.
+
+    Todas las peticiones de la sesión, incluidas las de login y logout,
+    se hacen a través de un transporte con pool de conexiones keep-alive,
+    para no repetir la conexión TCP y el handshake TLS en cada llamada.
+    """
+
+    def __init__(self, api_url: str, secret: str, params: Attribs = None, headers: Headers = None,
+        verify: bool = True, http: Optional[requests.Session] = None, pool_size: int = POOL_SIZE):
+        super().__init__(api_url, secret, params=params, headers=headers)
+        self._verify = verify
+        # Si no me pasan un transporte compartido, creo uno propio y lo cierro con la sesión
+        self._owned = http is None
+        self.http = http if http is not None else transport(pool_size)
+        self._reauth_lock = threading.Lock()
+
+    def _send(self, method: str, path: str, params: Attribs, headers: Headers, kwargs: Dict[str, Any]) -> requests.Response:
+        with trace.span("http", device=self.device, method=method, endpoint=metrics.endpoint(path)) as span:
+            if span is not None:
+                # Sólo los parámetros de la llamada; los de autenticación se añaden después
+                span.capture("params", params)
+                span.capture("request", lambda: kwargs.get("data", None))
+            start = time.perf_counter()
+            response = self.http.request(method, self.api_url + path,
+                params=self.params(dict(params) if params else None),
+                headers=self.headers(dict(headers) if headers else None),
+                **kwargs)
+            metrics.request(self.device, method, path, response.status_code, time.perf_counter() - start)
+            if span is not None:
+                _traced(span, response.status_code, lambda: response.content)
+        return response
+
+    def _authenticate(self) -> None:
+        """Lanza refresh, registrando su duración en las métricas"""
+        start, ok = time.perf_counter(), False
+        with trace.span("auth", device=self.device):
+            try:
+                self.refresh()
+                ok = True
+            finally:
+                metrics.auth(self.device, time.perf_counter() - start, ok)
+
+    def _reauth(self, stale: str) -> None:
+        """Renueva la sesión, salvo que otro hilo ya lo haya hecho desde que se usó 'stale'"""
+        with self._reauth_lock:
+            if self.secret == stale:
+                self._authenticate()
+
+    def request(self, method: str, path: str, params: Attribs = None, headers: Headers = None,
+        **kwargs: Any) -> requests.Response:
+        """Lanza una petición a la ruta dada (relativa a api_url), con la autenticación de la sesión.
+
+        Si el servidor responde que la sesión ha caducado, se renueva y se
+        repite la petición una vez.
+        """
+        kwargs.setdefault("verify", self._verify)
+        headers = _body(headers, kwargs)
+        stale = self.secret
+        response = self._send(method, path, params, headers, kwargs)
+        if self._expired(response.status_code, response.headers.get("Content-Type", "")):
+            self._reauth(stale)
+            response = self._send(method, path, params, headers, kwargs)
+        return response
+
+    def get(self, path: str, **kwargs: Any) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs: Any) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path: str, **kwargs: Any) -> requests.Response:
+        return self.request("PUT", path, **kwargs)
+
+    def patch(self, path: str, **kwargs: Any) -> requests.Response:
+        return self.request("PATCH", path, **kwargs)
+
+    def delete(self, path: str, **kwargs: Any) -> requests.Response:
+        return self.request("DELETE", path, **kwargs)
+
+    def close(self) -> None:
+        """Libera las conexiones del pool, si el transporte es propio de la sesión"""
+        if self._owned:
+            self.http.close()
+
     @abstractmethod
     def refresh(self) -> None:
         raise NotImplemented()
 
 
+class AsyncSession(Credentials, AsyncContextManager["AsyncSession"]):
+
+    """Sesión asíncrona (aiohttp) contra la API de un dispositivo.
+
+    La autenticación se lanza al entrar en el contexto (async with), y el
+    logout al salir. Si no se le pasa un aiohttp.ClientSession compartido,
+    crea uno propio al entrar y lo cierra al salir.
+    """
+
+    def __init__(self, api_url: str, params: Attribs = None, headers: Headers = None,
+        verify: bool = True, http: Optional[aiohttp.ClientSession] = None, pool_size: int = POOL_SIZE):
+        super().__init__(api_url, "", params=params, headers=headers)
+        self._verify = verify
+        self._ssl: Dict[str, Any] = {} if verify else { "ssl": False }
+        self._pool_size = pool_size
+        self._owned = http is None
+        self.http = cast(aiohttp.ClientSession, http)
+        self._reauth_lock: Optional[asyncio.Lock] = None
+
+    async def __aenter__(self) -> "AsyncSession":
+        if self._owned:
+            self.http = async_transport(self._pool_size, self._verify)
+        try:
+            await self._authenticate()
+        except:
+            await self.close()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        try:
+            await self._logout()
+        finally:
+            await self.close()
+
+    async def _send(self, method: str, path: str, params: Attribs, headers: Headers,
+        kwargs: Dict[str, Any]) -> aiohttp.ClientResponse:
+        with trace.span("http", device=self.device, method=method, endpoint=metrics.endpoint(path)) as span:
+            if span is not None:
+                span.capture("params", params)
+                span.capture("request", lambda: kwargs.get("data", None))
+            start = time.perf_counter()
+            response = await self.http.request(method, self.api_url + path,
+                params=self.params(dict(params) if params else None),
+                headers=self.headers(dict(headers) if headers else None),
+                **kwargs)
+            metrics.request(self.device, method, path, response.status, time.perf_counter() - start)
+            if span is not None:
+                # En las trazas muestreadas leo ya el cuerpo, aiohttp lo guarda
+                # y se lo devuelve después a quien lanzó la petición.
+                body = await response.read() if span.sampled else None
+                _traced(span, response.status, lambda: body)
+        return response
+
+    async def _authenticate(self) -> None:
+        """Lanza refresh, registrando su duración en las métricas"""
+        start, ok = time.perf_counter(), False
+        with trace.span("auth", device=self.device):
+            try:
+                await self.refresh()
+                ok = True
+            finally:
+                metrics.auth(self.device, time.perf_counter() - start, ok)
+
+    async def _reauth(self, stale: str) -> None:
+        """Renueva la sesión, salvo que otra corrutina ya lo haya hecho desde que se usó 'stale'.
+
+        Todas las corrutinas que detectan a la vez la caducidad esperan al
+        mismo login, en lugar de lanzar uno cada una.
+        """
+        if self._reauth_lock is None:
+            self._reauth_lock = asyncio.Lock()
+        async with self._reauth_lock:
+            if self.secret == stale:
+                await self._authenticate()
+
+    @asynccontextmanager
+    async def request(self, method: str, path: str, params: Attribs = None, headers: Headers = None,
+        **kwargs: Any) -> AsyncIterator[aiohttp.ClientResponse]:
+        """Lanza una petición a la ruta dada (relativa a api_url), con la autenticación de la sesión.
+
+        Se usa igual que las peticiones de aiohttp:
+
+        >>> async with session.get("/vlans") as response:
+        >>>     data = await codec.aload(response)
+
+        Si el servidor responde que la sesión ha caducado, se renueva y se
+        repite la petición una vez.
+        """
+        for key, val in self._ssl.items():
+            kwargs.setdefault(key, val)
+        headers = _body(headers, kwargs)
+        stale = self.secret
+        response = await self._send(method, path, params, headers, kwargs)
+        if self._expired(response.status, response.content_type):
+            response.release()
+            await self._reauth(stale)
+            response = await self._send(method, path, params, headers, kwargs)
+        try:
+            yield response
+        finally:
+            response.release()
+
+    def get(self, path: str, **kwargs: Any) -> AsyncContextManager[aiohttp.ClientResponse]:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs: Any) -> AsyncContextManager[aiohttp.ClientResponse]:
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path: str, **kwargs: Any) -> AsyncContextManager[aiohttp.ClientResponse]:
+        return self.request("PUT", path, **kwargs)
+
+    def patch(self, path: str, **kwargs: Any) -> AsyncContextManager[aiohttp.ClientResponse]:
+        return self.request("PATCH", path, **kwargs)
+
+    def delete(self, path: str, **kwargs: Any) -> AsyncContextManager[aiohttp.ClientResponse]:
+        return self.request("DELETE", path, **kwargs)
+
+    async def close(self) -> None:
+        """Libera las conexiones del pool, si el transporte es propio de la sesión"""
+        if self._owned and self.http is not None:
+            await self.http.close()
+
+    async def _logout(self) -> None:
+        """Cierra la sesión en el dispositivo, si el dispositivo lo requiere"""
+        pass
+
+    @abstractmethod
+    async def refresh(self) -> None:
+        raise NotImplemented()
+
+
+class PoolStats(object):
+
+    """Ocupación y esperas del pool de sesiones de un dispositivo"""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        # Sesiones abiertas, y cuántas de ellas están en uso
+        self.members = 0
+        self.busy = 0
+        # Llamadas esperando a que quede libre una sesión
+        self.waiting = 0
+        # Sesiones entregadas, y tiempo total y máximo de espera hasta conseguirlas
+        self.acquired = 0
+        self.waitSeconds = 0.0
+        self.maxWait = 0.0
+
+    def asdict(self) -> Dict[str, Any]:
+        return dict(self.__dict__)
+
+
+class _Slot(object):
+
+    """Sesiones de un dispositivo: las libres, y las llamadas que esperan turno"""
+
+    def __init__(self, params: Any, size: int) -> None:
+        self.params = params
+        self.stats = PoolStats(size)
+        self.idle: Deque[AsyncSession] = deque()
+        self.lastUse: Dict[AsyncSession, float] = dict()
+        # Cada llamada en espera recibe una sesión (o None, si debe reintentar) por su futuro
+        self.waiters: Deque[asyncio.Future] = deque()
+
+
+class SessionPool(ABC):
+
+    """Sesiones autenticadas con muchos dispositivos, compartidas entre corrutinas.
+
+    Mantiene como mucho 'size' sesiones abiertas con cada dispositivo y
+    juego de credenciales, y las presta por turnos (en orden de llegada).
+    Las sesiones que llevan más de 'idle' segundos paradas se comprueban
+    (_valid) antes de entregarlas. Al cerrar el pool se hace logout de
+    todas: de las libres, y de las ocupadas cuando se devuelvan.
+
+    Cada tipo de dispositivo lo extiende con _open, que crea sus sesiones,
+    y con un método session que completa los parámetros con la config y
+    llama a _borrow. Ver switch.Pool y controller.Pool.
+    """
+
+    # Tipo de dispositivo, para las etiquetas de las métricas
+    device = "device"
+
+    def __init__(self, config: Optional[Settings], size: int, verify: bool,
+        http: Optional[aiohttp.ClientSession], idle: float) -> None:
+        self._config = config if config is not None else Config()
+        self._size = size
+        self._verify = verify
+        self._idle = idle
+        self._owned = http is None
+        self._http = http
+        # Un hueco por dispositivo y credenciales: las sesiones de un usuario no se prestan a otro
+        self._slots: Dict[Hashable, _Slot] = dict()
+        self._closed = False
+        # Logouts de las sesiones devueltas tras cerrar el pool, fuera de session()
+        self._retiring: Set[asyncio.Future] = set()
+
+    async def __aenter__(self) -> "SessionPool":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.close()
+
+    def _transport(self) -> aiohttp.ClientSession:
+        if self._http is None:
+            # La concurrencia la limita el pool de sesiones, no el de conexiones
+            self._http = async_transport(verify=self._verify, limit=0)
+        return self._http
+
+    def _slot(self, params: Hashable) -> _Slot:
+        slot = self._slots.get(params, None)
+        if slot is None:
+            slot = _Slot(params, self._size)
+            self._slots[params] = slot
+        return slot
+
+    def _gauges(self, slot: _Slot) -> None:
+        labels = { "device": self.device, "host": slot.params.api_host }
+        metrics.REGISTRY.set("aruba_pool_members", labels, slot.stats.members)
+        metrics.REGISTRY.set("aruba_pool_busy", labels, slot.stats.busy)
+        metrics.REGISTRY.set("aruba_pool_waiting", labels, slot.stats.waiting)
+
+    @abstractmethod
+    def _open(self, params: Any) -> AsyncSession:
+        """Crea (sin autenticar) una sesión con los parámetros de un hueco"""
+        raise NotImplemented()
+
+    async def _valid(self, member: AsyncSession) -> bool:
+        """Comprueba si el dispositivo sigue aceptando una sesión parada. Por defecto no se comprueba"""
+        return True
+
+    async def _connect(self, slot: _Slot) -> AsyncSession:
+        member = self._open(slot.params)
+        await member.__aenter__()
+        slot.lastUse[member] = time.monotonic()
+        return member
+
+    async def _check(self, slot: _Slot, member: AsyncSession) -> None:
+        """Renueva la sesión si lleva mucho tiempo parada y el switch ya no la acepta"""
+        if time.monotonic() - slot.lastUse.get(member, 0) > self._idle:
+            stale = member.secret
+            if not await self._valid(member):
+                await member._reauth(stale)
+
+    def _wake(self, slot: _Slot, member: Optional[AsyncSession]) -> bool:
+        """Entrega la sesión (o un aviso de reintento, si es None) a la primera llamada en espera"""
+        while slot.waiters:
+            waiter = slot.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(member)
+                return True
+        return False
+
+    async def _acquire(self, slot: _Slot) -> AsyncSession:
+        stats = slot.stats
+        while True:
+            if self._closed:
+                raise RuntimeError("Pool is closed")
+            if slot.idle:
+                return slot.idle.popleft()
+            if stats.members < stats.size:
+                stats.members += 1
+                try:
+                    return await self._connect(slot)
+                except:
+                    # Dejo el hueco libre, y aviso a quien espere para que lo intente
+                    stats.members -= 1
+                    self._wake(slot, None)
+                    raise
+            waiter = asyncio.get_running_loop().create_future()
+            slot.waiters.append(waiter)
+            stats.waiting += 1
+            self._gauges(slot)
+            try:
+                member = await waiter
+            except asyncio.CancelledError:
+                # Si ya me habían entregado una sesión, se la paso al siguiente
+                if waiter.done() and not waiter.cancelled() and waiter.result() is not None:
+                    self._release(slot, waiter.result())
+                raise
+            finally:
+                stats.waiting -= 1
+            if member is not None:
+                return member
+
+    def _release(self, slot: _Slot, member: AsyncSession) -> None:
+        if self._closed:
+            retire = asyncio.ensure_future(self._retire(slot, member))
+            self._retiring.add(retire)
+            retire.add_done_callback(self._retiring.discard)
+            return
+        slot.lastUse[member] = time.monotonic()
+        if not self._wake(slot, member):
+            slot.idle.append(member)
+
+    async def _logout(self, slot: _Slot, member: AsyncSession) -> None:
+        slot.stats.members -= 1
+        slot.lastUse.pop(member, None)
+        try:
+            await member.__aexit__(None, None, None)
+        except Exception:
+            pass
+        self._gauges(slot)
+
+    async def _retire(self, slot: _Slot, member: AsyncSession) -> None:
+        """Logout de una sesión devuelta con el pool ya cerrado"""
+        await self._logout(slot, member)
+        await self._finish()
+
+    async def _finish(self) -> None:
+        """Cierra el pool de conexiones, si es propio, cuando ya no queda ninguna sesión abierta"""
+        if any(slot.stats.members > 0 for slot in self._slots.values()):
+            return
+        if self._owned and self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    @asynccontextmanager
+    async def _borrow(self, params: Hashable) -> AsyncIterator[AsyncSession]:
+        """Presta una sesión del hueco de 'params', esperando turno si están todas ocupadas"""
+        slot = self._slot(params)
+        stats = slot.stats
+        start = time.perf_counter()
+        member = await self._acquire(slot)
+        try:
+            await self._check(slot, member)
+        except:
+            self._release(slot, member)
+            raise
+        waited = time.perf_counter() - start
+        stats.acquired += 1
+        stats.busy += 1
+        stats.waitSeconds += waited
+        stats.maxWait = max(stats.maxWait, waited)
+        metrics.REGISTRY.observe("aruba_pool_wait_seconds", { "device": self.device, "host": slot.params.api_host }, waited)
+        self._gauges(slot)
+        try:
+            yield member
+        finally:
+            stats.busy -= 1
+            if self._closed:
+                await self._retire(slot, member)
+            else:
+                self._release(slot, member)
+                self._gauges(slot)
+
+    def stats(self, api_host: str, username: Optional[str] = None) -> Optional[PoolStats]:
+        """Ocupación del pool de un dispositivo, si se ha usado (con 'username', si se usa con varios usuarios)"""
+        for params, slot in self._slots.items():
+            if params.api_host == api_host and (username is None or params.username == username):
+                return slot.stats
+        return None
+
+    async def close(self) -> None:
+        """Hace logout de las sesiones libres, y de las ocupadas cuando se devuelvan.
+
+        El pool de conexiones, si es propio, se cierra tras el último logout.
+        Las llamadas que esperaban turno, y las nuevas, fallan con RuntimeError.
+        """
+        self._closed = True
+        try:
+            for slot in self._slots.values():
+                while slot.idle:
+                    await self._logout(slot, slot.idle.popleft())
+                while self._wake(slot, None):
+                    pass
+        finally:
+            await self._finish()
+
+
+class TTLCache(object):
+
+    """Diccionario cuyos elementos caducan 'ttl' segundos después de guardarse.
+
+    Como mucho guarda 'maxsize' elementos; si se supera, descarta los más antiguos.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 4096) -> None:
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._items: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._items.get(key, None)
+        if item is None:
+            return default
+        expires, value = cast(Tuple[float, Any], item)
+        if expires <= time.monotonic():
+            del self._items[key]
+            return default
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._items.pop(key, None)
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def discard(self, key: Hashable) -> None:
+        self._items.pop(key, None)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, self) is not self
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+_NOT_HEX = re.compile(r"[^0-9a-f]")
+
+
+def normalize_mac(mac: str) -> str:
+    """Normaliza una MAC al formato de ClearPass: 12 dígitos hexadecimales en minúsculas"""
+    return _NOT_HEX.sub("", mac.lower())
+
+
+def inventory_item(item: Union[str, Mapping[str, Any]]) -> Dict[str, Any]:
+    """Elemento de un inventario (un nombre de host, o un diccionario con api_host y sus credenciales) como diccionario"""
+    if isinstance(item, str):
+        return { "api_host": item }
+    return dict(item)
+
+
+# Bloqueo exclusivo de un fichero entre procesos: fcntl en POSIX, msvcrt en Windows
+try:
+    import fcntl
+
+    def _lock(fd: int) -> None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+    def _unlock(fd: int) -> None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+except ImportError:
+    import msvcrt
+
+    def _lock(fd: int) -> None:
+        os.lseek(fd, 0, os.SEEK_SET)
+        while True:
+            try:
+                # LK_LOCK reintenta durante un segundo antes de fallar
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1) # type: ignore
+                return
+            except OSError:
+                continue
+
+    def _unlock(fd: int) -> None:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1) # type: ignore
+
+
+class FileStore(object):
+
+    """Diccionario guardado en un fichero JSON, compartido entre procesos.
+
+    Cada acceso bloquea un fichero auxiliar (path + ".lock"), así que varios
+    procesos pueden leer y actualizar entradas sin pisarse. El fichero se
+    crea con permisos 0600, porque suele guardar credenciales.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = os.path.expanduser(path)
+
+    @contextmanager
+    def locked(self) -> Iterator[Dict[str, Any]]:
+        """Bloquea el fichero y devuelve su contenido. Los cambios en el diccionario se guardan al salir"""
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            _lock(fd)
+            try:
+                data = self._read()
+                before = json.dumps(data, sort_keys=True)
+                yield data
+                if json.dumps(data, sort_keys=True) != before:
+                    self._write(data)
+            finally:
+                _unlock(fd)
+        finally:
+            os.close(fd)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self.locked() as data:
+            return data.get(key, default)
+
+    def set(self, key: str, value: Any) -> None:
+        with self.locked() as data:
+            data[key] = value
+
+    def discard(self, key: str) -> None:
+        with self.locked() as data:
+            data.pop(key, None)
+
+    def _read(self) -> Dict[str, Any]:
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return dict()
+        return data if isinstance(data, dict) else dict()
+
+    def _write(self, data: Mapping[str, Any]) -> None:
+        # Escribo en un temporal y lo renombro, para no dejar nunca el fichero a medias
+        temp = "{}.{}.tmp".format(self.path, os.getpid())
+        with os.fdopen(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump(data, f)
+        os.replace(temp, self.path)
+
+
 def _ask_input(prompt: str, defaults: str = None) -> str:
     """Pide una entrada por consola. Si defaults != None, lo utiliza como valor por defecto."""
     result = None
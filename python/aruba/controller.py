@@ -1,15 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import json
+import asyncio
+import hashlib
 import requests
+import aiohttp
 
 from contextlib import contextmanager
 from collections import namedtuple
-from typing import Optional, Dict, Iterator, Any, cast
+from typing import Optional, Callable, Dict, Hashable, Iterator, AsyncIterator, AsyncContextManager, Mapping, Sequence, Tuple, Set, Any, cast
 
-from aruba.errors import RequestError, FormatError
+from aruba.errors import RequestError, FormatError, CommandError
 from aruba.common import _ask_input, _ask_pass, _fill, Config, Settings
-from aruba import common
+from aruba import codec, common, fleet
 
 
 def _api_auth_url(api_host: str) -> str:
@@ -19,6 +23,71 @@ def _api_auth_url(api_host: str) -> str:
 def _api_config_url(api_host: str) -> str:
     return "https://{}:4343/v1/configuration".format(api_host)
 
+
+def _uidaruba(login_url: str, credentials: Mapping[str, str], data: Mapping[str, Any]) -> str:
+    """Extrae el UIDARUBA de la respuesta de login"""
+    gres = data.get("_global_result", None)
+    if not gres:
+        raise FormatError(login_url, None, credentials, data, "_global_result")
+    uid = gres.get("UIDARUBA", None)
+    if not uid:
+        raise FormatError(login_url, None, credentials, data, "UIDARUBA")
+    return uid
+
+
+def _expired(status: int, content_type: str) -> bool:
+    """Además de 401/403, la MD/MM responde con su página de login (HTML) si el UIDARUBA ha caducado"""
+    return status in common.EXPIRED_STATUS or content_type.startswith("text/html")
+
+
+# Tabla de la salida de un comando show: nombre, columnas en orden, y filas (dict columna -> valor)
+Table = namedtuple('Table', ('name', 'columns', 'rows'))
+
+# Salida de un comando show: tablas por nombre, otros valores sueltos, y texto libre (_data)
+Show = namedtuple('Show', ('command', 'tables', 'values', 'data'))
+
+
+def _columns(meta: Sequence[str], rows: Sequence[Mapping[str, Any]]) -> Tuple[str, ...]:
+    """Columnas de una tabla, en el orden de _meta, más las que no aparezcan en _meta"""
+    present: Dict[str, None] = dict()
+    for row in rows:
+        for key in row:
+            present[key] = None
+    if not present:
+        return tuple(meta)
+    ordered = [col for col in meta if col in present]
+    known = set(ordered)
+    return tuple(ordered + [col for col in present if col not in known])
+
+
+def _show(url: str, command: str, data: Mapping[str, Any]) -> Show:
+    """Convierte la salida JSON de /showcommand en tablas.
+
+    Cada lista de diccionarios es una tabla, cuyas columnas se ordenan según
+    la lista _meta. Los diccionarios sueltos son tablas de una fila, y el
+    texto que no es tabular llega en la lista _data.
+    """
+    gres = data.get("_global_result", None)
+    if gres and str(gres.get("status", "0")) != "0":
+        raise CommandError(url, command, gres.get("status"), gres.get("status_str", ""))
+    meta = data.get("_meta", None)
+    columns = tuple(str(col) for col in meta) if isinstance(meta, list) else tuple()
+    tables: Dict[str, Table] = dict()
+    values: Dict[str, Any] = dict()
+    for name, value in data.items():
+        if name.startswith("_"):
+            continue
+        if isinstance(value, list) and all(isinstance(row, dict) for row in value):
+            rows = tuple(value)
+            tables[name] = Table(name, _columns(columns, rows), rows)
+        elif isinstance(value, dict):
+            tables[name] = Table(name, tuple(value.keys()), (value,))
+        else:
+            values[name] = value
+    text = data.get("_data", None)
+    lines = tuple(str(line) for line in text) if isinstance(text, list) else tuple()
+    return Show(command, tables, values, lines)
+
 # ------------------------
 # Métodos de autenticación
 # ------------------------
@@ -26,38 +95,35 @@ def _api_config_url(api_host: str) -> str:
 
 class Session(common.Session):
 
-    def __init__(self, api_host: str, username: str, password: str, verify: bool = True) -> None:
+    device = "controller"
+
+    def __init__(self, api_host: str, username: str, password: str, verify: bool = True,
+        http: Optional[requests.Session] = None, pool_size: int = common.POOL_SIZE) -> None:
         self._api_host = api_host
         self._username = username
         self._password = password
-        self._verify = verify
-        uidaruba = self._login()
-        super().__init__(_api_config_url(api_host), uidaruba,
-            headers={ "Cookie": f"SESSION={uidaruba}" },
-            params={ "UIDARUBA": uidaruba })
+        super().__init__(_api_config_url(api_host), "", headers=dict(), params=dict(),
+            verify=verify, http=http, pool_size=pool_size)
+        self._authenticate()
+
+    def _expired(self, status: int, content_type: str) -> bool:
+        return _expired(status, content_type)
 
     def _login(self) -> str:
         """Lanza un intento de autenticación contra un MD/MM, devuelve el UIDARUBA"""
         login_url = _api_auth_url(self._api_host) + "/login"
         credentials = { "username": self._username, "password": self._password }
-        response = requests.post(login_url, verify=self._verify, data=credentials)
+        response = self.http.post(login_url, verify=self._verify, data=credentials)
         if response.status_code != 200:
             raise RequestError(login_url, None, credentials, response)
         # No error, accedo a los tokens
-        data = response.json()
-        gres = data.get("_global_result", None)
-        if not gres:
-            raise FormatError(login_url, None, credentials, data, "_global_result")
-        uid = gres.get("UIDARUBA", None)
-        if not uid:
-            raise FormatError(login_url, None, credentials, data, "UIDARUBA")
-        return uid
+        return _uidaruba(login_url, credentials, codec.load(response))
 
     def _logout(self) -> None:
         """Cierra una sesion REST contra un MD/MM"""
         logout_url = _api_auth_url(self._api_host) + "/logout"
         credentials = { "UIDARUBA": self.secret }
-        response = requests.get(logout_url, verify=self._verify, data=credentials)
+        response = self.http.get(logout_url, verify=self._verify, data=credentials)
         if response.status_code != 200:
             raise RequestError(logout_url, None, credentials, response)
 
@@ -69,26 +135,379 @@ class Session(common.Session):
         params["UIDARUBA"] = uidaruba
         self.secret = uidaruba
 
+    def show(self, command: str) -> Show:
+        """Ejecuta un comando show y devuelve su salida en forma de tablas"""
+        url = self.api_url + "/showcommand"
+        response = self.get("/showcommand", params={ "command": command, "json": 1 })
+        if response.status_code != 200:
+            raise RequestError(url, None, command, response)
+        return _show(url, command, codec.load(response))
 
-@contextmanager
-def session(config: Settings, api_host: Optional[str] = None, username: Optional[str] = None,
-    password: Optional[str] = None, verify: bool = True) -> Iterator[Session]:
-    """Obtiene un uidaruba para una MD/MM"""
-    # Cargo de la config valores por defecto para todos los parámetros
+
+class AsyncSession(common.AsyncSession):
+
+    """Versión asíncrona de Session, para usar con async with"""
+
+    device = "controller"
+
+    def __init__(self, api_host: str, username: str, password: str, verify: bool = True,
+        http: Optional[aiohttp.ClientSession] = None, pool_size: int = common.POOL_SIZE) -> None:
+        self._api_host = api_host
+        self._username = username
+        self._password = password
+        super().__init__(_api_config_url(api_host), headers=dict(), params=dict(),
+            verify=verify, http=http, pool_size=pool_size)
+
+    def _expired(self, status: int, content_type: str) -> bool:
+        return _expired(status, content_type)
+
+    async def _login(self) -> str:
+        """Lanza un intento de autenticación contra un MD/MM, devuelve el UIDARUBA"""
+        login_url = _api_auth_url(self._api_host) + "/login"
+        credentials = { "username": self._username, "password": self._password }
+        async with self.http.post(login_url, data=credentials, **self._ssl) as response:
+            if response.status != 200:
+                raise RequestError(login_url, None, credentials, response, await response.text())
+            data = await codec.aload(response)
+        return _uidaruba(login_url, credentials, data)
+
+    async def _logout(self) -> None:
+        """Cierra una sesion REST contra un MD/MM"""
+        logout_url = _api_auth_url(self._api_host) + "/logout"
+        credentials = { "UIDARUBA": self.secret }
+        async with self.http.get(logout_url, data=credentials, **self._ssl) as response:
+            if response.status != 200:
+                raise RequestError(logout_url, None, credentials, response, await response.text())
+
+    async def refresh(self) -> None:
+        uidaruba = await self._login()
+        headers = cast(Dict[str, str], self._headers)
+        params = cast(Dict[str, Any], self._params)
+        headers['Cookie'] = f"SESSION={uidaruba}"
+        params["UIDARUBA"] = uidaruba
+        self.secret = uidaruba
+
+    async def show(self, command: str) -> Show:
+        """Ejecuta un comando show y devuelve su salida en forma de tablas"""
+        url = self.api_url + "/showcommand"
+        async with self.get("/showcommand", params={ "command": command, "json": 1 }) as response:
+            if response.status != 200:
+                raise RequestError(url, None, command, response, await response.text())
+            data = await codec.aload(response)
+        return _show(url, command, data)
+
+
+Params = namedtuple('Params', ('api_host', 'username', 'password'))
+
+
+def _settings(config: Settings, api_host: Optional[str], username: Optional[str],
+    password: Optional[str]) -> Params:
+    """Completa los parámetros de conexión con los valores por defecto de la config"""
     data = _fill({
         "api_host": api_host,
         "username": username,
         "password": password,
     }, config.get("controller"))
-    # Saco las variables del array, por comodidad
-    Params = namedtuple('Params', ('api_host', 'username', 'password'))
-    asserted = Params(data["api_host"], data["username"], data["password"])
+    return Params(data["api_host"], data["username"], data["password"])
+
+
+@contextmanager
+def session(config: Settings, api_host: Optional[str] = None, username: Optional[str] = None,
+    password: Optional[str] = None, verify: bool = True,
+    http: Optional[requests.Session] = None, pool_size: int = common.POOL_SIZE) -> Iterator[Session]:
+    """Obtiene un uidaruba para una MD/MM"""
+    asserted = _settings(config, api_host, username, password)
     # Lanzo la autenticacion que corresponda
-    curr = Session(asserted.api_host, asserted.username, asserted.password, verify=verify)
+    curr = Session(asserted.api_host, asserted.username, asserted.password, verify=verify,
+        http=http, pool_size=pool_size)
     try:
         yield curr
     finally:
-        curr._logout()
+        try:
+            curr._logout()
+        finally:
+            curr.close()
+
+
+def async_session(config: Settings, api_host: Optional[str] = None, username: Optional[str] = None,
+    password: Optional[str] = None, verify: bool = True,
+    http: Optional[aiohttp.ClientSession] = None, pool_size: int = common.POOL_SIZE) -> AsyncSession:
+    """Prepara una sesión asíncrona con una MD/MM. El UIDARUBA se obtiene al entrar en async with."""
+    asserted = _settings(config, api_host, username, password)
+    return AsyncSession(asserted.api_host, asserted.username, asserted.password, verify=verify,
+        http=http, pool_size=pool_size)
+
+
+# ------------------------
+# Pool de sesiones
+# ------------------------
+
+# Sesiones (UIDARUBA) que se mantienen abiertas con cada controladora, por defecto
+POOL_MEMBERS = 2
+
+
+class Pool(common.SessionPool):
+
+    """Sesiones autenticadas con muchas controladoras, compartidas entre corrutinas.
+
+    Igual que switch.Pool: mantiene como mucho 'size' sesiones abiertas con
+    cada controladora y juego de credenciales, las presta por turnos, y hace
+    logout de todas al cerrarse. Se puede pasar a show_all para que no haga
+    login y logout en cada llamada:
+
+    >>> async with controller.Pool(Config(), verify=False) as pool:
+    >>>     async for result in controller.show_all(("md1", "md2"), ("show user-table",), pool=pool):
+    >>>         ...
+
+    Las sesiones que caducan se renuevan solas al usarlas, como en cualquier
+    AsyncSession, así que no se comprueban antes de entregarlas.
+    """
+
+    device = AsyncSession.device
+
+    def __init__(self, config: Optional[Settings] = None, size: int = POOL_MEMBERS, verify: bool = True,
+        http: Optional[aiohttp.ClientSession] = None) -> None:
+        super().__init__(config, size, verify, http, 0)
+
+    def _open(self, params: Params) -> AsyncSession:
+        return AsyncSession(params.api_host, params.username, params.password, verify=self._verify,
+            http=self._transport())
+
+    def session(self, api_host: Optional[str] = None, username: Optional[str] = None,
+        password: Optional[str] = None) -> AsyncContextManager[AsyncSession]:
+        """Presta una sesión con la controladora, esperando turno si están todas ocupadas.
+
+        Los parámetros que falten se toman de la sección "controller" de la config.
+        """
+        params = _settings(self._config, api_host, username, password)
+        return cast(AsyncContextManager[AsyncSession], self._borrow(params))
+
+
+# ------------------------
+# Comandos show en paralelo
+# ------------------------
+
+# Resultado de un comando en una controladora: host, comando, salida (Show), y excepción si ha fallado
+ShowResult = namedtuple('ShowResult', ('host', 'command', 'value', 'error'))
+
+# Número de controladoras con sesión abierta a la vez, por defecto
+CONCURRENCY = 16
+
+# Número de comandos que se lanzan a la vez contra una misma controladora, por defecto
+PER_HOST = 4
+
+
+async def _show_host(http: aiohttp.ClientSession, limit: asyncio.Semaphore, config: Settings,
+    item: Any, commands: Sequence[str], per_host: int, verify: bool,
+    timeout: Optional[float], results: asyncio.Queue, pool: Optional[Pool]) -> None:
+    """Ejecuta los comandos en una controladora, dejando un ShowResult por comando en la cola"""
+    data = common.inventory_item(item)
+    host = data.get("api_host", None)
+    params = { key: data.get(key, None) for key in ("username", "password") }
+    pending: Set[str] = set(commands)
+    async with limit:
+        try:
+            if pool is not None:
+                context: AsyncContextManager[AsyncSession] = pool.session(host, **params)
+            else:
+                context = async_session(config, api_host=host, verify=verify, http=http, **params)
+            async with context as session:
+                gate = asyncio.Semaphore(per_host)
+                async def one(command: str) -> None:
+                    async with gate:
+                        try:
+                            if timeout is None:
+                                value = await session.show(command)
+                            else:
+                                value = await asyncio.wait_for(session.show(command), timeout)
+                            result = ShowResult(host, command, value, None)
+                        except Exception as err:
+                            result = ShowResult(host, command, None, err)
+                    pending.discard(command)
+                    results.put_nowait(result)
+                await asyncio.gather(*(one(command) for command in commands))
+        except Exception as err:
+            # Fallo de login: todos los comandos que no han llegado a ejecutarse fallan
+            for command in commands:
+                if command in pending:
+                    pending.discard(command)
+                    results.put_nowait(ShowResult(host, command, None, err))
+
+
+async def show_all(inventory: fleet.Inventory, commands: Sequence[str], concurrency: int = CONCURRENCY,
+    per_host: int = PER_HOST, config: Optional[Settings] = None, verify: bool = True,
+    timeout: Optional[float] = None, pool: Optional[Pool] = None) -> AsyncIterator[ShowResult]:
+    """Ejecuta varios comandos show en muchas controladoras, en paralelo.
+
+    Se abre una sesión por controladora (como mucho 'concurrency' a la vez),
+    todas sobre el mismo pool de conexiones, y en cada una se lanzan hasta
+    'per_host' comandos simultáneos. Los resultados se devuelven según llegan:
+
+    >>> async for result in controller.show_all(("md1", "md2"), ("show user-table", "show datapath session table")):
+    >>>     if result.error is None:
+    >>>         for table in result.value.tables.values():
+    >>>             print(result.host, table.name, len(table.rows))
+
+    El inventario tiene el mismo formato que en aruba.fleet. Los valores
+    que no aparezcan en él se toman de la sección "controller" de la config.
+    'timeout' limita la duración de cada comando, sin contar el login.
+
+    Si se pasa un controller.Pool, las sesiones se toman prestadas del pool
+    en lugar de hacer login y logout en cada controladora y cada llamada;
+    las credenciales y la verificación de certificados son entonces las del pool.
+    """
+    if config is None:
+        config = Config()
+    commands = tuple(dict.fromkeys(commands))
+    limit = asyncio.Semaphore(concurrency)
+    results: asyncio.Queue = asyncio.Queue()
+    async with common.async_transport(verify=verify, limit=0) as http:
+        tasks = [
+            asyncio.ensure_future(_show_host(http, limit, config, item, commands, per_host, verify, timeout, results, pool))
+            for item in inventory
+        ]
+        try:
+            for _ in range(len(tasks) * len(commands)):
+                yield await results.get()
+        finally:
+            # Si se deja de iterar antes de terminar, cancelo lo pendiente
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# ------------------------
+# Instantáneas de objetos de configuración
+# ------------------------
+
+# Campos que identifican una entrada de /configuration/object, en orden de preferencia
+IDENTITY = ("ap_name", "mac", "name", "profile-name")
+
+
+def _digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _canonical(entry: Any) -> bytes:
+    # Con el json de la stdlib, para que el hash no dependa del backend de aruba.codec
+    return json.dumps(entry, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def identity(entry: Mapping[str, Any]) -> Hashable:
+    """Clave por defecto de una entrada: el primero de los campos IDENTITY que tenga.
+
+    Si no tiene ninguno, la propia entrada es su clave (y por tanto, cualquier
+    cambio en ella se verá como una entrada eliminada y otra añadida).
+    """
+    for field in IDENTITY:
+        value = entry.get(field, None)
+        if value is not None:
+            return value
+    return _digest(_canonical(entry))
+
+
+class Diff(namedtuple('Diff', ('object', 'config_path', 'added', 'removed', 'modified'))):
+
+    """Cambios en un objeto entre dos lecturas. added, removed y modified son dicts clave -> entrada.
+
+    Es falso si no hay cambios, para poder hacer 'if diff: ...'
+    """
+
+    __slots__ = ()
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.modified)
+
+
+class Snapshots(object):
+
+    """Última lectura de cada objeto de /configuration/object, por (objeto, config-path).
+
+    Cada poll descarga el objeto y devuelve sólo lo que ha cambiado desde
+    la lectura anterior. Si la respuesta es idéntica byte a byte, ni
+    siquiera se decodifica el JSON. Si no, se compara entrada a entrada
+    por el hash de su contenido, usando 'key' para identificarlas:
+
+    >>> snapshots = controller.Snapshots()
+    >>> while True:
+    >>>     diff = await snapshots.apoll(session, "ap_prov", "/md")
+    >>>     if diff:
+    >>>         print(len(diff.added), len(diff.removed), len(diff.modified))
+    >>>     await asyncio.sleep(60)
+
+    La primera lectura de un objeto devuelve todas sus entradas en 'added'.
+    Las entradas de una misma lectura con la misma clave se identifican por
+    el hash de su contenido, como las que no tienen ningún campo IDENTITY.
+    """
+
+    def __init__(self, key: Callable[[Mapping[str, Any]], Hashable] = identity) -> None:
+        self._key = key
+        # Hash de la última respuesta completa, por (objeto, config-path)
+        self._raw: Dict[Tuple[str, str], bytes] = dict()
+        # Entradas de la última respuesta: clave -> (hash, entrada)
+        self._entries: Dict[Tuple[str, str], Dict[Hashable, Tuple[bytes, Any]]] = dict()
+
+    def update(self, url: str, object: str, config_path: str, raw: bytes) -> Diff:
+        """Compara la respuesta recibida con la anterior, y la guarda como la última"""
+        index = (object, config_path)
+        digest = _digest(raw)
+        if self._raw.get(index, None) == digest:
+            return Diff(object, config_path, dict(), dict(), dict())
+        data = codec.loads(raw)
+        entries = data.get("_data", dict()).get(object, None)
+        if entries is None:
+            raise FormatError(url, None, { "config-path": config_path }, data, object)
+        if isinstance(entries, dict):
+            entries = (entries,)
+        previous = self._entries.get(index, dict())
+        current: Dict[Hashable, Tuple[bytes, Any]] = dict()
+        added: Dict[Hashable, Any] = dict()
+        modified: Dict[Hashable, Any] = dict()
+        keyed = [(self._key(entry), _digest(_canonical(entry)), entry) for entry in entries]
+        counts: Dict[Hashable, int] = dict()
+        for key, _, _ in keyed:
+            counts[key] = counts.get(key, 0) + 1
+        for key, entry_digest, entry in keyed:
+            # Si varias entradas comparten clave, cada una se identifica por su contenido
+            if counts[key] > 1:
+                key = entry_digest
+            current[key] = (entry_digest, entry)
+            old = previous.get(key, None)
+            if old is None:
+                added[key] = entry
+            elif old[0] != entry_digest:
+                modified[key] = entry
+        removed = { key: old[1] for key, old in previous.items() if key not in current }
+        self._raw[index] = digest
+        self._entries[index] = current
+        return Diff(object, config_path, added, removed, modified)
+
+    def poll(self, session: Session, object: str, config_path: str) -> Diff:
+        """Lee el objeto con una sesión síncrona, y devuelve los cambios"""
+        path = "/object/{}".format(object)
+        response = session.get(path, params={ "config-path": config_path })
+        if response.status_code != 200:
+            raise RequestError(session.api_url + path, None, { "config-path": config_path }, response)
+        return self.update(session.api_url + path, object, config_path, response.content)
+
+    async def apoll(self, session: AsyncSession, object: str, config_path: str) -> Diff:
+        """Lee el objeto con una sesión asíncrona, y devuelve los cambios"""
+        path = "/object/{}".format(object)
+        async with session.get(path, params={ "config-path": config_path }) as response:
+            if response.status != 200:
+                raise RequestError(session.api_url + path, None, { "config-path": config_path },
+                    response, await response.text())
+            raw = await response.read()
+        return self.update(session.api_url + path, object, config_path, raw)
+
+    def entries(self, object: str, config_path: str) -> Dict[Hashable, Any]:
+        """Entradas de la última lectura del objeto, por clave"""
+        return { key: entry for key, (_, entry) in self._entries.get((object, config_path), dict()).items() }
+
+    def forget(self, object: str, config_path: str) -> None:
+        """Descarta la última lectura, el siguiente poll devolverá todo como añadido"""
+        self._raw.pop((object, config_path), None)
+        self._entries.pop((object, config_path), None)
 
 
 if __name__ == "__main__":
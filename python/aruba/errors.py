@@ -4,7 +4,7 @@
 import json
 
 from requests import Response
-from typing import Any, Optional, Mapping
+from typing import Any, Optional, Mapping, cast
 
 Headers = Optional[Mapping[str, str]]
 
@@ -12,12 +12,18 @@ class RequestError(Exception):
 
     """ Error que se genera cuando hay un fallo accediendo al servidor"""
 
-    def __init__(self, url: str, headers: Headers, body: Any, response: Response) -> None:
+    def __init__(self, url: str, headers: Headers, body: Any, response: Any, text: Optional[str] = None) -> None:
         self.url = url
         self.headers = headers
         self.body = body
-        self.status_code = response.status_code
-        self.text = response.text
+        # Las respuestas de aiohttp usan "status", y su texto hay que leerlo
+        # con await antes de crear el error, así que se recibe aparte.
+        if isinstance(response, Response):
+            self.status_code = response.status_code
+            self.text = response.text if text is None else text
+        else:
+            self.status_code = response.status
+            self.text = cast(str, text)
         self.response = response
         super().__init__(self.message())
 
@@ -27,14 +33,36 @@ class RequestError(Exception):
 
 class FormatError(Exception):
 
-    """Error que se genera cuando la respuesta recibida del servidor no tiene el formato correcto"""
-    def __init__(self, url: str, headers: Headers, body: Any, json: str, key: str) -> None:
+    """Error que se genera cuando la respuesta recibida del servidor no tiene el formato correcto.
+
+    El mensaje (con el cuerpo completo de la respuesta) sólo se formatea
+    cuando se muestra, no al crear el error: muchas veces se captura y se
+    descarta sin llegar a imprimirse.
+    """
+    def __init__(self, url: str, headers: Headers, body: Any, json: Any, key: str) -> None:
         self.url = url
         self.headers = headers
         self.body = body
         self.json = json
         self.key = key
+        super().__init__(url, key)
+
+    def __str__(self) -> str:
+        return self.message()
+
+    def message(self) -> str:
+        return "missing key: {}, body: {}".format(self.key, json.dumps(self.json, indent=4, default=str))
+
+
+class CommandError(Exception):
+
+    """Error que se genera cuando el dispositivo rechaza un comando (show, CLI...)"""
+    def __init__(self, url: str, command: str, status: Any, text: str) -> None:
+        self.url = url
+        self.command = command
+        self.status = status
+        self.text = text
         super().__init__(self.message())
 
     def message(self) -> str:
-        return "missing key: {}, body: {}".format(self.key, json.dumps(self.json, indent=4))
+        return "command '{}' failed, status {}: {}".format(self.command, self.status, self.text)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import aiohttp
+
+from collections import namedtuple
+from typing import Any, AsyncContextManager, AsyncIterator, Awaitable, Callable, Iterable, Mapping, Optional, Union
+
+from aruba.common import Config, Settings
+from aruba import common, switch
+
+# Resultado de la operación en un switch: host, valor devuelto, y excepción si ha fallado
+Result = namedtuple('Result', ('host', 'value', 'error'))
+
+# Operación a ejecutar en cada switch, recibe la sesión ya autenticada
+Operation = Callable[[switch.AsyncSession], Awaitable[Any]]
+
+# Cada elemento del inventario es un nombre de host, o un diccionario con
+# api_host y, opcionalmente, username, password y api_version propios.
+Inventory = Iterable[Union[str, Mapping[str, Any]]]
+
+# Número de switches que se procesan a la vez, por defecto
+CONCURRENCY = 32
+
+
+async def _run_one(http: aiohttp.ClientSession, limit: asyncio.Semaphore, config: Settings,
+    item: Union[str, Mapping[str, Any]], operation: Operation, verify: bool, timeout: Optional[float],
+    pool: Optional[switch.Pool]) -> Result:
+    """Autentica en un switch, ejecuta la operación y cierra la sesión, capturando cualquier error"""
+    data = common.inventory_item(item)
+    host = data.get("api_host", None)
+    params = { key: data.get(key, None) for key in ("api_version", "username", "password") }
+    async with limit:
+        try:
+            if pool is not None:
+                context: AsyncContextManager[switch.AsyncSession] = pool.session(host, **params)
+            else:
+                context = switch.async_session(config, api_host=host, verify=verify, http=http, **params)
+            async with context as session:
+                if timeout is None:
+                    value = await operation(session)
+                else:
+                    value = await asyncio.wait_for(operation(session), timeout)
+            return Result(host, value, None)
+        except Exception as err:
+            return Result(host, None, err)
+
+
+async def run(inventory: Inventory, operation: Operation, concurrency: int = CONCURRENCY,
+    config: Optional[Settings] = None, verify: bool = True, timeout: Optional[float] = None,
+    pool: Optional[switch.Pool] = None) -> AsyncIterator[Result]:
+    """Ejecuta una operación en todos los switches del inventario, en paralelo.
+
+    Como mucho hay 'concurrency' switches con sesión abierta a la vez. En cada
+    switch se hace login, se llama a operation(session), y se hace logout
+    aunque la operación falle. Los resultados se devuelven según terminan:
+
+    >>> async def vlans(session):
+    >>>     async with session.get("/vlans") as response:
+    >>>         return await response.json()
+    >>>
+    >>> async for result in fleet.run(("sw1", "sw2"), vlans, concurrency=10):
+    >>>     print(result.host, result.error or result.value)
+
+    Los valores que no aparezcan en el inventario (usuario, password, versión
+    de API) se toman de la sección "switch" de la config. 'timeout' limita
+    la duración de la operación en cada switch, sin contar login y logout.
+
+    Si se pasa un switch.Pool, las sesiones se toman prestadas del pool en
+    lugar de hacer login y logout en cada switch; las credenciales y la
+    verificación de certificados son entonces las del pool.
+    """
+    if config is None:
+        config = Config()
+    limit = asyncio.Semaphore(concurrency)
+    # La concurrencia la limita el semáforo, no el pool de conexiones
+    async with common.async_transport(verify=verify, limit=0) as http:
+        tasks = [
+            asyncio.ensure_future(_run_one(http, limit, config, item, operation, verify, timeout, pool))
+            for item in inventory
+        ]
+        try:
+            for done in asyncio.as_completed(tasks):
+                yield await done
+        finally:
+            # Si se deja de iterar antes de terminar, cancelo lo pendiente
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
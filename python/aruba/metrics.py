@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import bisect
+import logging
+import threading
+
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+
+# Límites (en segundos) de los buckets de los histogramas de latencia
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Etiquetas de una métrica, ordenadas para usarlas como clave
+Labels = Tuple[Tuple[str, str], ...]
+
+# Función que recibe cada observación: hook(nombre, etiquetas, valor)
+Hook = Callable[[str, Mapping[str, str], float], None]
+
+# Segmentos de ruta que son identificadores (MACs, IDs de sesión, puertos...)
+_VARIABLE = re.compile(r"\d")
+
+
+def _labels(labels: Mapping[str, str]) -> Labels:
+    return tuple(sorted((key, str(val)) for key, val in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = labels + ((extra,) if extra is not None else ())
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, _escape(val)) for key, val in pairs) + "}"
+
+
+def endpoint(path: str) -> str:
+    """Normaliza la ruta de una petición para usarla como etiqueta.
+
+    Los segmentos que contienen dígitos (MACs, IDs, números de puerto...)
+    se sustituyen por {id}, para no crear una serie por cada valor, p.ej.
+    /session/1234/disconnect -> /session/{id}/disconnect
+    """
+    path = path.split("?", 1)[0]
+    return "/".join("{id}" if _VARIABLE.search(part) else part for part in path.split("/"))
+
+
+class Histogram(object):
+
+    """Histograma acumulativo, al estilo de Prometheus"""
+
+    def __init__(self, buckets: Sequence[float] = BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimación del cuantil q (0..1), como el límite del bucket donde cae"""
+        if self.count == 0:
+            return 0.0
+        target, acc = q * self.count, 0
+        for index, count in enumerate(self.counts):
+            acc += count
+            if acc >= target:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class Registry(object):
+
+    """Almacén de métricas (contadores, gauges e histogramas) con etiquetas.
+
+    Cada observación se pasa además a los hooks registrados con add_hook,
+    para poder enviarlas a otros sistemas de monitorización. Los errores de
+    los hooks se registran en el log, sin propagarse a quien observa.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[Labels, float]] = dict()
+        self._gauges: Dict[str, Dict[Labels, float]] = dict()
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = dict()
+        self._hooks: List[Hook] = list()
+
+    def add_hook(self, hook: Hook) -> None:
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook: Hook) -> None:
+        self._hooks.remove(hook)
+
+    def _notify(self, name: str, labels: Mapping[str, str], value: float) -> None:
+        # Un hook que falla no debe hacer fallar la petición o el mensaje que se mide
+        for hook in self._hooks:
+            try:
+                hook(name, labels, value)
+            except Exception:
+                logging.exception("Registry - error en hook para {}".format(name))
+
+    def inc(self, name: str, labels: Mapping[str, str], value: float = 1) -> None:
+        """Incrementa un contador"""
+        key = _labels(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, dict())
+            series[key] = series.get(key, 0) + value
+        self._notify(name, labels, value)
+
+    def set(self, name: str, labels: Mapping[str, str], value: float) -> None:
+        """Actualiza un gauge"""
+        with self._lock:
+            self._gauges.setdefault(name, dict())[_labels(labels)] = value
+        self._notify(name, labels, value)
+
+    def observe(self, name: str, labels: Mapping[str, str], value: float) -> None:
+        """Añade una observación a un histograma"""
+        key = _labels(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, dict())
+            histogram = series.get(key, None)
+            if histogram is None:
+                histogram = Histogram()
+                series[key] = histogram
+            histogram.observe(value)
+        self._notify(name, labels, value)
+
+    def histogram(self, name: str, labels: Mapping[str, str]) -> Optional[Histogram]:
+        return self._histograms.get(name, dict()).get(_labels(labels), None)
+
+    def prometheus(self) -> str:
+        """Vuelca todas las métricas en formato de texto de Prometheus"""
+        lines: List[str] = list()
+        with self._lock:
+            for kind, metrics in (("counter", self._counters), ("gauge", self._gauges)):
+                for name, series in sorted(metrics.items()):
+                    lines.append("# TYPE {} {}".format(name, kind))
+                    for labels, value in sorted(series.items()):
+                        lines.append("{}{} {}".format(name, _format(labels), value))
+            for name, hseries in sorted(self._histograms.items()):
+                lines.append("# TYPE {} histogram".format(name))
+                for labels, histogram in sorted(hseries.items(), key=lambda item: item[0]):
+                    acc = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        acc += count
+                        lines.append("{}_bucket{} {}".format(name, _format(labels, ("le", str(bound))), acc))
+                    lines.append("{}_bucket{} {}".format(name, _format(labels, ("le", "+Inf")), histogram.count))
+                    lines.append("{}_sum{} {}".format(name, _format(labels), histogram.sum))
+                    lines.append("{}_count{} {}".format(name, _format(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Copia de todas las series, en un formato serializable como JSON (ver merge)"""
+        with self._lock:
+            return {
+                "counters": { name: [[list(labels), value] for labels, value in series.items()]
+                    for name, series in self._counters.items() },
+                "gauges": { name: [[list(labels), value] for labels, value in series.items()]
+                    for name, series in self._gauges.items() },
+                "histograms": { name: [[list(labels), { "buckets": list(h.buckets), "counts": list(h.counts),
+                    "sum": h.sum, "count": h.count }] for labels, h in series.items()]
+                    for name, series in self._histograms.items() },
+            }
+
+    def merge(self, snapshot: Mapping[str, Any]) -> None:
+        """Suma a este registro las series de un snapshot (p.ej. de otro proceso).
+
+        Los contadores, gauges e histogramas con las mismas etiquetas se suman.
+        No se avisa a los hooks.
+        """
+        with self._lock:
+            for kind, target in (("counters", self._counters), ("gauges", self._gauges)):
+                for name, items in snapshot.get(kind, dict()).items():
+                    series = target.setdefault(name, dict())
+                    for labels, value in items:
+                        key = tuple(tuple(pair) for pair in labels)
+                        series[key] = series.get(key, 0) + value
+            for name, items in snapshot.get("histograms", dict()).items():
+                hseries = self._histograms.setdefault(name, dict())
+                for labels, data in items:
+                    key = tuple(tuple(pair) for pair in labels)
+                    histogram = hseries.get(key, None)
+                    if histogram is None:
+                        histogram = Histogram(data["buckets"])
+                        hseries[key] = histogram
+                    histogram.counts = [a + b for a, b in zip(histogram.counts, data["counts"])]
+                    histogram.sum += data["sum"]
+                    histogram.count += data["count"]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+
+# Registro por defecto, donde publican sus métricas las sesiones y aruba.nats
+REGISTRY = Registry()
+
+
+def request(device: str, method: str, path: str, status: int, seconds: float) -> None:
+    """Registra una petición a la API de un dispositivo"""
+    labels = { "device": device, "method": method, "endpoint": endpoint(path) }
+    REGISTRY.observe("aruba_http_request_seconds", labels, seconds)
+    labels["status"] = str(status)
+    REGISTRY.inc("aruba_http_requests_total", labels)
+
+
+def auth(device: str, seconds: float, ok: bool) -> None:
+    """Registra un login (o renovación de credenciales) contra un dispositivo"""
+    REGISTRY.observe("aruba_auth_seconds", { "device": device }, seconds)
+    REGISTRY.inc("aruba_auth_total", { "device": device, "result": "ok" if ok else "error" })
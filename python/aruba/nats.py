@@ -1,18 +1,113 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import sys
+import time
+import shutil
+import signal
 import logging
+import tempfile
+import threading
 import traceback
+import multiprocessing
 import asyncio
 import aiohttp
 
-from concurrent.futures import TimeoutError
+from aiohttp import web
 from contextlib import AsyncExitStack
-from typing import Dict, Callable, Optional, Awaitable, ContextManager, AsyncContextManager
+from types import ModuleType
+from typing import Dict, Callable, Optional, Awaitable, ContextManager, AsyncContextManager, Union, Hashable, Any, TypeVar
 from nats.aio.client import Client as NATS, Msg # type: ignore
-from aruba.common import Session
+from aruba.common import Session, AsyncSession, TTLCache
+from aruba import codec, metrics, trace
+
+# The callback may return bytes, None, or any other object, which is encoded with aruba.codec
+AsyncCallback = Callable[[str, bytes], Awaitable[Any]]
+RefreshCallback = Callable[[], Any]
+KeyCallback = Callable[[str, bytes], Optional[Hashable]]
+SetupCallback = Callable[["App"], Awaitable[None]]
+
+T = TypeVar("T")
+
+# Overflow policies, applied when the backlog of a topic is full
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+REPLY_BUSY = "reply_busy"
+
+
+class Limits(object):
+
+    """Flow control settings for a topic suscription.
+
+    - queue: NATS queue group. Workers in the same group share the messages.
+    - maxInFlight: number of messages processed concurrently.
+    - maxPending: messages waiting for a free worker, before overflow.
+      Messages that an idle worker is about to take do not count.
+    - pendingMsgsLimit, pendingBytesLimit: limits of the NATS client buffer
+      for the suscription. Beyond them, the client drops messages.
+    - overflow: what to do with a new message when the backlog is full:
+        BLOCK waits for room (and lets the client buffer grow),
+        DROP_OLDEST discards the oldest message waiting in the backlog
+          (answering it with 'busyReply', if it expects a reply),
+        REPLY_BUSY answers the new message with 'busyReply' right away.
+    """
+
+    def __init__(self, queue: str = "workers", maxInFlight: int = 16, maxPending: int = 64,
+        pendingMsgsLimit: int = 65536, pendingBytesLimit: int = 64 * 1024 * 1024,
+        overflow: str = BLOCK, busyReply: bytes = b"busy") -> None:
+        if overflow not in (BLOCK, DROP_OLDEST, REPLY_BUSY):
+            raise ValueError("Unknown overflow policy {}".format(overflow))
+        self.queue = queue
+        self.maxInFlight = maxInFlight
+        self.maxPending = maxPending
+        self.pendingMsgsLimit = pendingMsgsLimit
+        self.pendingBytesLimit = pendingBytesLimit
+        self.overflow = overflow
+        self.busyReply = busyReply
+
+
+class Coalesce(object):
+
+    """Single-flight settings for a topic suscription.
+
+    Messages with the same key(topic, msgBytes) that arrive while the callback
+    is already running for that key do not call it again: they wait for the
+    running call and get its reply. If key returns None, the message is
+    processed on its own. By default the key is the message payload.
+
+    If ttl > 0, successful replies are also kept for 'ttl' seconds (at most
+    'maxsize' keys), and returned right away to later messages with the
+    same key. Failures are never kept.
+    """
+
+    def __init__(self, key: Optional[KeyCallback] = None, ttl: float = 0, maxsize: int = 4096) -> None:
+        self.key: KeyCallback = key if key is not None else (lambda topic, msg: msg)
+        self.ttl = ttl
+        self.maxsize = maxsize
 
-AsyncCallback = Callable[[str, bytes], Awaitable[Optional[bytes]]]
+
+class TopicStats(object):
+
+    """Message counters for a topic suscription"""
+
+    def __init__(self) -> None:
+        self.received = 0
+        self.processed = 0
+        self.inFlight = 0
+        self.pending = 0
+        # Times the BLOCK policy had to wait for room in the backlog
+        self.blocked = 0
+        # Messages discarded by DROP_OLDEST
+        self.dropped = 0
+        # Messages answered with busyReply by REPLY_BUSY
+        self.rejected = 0
+        # Messages that shared the reply of a running call, or got a cached one (see Coalesce)
+        self.coalesced = 0
+        self.cached = 0
+
+    def asdict(self) -> Dict[str, int]:
+        return dict(self.__dict__)
 
 
 class Suscription(object):
@@ -23,16 +118,92 @@ class Suscription(object):
     See https://nats.io/documentation/
     """
 
-    def __init__(self, natsConn: NATS, loop: asyncio.AbstractEventLoop) -> None:
-        """Manage suscriptions to topics in the provided connection"""
-        self.natsConn = natsConn
-        self.loop = loop
+    def __init__(self, natsConn: NATS) -> None:
+        """Manage suscriptions to topics in the provided connection.
 
-    async def _sink(self, topic: str, cancelQueue: asyncio.Queue, asyncCallback: AsyncCallback) -> None:
-        async def handler(msg: bytes):
-            logging.debug("Suscription - Received message on {}".format(topic))
-            await self._onMessage(self.natsConn, topic, msg, asyncCallback)
-        sid = await self.natsConn.subscribe(topic, "workers", cb=handler)
+        Tasks are started in the running loop, so it must be used from
+        coroutines running in the same loop as the connection.
+        """
+        self.natsConn = natsConn
+        self.stats: Dict[str, TopicStats] = dict()
+
+    async def _sink(self, topic: str, cancelQueue: asyncio.Queue, asyncCallback: AsyncCallback,
+        limits: Limits, stats: TopicStats, ready: asyncio.Future) -> None:
+        # Messages wait in the backlog until one of the workers is free. The
+        # first ones are for the idle workers, which may not have had the
+        # chance to take them yet (e.g. in a burst), so they do not count
+        # against maxPending.
+        backlog: asyncio.Queue = asyncio.Queue()
+        # Set when a worker finishes a message, for BLOCK
+        room = asyncio.Event()
+        labels = { "topic": topic }
+        def full() -> bool:
+            return backlog.qsize() >= limits.maxPending + limits.maxInFlight - stats.inFlight
+        def gauges() -> None:
+            stats.pending = backlog.qsize()
+            metrics.REGISTRY.set("aruba_nats_pending", labels, stats.pending)
+            metrics.REGISTRY.set("aruba_nats_in_flight", labels, stats.inFlight)
+        async def worker() -> None:
+            trace.detach()
+            while True:
+                queued, msg = await backlog.get()
+                start = time.perf_counter()
+                metrics.REGISTRY.observe("aruba_nats_queue_seconds", labels, start - queued)
+                stats.inFlight += 1
+                gauges()
+                ok = False
+                try:
+                    # Each message is the root of a trace, with the API calls it triggers as children
+                    with trace.span("nats", topic=topic, queue_ms=(start - queued) * 1000):
+                        ok = await self._onMessage(self.natsConn, topic, msg, asyncCallback)
+                except Exception:
+                    # E.g. the reply could not be published. The worker goes on with the next message
+                    logging.exception("Suscription - error replying on {}".format(topic))
+                finally:
+                    stats.inFlight -= 1
+                    stats.processed += 1
+                    backlog.task_done()
+                    room.set()
+                    gauges()
+                    metrics.REGISTRY.observe("aruba_nats_handler_seconds", labels, time.perf_counter() - start)
+                    metrics.REGISTRY.inc("aruba_nats_messages_total", { "topic": topic, "result": "ok" if ok else "error" })
+        async def handler(msg: Msg):
+            logging.debug("Suscription - Received message on %s", topic)
+            stats.received += 1
+            if full():
+                metrics.REGISTRY.inc("aruba_nats_overflow_total", { "topic": topic, "policy": limits.overflow })
+                if limits.overflow == REPLY_BUSY or (limits.overflow == DROP_OLDEST and backlog.empty()):
+                    stats.rejected += 1
+                    if msg.reply:
+                        await self.natsConn.publish(msg.reply, limits.busyReply)
+                    return
+                if limits.overflow == DROP_OLDEST:
+                    stats.dropped += 1
+                    _, oldest = backlog.get_nowait()
+                    backlog.task_done()
+                    # Whoever sent it is waiting for a reply, do not let it time out
+                    if oldest.reply:
+                        await self.natsConn.publish(oldest.reply, limits.busyReply)
+                else:
+                    stats.blocked += 1
+                    while full():
+                        room.clear()
+                        await room.wait()
+            backlog.put_nowait((time.perf_counter(), msg))
+            gauges()
+        workers = [asyncio.ensure_future(worker()) for _ in range(limits.maxInFlight)]
+        try:
+            sub = await self.natsConn.subscribe(topic, queue=limits.queue, cb=handler,
+                pending_msgs_limit=limits.pendingMsgsLimit, pending_bytes_limit=limits.pendingBytesLimit)
+            # Round trip to the server, so that it knows about the suscription when 'ready' is set
+            await self.natsConn.flush()
+        except Exception as err:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            ready.set_exception(err)
+            return
+        ready.set_result(None)
         try:
             logging.debug("Suscription - subscribed to {}".format(topic))
             # Wait until something is pushed to the queue (cancellation signal)
@@ -40,52 +211,126 @@ class Suscription(object):
             logging.debug("Suscription - Finished suscription to {}".format(topic))
             cancelQueue.task_done()
         finally:
-            await self.natsConn.unsubscribe(sid)
-
-    # Asynchronous task to be run on message arrival
-    async def _onMessage(self, natsConn: NATS, topic: str, natsMsg: Msg, asyncCallback: AsyncCallback) -> None:
+            await sub.unsubscribe()
+            # Messages in flight are cancelled, without a reply
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    # Asynchronous task to be run on message arrival. Returns False if the callback failed.
+    async def _onMessage(self, natsConn: NATS, topic: str, natsMsg: Msg, asyncCallback: AsyncCallback) -> bool:
         reply: Optional[bytes] = None
+        ok = True
+        span = trace.current()
+        if span is not None:
+            span.capture("request", natsMsg.data)
         try:
-            logging.debug("Suscription::task - Received message on {}".format(topic))
-            reply = await asyncCallback(topic, natsMsg.data)
-        except:
+            logging.debug("Suscription::task - Received message on %s", topic)
+            result = await asyncCallback(topic, natsMsg.data)
+            # Replies that are not bytes are encoded as JSON
+            reply = result if result is None or isinstance(result, (bytes, bytearray)) else codec.dumps(result)
+        except Exception:
+            ok = False
             reply = traceback.format_exc().encode('utf-8')
             logging.error("Suscription::task - error on {}: {}".format(topic, reply))
+        if span is not None:
+            if not ok:
+                span.fail(reply.decode('utf-8').strip().splitlines()[-1])
+            span.capture("reply", reply)
         if natsMsg.reply:
             if reply is None:
                 reply = "".encode('utf-8')
             await natsConn.publish(natsMsg.reply, reply)
-
-    def topic(self, topic: str, asyncCallback: AsyncCallback) -> AsyncContextManager[None]:
+        return ok
+
+    def _coalesce(self, topic: str, asyncCallback: AsyncCallback, coalesce: Coalesce, stats: TopicStats) -> AsyncCallback:
+        """Wraps the callback so that messages with the same key share a single call"""
+        running: Dict[Hashable, asyncio.Future] = dict()
+        replies = TTLCache(coalesce.ttl, coalesce.maxsize) if coalesce.ttl > 0 else None
+        missing = object()
+        async def call(key: Hashable, topic: str, msg: bytes) -> Any:
+            reply = await asyncCallback(topic, msg)
+            if replies is not None:
+                replies.set(key, reply)
+            return reply
+        async def callback(topic: str, msg: bytes) -> Any:
+            key = coalesce.key(topic, msg)
+            if key is None:
+                return await asyncCallback(topic, msg)
+            if replies is not None:
+                reply = replies.get(key, missing)
+                if reply is not missing:
+                    stats.cached += 1
+                    metrics.REGISTRY.inc("aruba_nats_coalesced_total", { "topic": topic, "source": "cache" })
+                    return reply
+            pending = running.get(key, None)
+            if pending is None:
+                pending = asyncio.ensure_future(call(key, topic, msg))
+                running[key] = pending
+                pending.add_done_callback(lambda _: running.pop(key, None))
+            else:
+                stats.coalesced += 1
+                metrics.REGISTRY.inc("aruba_nats_coalesced_total", { "topic": topic, "source": "running" })
+            # shield: if this message is cancelled, the others keep waiting for the call
+            return await asyncio.shield(pending)
+        return callback
+
+    def topic(self, topic: str, asyncCallback: AsyncCallback, limits: Optional[Limits] = None,
+        coalesce: Optional[Coalesce] = None) -> AsyncContextManager[None]:
         """Process all messages in the topic.
         Each message triggers a call to the asyncCallback func, asyncCallback(topic, msgBytes)
-        This functions returns a cancellation closure, e.g.
-        >>> cancel = new Suscription(url, topic, False)(loop, callback)
-        >>> # ... do your stuff while messages are received
-        >>> await cancel()
+        This function returns an async context manager that keeps the suscription, e.g.
+        >>> async with suscr.topic(topic, callback):
+        >>>     # ... do your stuff while messages are received
+
+        Flow control is configured with 'limits', and the message counters
+        of the topic are kept in self.stats[topic]. If 'coalesce' is given,
+        identical concurrent messages share a single call (see Coalesce).
+
+        Entering the context returns once the NATS server has the suscription,
+        so messages published after that are not missed.
         """
-        queue: asyncio.Queue = asyncio.Queue(1, loop=self.loop)
+        queue: asyncio.Queue = asyncio.Queue(1)
+        limits = limits if limits is not None else Limits()
+        stats = TopicStats()
+        self.stats[topic] = stats
+        if coalesce is not None:
+            asyncCallback = self._coalesce(topic, asyncCallback, coalesce, stats)
         suscr = self
         class _topic(AsyncContextManager[None]):
+            sink: Optional[asyncio.Future] = None
             async def __aenter__(self) -> None:
-                suscr.loop.create_task(suscr._sink(topic, queue, asyncCallback))
+                ready = asyncio.get_running_loop().create_future()
+                self.sink = asyncio.ensure_future(suscr._sink(topic, queue, asyncCallback, limits, stats, ready))
+                await ready
             async def __aexit__(self, exc_type, exc, tb) -> None:
                 await queue.put(False)
+                # Wait for the unsubscription, the connection may be closed right after
+                if self.sink is not None:
+                    await self.sink
         return _topic()
 
-    def refresh(self, syncRefreshFunc: Callable[[], None], timeout: float) -> AsyncContextManager[None]:
-        """Keeps calling the refresh function in the background, every 'timeout' seconds"""
-        queue: asyncio.Queue = asyncio.Queue(1, loop=self.loop)
-        suscr = self
+    def refresh(self, refreshFunc: RefreshCallback, timeout: float) -> AsyncContextManager[None]:
+        """Keeps calling the refresh function in the background, every 'timeout' seconds.
+
+        refreshFunc may be a coroutine function, which is awaited, or a plain function,
+        which is run in the default executor so that it does not block the loop.
+        """
+        queue: asyncio.Queue = asyncio.Queue(1)
         class _refresh(AsyncContextManager[None]):
             async def refresh(self) -> None:
+                trace.detach()
                 while True:
                     try:
-                        await asyncio.wait_for(queue.get(), timeout=timeout, loop=suscr.loop)
-                    except TimeoutError:
-                        syncRefreshFunc()
+                        await asyncio.wait_for(queue.get(), timeout=timeout)
+                        return
+                    except asyncio.TimeoutError:
+                        if asyncio.iscoroutinefunction(refreshFunc):
+                            await refreshFunc()
+                        else:
+                            await asyncio.get_running_loop().run_in_executor(None, refreshFunc)
             async def __aenter__(self) -> None:
-                suscr.loop.create_task(self.refresh())
+                asyncio.ensure_future(self.refresh())
             async def __aexit__(self, exc_type, exc, tb) -> None:
                 await queue.put(False)
         return _refresh()
@@ -93,15 +338,15 @@ class Suscription(object):
 
 class suscription(AsyncContextManager[Suscription]):
 
-    def __init__(self, natsURL: str, loop: asyncio.AbstractEventLoop) -> None:
+    def __init__(self, natsURL: str) -> None:
         self.natsURL = natsURL
-        self.loop = loop
         self.natsConn = NATS()
 
     async def __aenter__(self) -> Suscription:
-        await self.natsConn.connect(self.natsURL, loop=self.loop)
+        # The connection runs in the loop it is opened from
+        await self.natsConn.connect(self.natsURL)
         logging.debug("Suscription - Connected to NATS server")
-        return Suscription(self.natsConn, self.loop)
+        return Suscription(self.natsConn)
 
     async def __aexit__(self, exc_type, exc, tb) -> None:
         await self.natsConn.close()
@@ -115,52 +360,103 @@ class App(object):
     NATS topics and trigger actions on the session.
     """
 
-    def __init__(self, natsURL: str, contextCallback: Callable[[], ContextManager],
-        verify: bool = True, loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+    def __init__(self, natsURL: str, contextCallback: Callable[[], Union[ContextManager, AsyncContextManager]],
+        verify: bool = True, refresh: Optional[float] = None, metricsPort: Optional[int] = None,
+        metricsHost: str = "0.0.0.0") -> None:
         """Build an app connected to the given NATS server.
 
         contextCallback must be a function that takes no arguments and returns a
-        contextmanager, e.g:
+        contextmanager or an async contextmanager, e.g:
 
         Works:
+        >>> app = App(myURL, lambda: clearpass.async_session(config))
         >>> app = App(myURL, lambda: clearpass.session(config))
 
+        Async sessions are preferred, since synchronous ones block the
+        event loop while they authenticate.
+
         Does not work:
         >>> app = App(myURL, clearpass.session(config))
+
+        Sessions renew their credentials on their own when the server
+        rejects them. If 'refresh' is given, they are also refreshed in
+        the background every 'refresh' seconds.
+
+        If 'metricsPort' is given, the app serves the contents of
+        aruba.metrics.REGISTRY in Prometheus text format at
+        http://metricsHost:metricsPort/metrics
+
+        The app does not touch the event loop until it is started, so it
+        can be built anywhere. It runs in the loop it is started from; the
+        simplest way to run it is run(app.serve(setup)), see serve().
         """
         self._natsURL = natsURL
         self._context = contextCallback
         self._verify = verify
+        self._refresh = refresh
+        self._metricsPort = metricsPort
+        self._metricsHost = metricsHost
         self._stop: Optional[Callable[[], Awaitable[None]]] = None
         self._topics: Dict[str, Callable[[], Awaitable]] = dict()
-        self.loop = loop if loop is not None else asyncio.get_event_loop()
-        self.prodSession: Optional[Session] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.prodSession: Optional[Union[Session, AsyncSession]] = None
         self.httpSession: Optional[aiohttp.ClientSession] = None
         self.natsSession: Optional[Suscription] = None
 
     async def start(self) -> None:
         "Start the app. This is not reentrant, can only be started once."
         logging.debug("Iniciando proceso principal")
+        self.loop = asyncio.get_running_loop()
         async with AsyncExitStack() as stack:
-            prodSession = stack.enter_context(self._context())
+            context = self._context()
+            if hasattr(context, "__aenter__"):
+                prodSession = await stack.enter_async_context(context)
+            else:
+                prodSession = stack.enter_context(context)
             logging.debug("Iniciado contexto de aplicación")
-            httpSession = await stack.enter_async_context(aiohttp.ClientSession(connector=aiohttp.TCPConnector(verify_ssl=self._verify)))
+            ssl: Dict[str, Any] = {} if self._verify else { "ssl": False }
+            httpSession = await stack.enter_async_context(aiohttp.ClientSession(connector=aiohttp.TCPConnector(**ssl)))
             logging.debug("Iniciado pool HTTP")
-            natsSession = await stack.enter_async_context(suscription(self._natsURL, self.loop))
+            natsSession = await stack.enter_async_context(suscription(self._natsURL))
             logging.debug("Lanzada conexion a NATS URL")
             self.prodSession = prodSession
             self.httpSession = httpSession
             self.natsSession = natsSession
-            # If session supports refresh, refresh it.
-            if hasattr(prodSession, "refresh"):
-                await stack.enter_async_context(natsSession.refresh(prodSession.refresh, 7200))
+            # If session supports refresh and periodic refresh was requested, refresh it.
+            if self._refresh is not None and hasattr(prodSession, "refresh"):
+                await stack.enter_async_context(natsSession.refresh(prodSession.refresh, self._refresh))
                 logging.debug("Lanzado proceso de refresco de sesion")
+            if self._metricsPort is not None:
+                await self._serveMetrics(stack)
+                logging.debug("Publicando métricas en puerto {}".format(self._metricsPort))
             self._stop = stack.pop_all().aclose
             self._topics = dict()
 
-    async def subscribe(self, topic: str, asyncCallback: AsyncCallback) -> None:
+    async def _serveMetrics(self, stack: AsyncExitStack) -> None:
+        async def handler(request: web.Request) -> web.Response:
+            return web.Response(text=metrics.REGISTRY.prometheus(), content_type="text/plain")
+        server = web.Application()
+        server.router.add_get("/metrics", handler)
+        runner = web.AppRunner(server)
+        await runner.setup()
+        stack.push_async_callback(runner.cleanup)
+        await web.TCPSite(runner, self._metricsHost, self._metricsPort).start()
+
+    async def subscribe(self, topic: str, asyncCallback: AsyncCallback, limits: Optional[Limits] = None,
+        coalesce: Optional[Coalesce] = None) -> None:
         """Subscribe a topic. asyncCallback will be called with topic name, and message.
 
+        'limits' controls the queue group, concurrency, buffering and overflow
+        policy of the suscription (see Limits). Counters are available with
+        app.stats(topic).
+
+        'coalesce' enables single-flight: messages with the same key that
+        arrive while a call for that key is running share its reply, and the
+        reply may be kept for a short ttl (see Coalesce). E.g. if the reply
+        does not depend on the payload:
+
+        >>> app.subscribe("topic", myCallback, coalesce=Coalesce(key=lambda topic, msg: topic, ttl=2))
+
         Caution: asyncCallback must be an asyncfunction, not a lambda. E.g. this doesn't work:
 
         >>> app.subscribe("topic", (lambda topic, msg: doStuff()))
@@ -174,10 +470,16 @@ class App(object):
         if self.natsSession is None:
             raise ValueError("Must start before subscribe")
         async with AsyncExitStack() as stack:
-            await stack.enter_async_context(self.natsSession.topic(topic, asyncCallback))
+            await stack.enter_async_context(self.natsSession.topic(topic, asyncCallback, limits, coalesce))
             logging.debug("Suscrito a tópico {}, esperando mensajes...".format(topic))
             self._topics[topic] = stack.pop_all().aclose
 
+    def stats(self, topic: str) -> Optional[TopicStats]:
+        "Message counters for the topic, if subscribed"
+        if self.natsSession is None:
+            return None
+        return self.natsSession.stats.get(topic, None)
+
     async def stop(self) -> None:
         "Stop the nat connection and all subscritions. Call with await"
         for closeFunc in self._topics.values():
@@ -194,5 +496,267 @@ class App(object):
             await closeFunc()
             del self._topics[topic]
 
+    async def serve(self, setup: Optional[SetupCallback] = None) -> None:
+        """Start the app, call setup(app), and process messages until cancelled.
+
+        'setup' is where topics are subscribed. The app is stopped when
+        the coroutine is cancelled. It is meant to be run with run(), which
+        cancels it on SIGINT / SIGTERM:
+
+        >>> async def setup(app):
+        >>>     await app.subscribe("topic", myCallback)
+        >>> run(App(myURL, lambda: clearpass.async_session(config)).serve(setup), uvloop=True)
+        """
+        await self.start()
+        try:
+            if setup is not None:
+                await setup(self)
+            # Nothing ever completes this future, it is only cancelled
+            await asyncio.get_running_loop().create_future()
+        finally:
+            await self.stop()
+
     def forever(self) -> None:
+        """Run the loop the app was started from, forever. Prefer run(app.serve(setup))"""
+        if self.loop is None:
+            raise ValueError("Must start before forever")
         self.loop.run_forever()
+
+
+def _uvloop() -> Optional[ModuleType]:
+    """The uvloop module, if installed"""
+    try:
+        import uvloop # type: ignore
+        return uvloop
+    except ImportError:
+        logging.warning("uvloop is not installed (pip install uvloop), using the default event loop")
+        return None
+
+
+async def _main(main: Awaitable[T]) -> Optional[T]:
+    """Awaits main, cancelling it on SIGINT / SIGTERM"""
+    task = asyncio.ensure_future(main)
+    loop = asyncio.get_running_loop()
+    handled = list()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, task.cancel)
+            handled.append(sig)
+        except (NotImplementedError, RuntimeError):
+            # Windows, or not in the main thread: Ctrl+C raises KeyboardInterrupt instead
+            pass
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            raise
+        logging.info("Stopped by signal")
+        return None
+    finally:
+        for sig in handled:
+            loop.remove_signal_handler(sig)
+
+
+def run(main: Awaitable[T], uvloop: bool = False) -> Optional[T]:
+    """asyncio.run-style entry point for NATS services.
+
+    Runs 'main' (usually app.serve(setup)) in a new event loop, until it
+    finishes or a SIGINT / SIGTERM cancels it, and closes the loop. Returns
+    the result of 'main', or None if it was cancelled by a signal.
+
+    With uvloop=True the loop is uvloop's, if it is installed, which cuts
+    the overhead of every socket read and write (see benchmark.loops).
+    """
+    module = _uvloop() if uvloop else None
+    if sys.version_info >= (3, 11):
+        factory = module.new_event_loop if module is not None else None
+        with asyncio.Runner(loop_factory=factory) as runner:
+            return runner.run(_main(main))
+    # Before 3.11 there is no loop_factory, the loop comes from the policy
+    if module is not None:
+        asyncio.set_event_loop_policy(module.EventLoopPolicy())
+    return asyncio.run(_main(main))
+
+
+# Function run in each worker process, receives the worker number (0..processes-1)
+Worker = Callable[[int], None]
+
+
+def _dumpMetrics(path: str, interval: float) -> None:
+    """Writes the metrics of this process to 'path' every 'interval' seconds"""
+    temp = "{}.tmp".format(path)
+    while True:
+        with open(temp, "wb") as f:
+            f.write(codec.dumps(metrics.REGISTRY.snapshot()))
+        os.replace(temp, path)
+        time.sleep(interval)
+
+
+def _child(worker: Worker, index: int, metricsPath: str, interval: float) -> None:
+    """Entry point of each worker process"""
+    threading.Thread(target=_dumpMetrics, args=(metricsPath, interval), daemon=True).start()
+    worker(index)
+
+
+class Supervisor(object):
+
+    """Runs several copies of a NATS worker (e.g. an App) in separate processes.
+
+    'worker' is called in each process with the worker number. It usually
+    builds an App and runs it with run(app.serve(setup)); all of them
+    subscribe with the same queue group (see Limits), so NATS spreads the
+    messages among them, and the service uses every core of the node.
+
+    Processes are started with 'spawn', so 'worker' must be picklable: a
+    module-level function, or a functools.partial of one.
+
+    Workers that exit with an error are started again, waiting 'restartDelay'
+    seconds (doubled on each crash in a row, up to 'maxDelay'). Workers that
+    exit cleanly are not restarted, and the supervisor finishes when none
+    is left.
+
+    Each worker dumps its aruba.metrics.REGISTRY to a file every 'interval'
+    seconds. If 'metricsPort' is given, the supervisor serves the sum of all
+    of them at http://metricsHost:metricsPort/metrics, so workers must not
+    serve their own metrics. When a worker exits, the counters and histograms
+    of its last dump are kept and added to those of the next ones, so the
+    totals never go down on a restart (counts after that last dump are lost).
+
+    To share device tokens among workers, so that N workers do not log in
+    N times, use clearpass.SharedTokenCache in their sessions. E.g:
+
+    >>> def worker(index):
+    >>>     tokens = clearpass.SharedTokenCache()
+    >>>     app = App(url, lambda: clearpass.async_session(config, tokens=tokens))
+    >>>     run(app.serve(setup))
+    >>> Supervisor(worker, processes=4, metricsPort=9100).run()
+    """
+
+    def __init__(self, worker: Worker, processes: Optional[int] = None,
+        restartDelay: float = 1.0, maxDelay: float = 30.0, interval: float = 5.0,
+        metricsPort: Optional[int] = None, metricsHost: str = "0.0.0.0") -> None:
+        self.worker = worker
+        self.processes = processes if processes is not None else (os.cpu_count() or 1)
+        self.restartDelay = restartDelay
+        self.maxDelay = maxDelay
+        self.interval = interval
+        self.metricsPort = metricsPort
+        self.metricsHost = metricsHost
+        self.restarts = 0
+        self._context = multiprocessing.get_context("spawn")
+        self._children: Dict[int, multiprocessing.process.BaseProcess] = dict()
+        self._metricsDir = ""
+        # Counters and histograms of the workers that have already exited
+        self._retired = metrics.Registry()
+        self._stopping = False
+
+    def _path(self, index: int) -> str:
+        return os.path.join(self._metricsDir, "worker-{}.json".format(index))
+
+    def _start(self, index: int) -> None:
+        process = self._context.Process(target=_child, name="worker-{}".format(index),
+            args=(self.worker, index, self._path(index), self.interval))
+        process.start()
+        self._children[index] = process
+        logging.info("Supervisor - started worker {} (pid {})".format(index, process.pid))
+
+    def _load(self, index: int) -> Optional[Dict[str, Any]]:
+        """Last metrics dumped by worker 'index', if any"""
+        try:
+            with open(self._path(index), "rb") as f:
+                return codec.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _retire(self, index: int) -> None:
+        """Keeps the counters and histograms of worker 'index', that has just exited.
+
+        Gauges are dropped: they describe a process that is gone. The dump
+        is removed, so it is not counted again while the next one starts.
+        """
+        snapshot = self._load(index)
+        if snapshot is None:
+            return
+        snapshot.pop("gauges", None)
+        self._retired.merge(snapshot)
+        os.remove(self._path(index))
+
+    def metrics(self) -> metrics.Registry:
+        """Metrics of the supervisor and the workers that exited, plus the last ones dumped by each running worker"""
+        total = metrics.Registry()
+        total.merge(metrics.REGISTRY.snapshot())
+        total.merge(self._retired.snapshot())
+        for index in range(self.processes):
+            snapshot = self._load(index)
+            if snapshot is not None:
+                total.merge(snapshot)
+        return total
+
+    async def _serveMetrics(self, stack: AsyncExitStack) -> None:
+        async def handler(request: web.Request) -> web.Response:
+            return web.Response(text=self.metrics().prometheus(), content_type="text/plain")
+        server = web.Application()
+        server.router.add_get("/metrics", handler)
+        runner = web.AppRunner(server)
+        await runner.setup()
+        stack.push_async_callback(runner.cleanup)
+        await web.TCPSite(runner, self.metricsHost, self.metricsPort).start()
+
+    async def _watch(self, index: int) -> None:
+        """Keeps worker 'index' running, restarting it when it crashes"""
+        delay = self.restartDelay
+        while not self._stopping:
+            started = time.monotonic()
+            self._start(index)
+            process = self._children[index]
+            while process.is_alive():
+                await asyncio.sleep(0.5)
+            self._retire(index)
+            if self._stopping:
+                return
+            if process.exitcode == 0:
+                logging.info("Supervisor - worker {} finished".format(index))
+                return
+            # A worker that ran for a while before crashing starts with the minimum delay again
+            if time.monotonic() - started > self.maxDelay:
+                delay = self.restartDelay
+            logging.error("Supervisor - worker {} exited with code {}, restarting in {} seconds".format(
+                index, process.exitcode, delay))
+            self.restarts += 1
+            metrics.REGISTRY.inc("aruba_supervisor_restarts_total", { "worker": str(index) })
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.maxDelay)
+
+    def _stop(self) -> None:
+        self._stopping = True
+        for process in self._children.values():
+            if process.is_alive():
+                process.terminate()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stop)
+            except (NotImplementedError, RuntimeError):
+                # Windows: Ctrl+C reaches the workers too, and they finish on their own
+                pass
+        metrics.REGISTRY.set("aruba_supervisor_workers", {}, self.processes)
+        async with AsyncExitStack() as stack:
+            self._metricsDir = tempfile.mkdtemp(prefix="aruba-metrics-")
+            stack.callback(shutil.rmtree, self._metricsDir, True)
+            if self.metricsPort is not None:
+                await self._serveMetrics(stack)
+                logging.debug("Supervisor - serving metrics on port {}".format(self.metricsPort))
+            try:
+                await asyncio.gather(*(self._watch(index) for index in range(self.processes)))
+            finally:
+                self._stop()
+                for process in self._children.values():
+                    process.join(10)
+                    if process.is_alive():
+                        process.kill()
+
+    def run(self) -> None:
+        """Starts the workers, and supervises them until they finish or a SIGINT / SIGTERM arrives"""
+        asyncio.run(self._run())
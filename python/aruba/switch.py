@@ -2,86 +2,635 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import time
+import base64
+import logging
+import asyncio
 import requests
+import aiohttp
 
 from contextlib import contextmanager
 from collections import namedtuple
-from typing import Optional, Dict, Iterator, cast
+from typing import Optional, Callable, Dict, Iterable, Iterator, AsyncIterator, AsyncContextManager, Mapping, Sequence, List, Set, Tuple, Union, Any, cast
 
-from aruba.errors import RequestError, FormatError
-from aruba.common import _ask_input, _ask_pass, _fill, Config, Settings
-from aruba import common
+from aruba.errors import RequestError, FormatError, CommandError
+from aruba.common import _ask_input, _ask_pass, _fill, Config, PoolStats, Settings
+from aruba import codec, common
 
 
 def _api_url(api_host: str, api_version: str) -> str:
     return "https://{}/rest/{}".format(api_host, api_version)
 
+
+def _credentials(username: str, password: str) -> Dict[str, str]:
+    return { "userName": username, "password": password }
+
+
+def _cookie(login_url: str, credentials: Mapping[str, str], data: Mapping[str, Any]) -> str:
+    """Extrae la cookie de la respuesta de login"""
+    cookie = data.get("cookie", None)
+    if not cookie:
+        raise FormatError(login_url, None, credentials, data, "cookie")
+    return cookie
+
+
+# Fichero donde se guardan las cookies de sesión, para reutilizarlas entre procesos
+COOKIES_FILE = "~/.aruba.cookies"
+COOKIES = common.FileStore(COOKIES_FILE)
+
+# Ruta que se consulta para comprobar si una cookie guardada sigue siendo válida
+STATUS_PATH = "/system/status"
+
+
+def _cookie_key(api_host: str, api_version: str, username: str) -> str:
+    return "{}|{}|{}".format(api_host, api_version, username)
+
 # ------------------------
 # Métodos de autenticación
 # ------------------------
 
 class Session(common.Session):
 
-    def __init__(self, api_host: str, api_version: str, username: str, password: str, verify: bool = True) -> None:
+    """Sesión con un switch.
+
+    Si se le pasa una caché de cookies ('cookies'), reutiliza la cookie que
+    haya guardado otro proceso, siempre que siga siendo válida, y guarda la
+    suya al hacer login. En ese caso no hace logout, para que la sesión
+    quede disponible para el siguiente proceso.
+    """
+
+    device = "switch"
+
+    def __init__(self, api_host: str, api_version: str, username: str, password: str, verify: bool = True,
+        http: Optional[requests.Session] = None, pool_size: int = common.POOL_SIZE,
+        cookies: Optional[common.FileStore] = None) -> None:
         self._api_host = api_host
         self._api_version = api_version
         self._username = username
         self._password = password
-        self._verify = verify
+        self._cookies = cookies
         api_url = _api_url(self._api_host, self._api_version)
-        cookie = self._login(api_url)
-        super().__init__(api_url, cookie, headers={'Cookie': cookie})
+        super().__init__(api_url, "", headers=dict(), verify=verify, http=http, pool_size=pool_size)
+        self._authenticate()
+
+    def _authenticate(self) -> None:
+        """Reutiliza la cookie guardada si sigue siendo válida, o hace login y la guarda"""
+        if self._cookies is None:
+            super()._authenticate()
+            return
+        key = _cookie_key(self._api_host, self._api_version, self._username)
+        cookie = self._cookies.get(key, None)
+        # Si la cookie guardada es la que acaba de caducar, no hace falta comprobarla
+        if cookie and cookie != self.secret and self._valid(cookie):
+            self._use(cookie)
+            return
+        super()._authenticate()
+        self._cookies.set(key, self.secret)
+
+    def _valid(self, cookie: str) -> bool:
+        """Comprueba si la cookie sigue siendo válida, con una consulta ligera"""
+        response = self.http.get(self.api_url + STATUS_PATH, verify=self._verify, headers={ "Cookie": cookie })
+        return response.status_code == 200
+
+    def _use(self, cookie: str) -> None:
+        headers = cast(Dict[str, str], self._headers)
+        headers['Cookie'] = cookie
+        self.secret = cookie
 
     def _login(self, api_url: str) -> str:
         """Lanza un intento de autenticación contra un switch, devuelve la cookie"""
         login_url = api_url + "/login-sessions"
-        credentials = { "userName": self._username, "password": self._password }
-        response = requests.post(login_url, verify=self._verify, json=credentials)
+        credentials = _credentials(self._username, self._password)
+        response = self.http.post(login_url, verify=self._verify, json=credentials)
         if response.status_code != 201:
             raise RequestError(login_url, None, credentials, response)
         # No error, accedo a los tokens
-        data = response.json()
-        cookie = data.get("cookie", None)
-        if not cookie:
-            raise FormatError(login_url, None, credentials, data, "cookie")
-        return cookie
+        return _cookie(login_url, credentials, codec.load(response))
 
     def _logout(self) -> None:
-        """Cierra una sesion REST contra un switch"""
+        """Cierra una sesion REST contra un switch, salvo que se guarde para reutilizarla"""
+        if self._cookies is not None:
+            return
         logout_url = self.api_url + "/login-sessions"
-        response = requests.delete(logout_url, verify=self._verify, headers=self._headers)
+        response = self.http.delete(logout_url, verify=self._verify, headers=self._headers)
         if response.status_code != 204:
             raise RequestError(logout_url, self._headers, None, response)
 
     def refresh(self) -> None:
-        cookie = self._login(self.api_url)
+        self._use(self._login(self.api_url))
+
+
+class AsyncSession(common.AsyncSession):
+
+    """Versión asíncrona de Session, para usar con async with"""
+
+    device = "switch"
+
+    def __init__(self, api_host: str, api_version: str, username: str, password: str, verify: bool = True,
+        http: Optional[aiohttp.ClientSession] = None, pool_size: int = common.POOL_SIZE,
+        cookies: Optional[common.FileStore] = None) -> None:
+        self._api_host = api_host
+        self._api_version = api_version
+        self._username = username
+        self._password = password
+        self._cookies = cookies
+        api_url = _api_url(self._api_host, self._api_version)
+        super().__init__(api_url, headers=dict(), verify=verify, http=http, pool_size=pool_size)
+
+    @property
+    def api_host(self) -> str:
+        """Switch (host o host:puerto) al que se conecta la sesión"""
+        return self._api_host
+
+    async def _authenticate(self) -> None:
+        """Reutiliza la cookie guardada si sigue siendo válida, o hace login y la guarda"""
+        if self._cookies is None:
+            await super()._authenticate()
+            return
+        # El fichero se bloquea entre procesos, así que no lo leo desde el bucle
+        loop = asyncio.get_running_loop()
+        key = _cookie_key(self._api_host, self._api_version, self._username)
+        cookie = await loop.run_in_executor(None, self._cookies.get, key, None)
+        if cookie and cookie != self.secret and await self._valid(cookie):
+            self._use(cookie)
+            return
+        await super()._authenticate()
+        await loop.run_in_executor(None, self._cookies.set, key, self.secret)
+
+    async def _valid(self, cookie: str) -> bool:
+        """Comprueba si la cookie sigue siendo válida, con una consulta ligera"""
+        async with self.http.get(self.api_url + STATUS_PATH, headers={ "Cookie": cookie }, **self._ssl) as response:
+            return response.status == 200
+
+    def _use(self, cookie: str) -> None:
         headers = cast(Dict[str, str], self._headers)
         headers['Cookie'] = cookie
         self.secret = cookie
 
+    async def _login(self) -> str:
+        """Lanza un intento de autenticación contra un switch, devuelve la cookie"""
+        login_url = self.api_url + "/login-sessions"
+        credentials = _credentials(self._username, self._password)
+        async with self.http.post(login_url, json=credentials, **self._ssl) as response:
+            if response.status != 201:
+                raise RequestError(login_url, None, credentials, response, await response.text())
+            data = await codec.aload(response)
+        return _cookie(login_url, credentials, data)
 
-@contextmanager
-def session(config: Settings, api_host: Optional[str] = None, api_version: Optional[str] = None,
-    username: Optional[str] = None, password: Optional[str] = None, verify: bool = True) -> Iterator[Session]:
-    """Obtiene una cookie para un switch"""
-    # Cargo de la config valores por defecto para todos los parámetros
+    async def _logout(self) -> None:
+        """Cierra una sesion REST contra un switch, salvo que se guarde para reutilizarla"""
+        if self._cookies is not None:
+            return
+        logout_url = self.api_url + "/login-sessions"
+        async with self.http.delete(logout_url, headers=self._headers, **self._ssl) as response:
+            if response.status != 204:
+                raise RequestError(logout_url, self._headers, None, response, await response.text())
+
+    async def refresh(self) -> None:
+        self._use(await self._login())
+
+
+Params = namedtuple('Params', ('api_host', 'username', 'password', 'api_version'))
+
+
+def _settings(config: Settings, api_host: Optional[str], api_version: Optional[str],
+    username: Optional[str], password: Optional[str]) -> Params:
+    """Completa los parámetros de conexión con los valores por defecto de la config"""
     data = _fill({
         "api_host": api_host,
         "username": username,
         "password": password,
         "api_version": api_version,
     }, config.get("switch"))
-    # Saco las variables del array, por comodidad
-    Params = namedtuple('Params', ('api_host', 'username', 'password', 'api_version'))
-    asserted = Params(
-        data["api_host"], data["username"], data["password"], data["api_version"]
-    )
+    return Params(data["api_host"], data["username"], data["password"], data["api_version"])
+
+
+@contextmanager
+def session(config: Settings, api_host: Optional[str] = None, api_version: Optional[str] = None,
+    username: Optional[str] = None, password: Optional[str] = None, verify: bool = True,
+    http: Optional[requests.Session] = None, pool_size: int = common.POOL_SIZE,
+    persist: bool = False) -> Iterator[Session]:
+    """Obtiene una cookie para un switch.
+
+    Con persist=True, la cookie se guarda en COOKIES_FILE y se reutiliza en
+    las siguientes llamadas (de este u otros procesos) mientras sea válida,
+    sin hacer login ni logout.
+    """
+    asserted = _settings(config, api_host, api_version, username, password)
     # Lanzo la autenticacion que corresponda
-    curr = Session(asserted.api_host, asserted.api_version, asserted.username, asserted.password, verify)
+    curr = Session(asserted.api_host, asserted.api_version, asserted.username, asserted.password, verify,
+        http=http, pool_size=pool_size, cookies=COOKIES if persist else None)
     try:
         yield curr
     finally:
-        curr._logout()
+        try:
+            curr._logout()
+        finally:
+            curr.close()
+
+
+def async_session(config: Settings, api_host: Optional[str] = None, api_version: Optional[str] = None,
+    username: Optional[str] = None, password: Optional[str] = None, verify: bool = True,
+    http: Optional[aiohttp.ClientSession] = None, pool_size: int = common.POOL_SIZE,
+    persist: bool = False) -> AsyncSession:
+    """Prepara una sesión asíncrona con un switch. La cookie se obtiene al entrar en async with.
+
+    'persist' funciona igual que en session().
+    """
+    asserted = _settings(config, api_host, api_version, username, password)
+    return AsyncSession(asserted.api_host, asserted.api_version, asserted.username, asserted.password, verify,
+        http=http, pool_size=pool_size, cookies=COOKIES if persist else None)
+
+
+# ------------------------
+# Pool de sesiones
+# ------------------------
+
+# Sesiones (cookies) que se mantienen abiertas con cada switch, por defecto
+POOL_MEMBERS = 2
+
+# Segundos sin usarse tras los que se comprueba una sesión antes de entregarla
+POOL_IDLE = 60
+
+
+class Pool(common.SessionPool):
+
+    """Sesiones autenticadas con muchos switches, compartidas entre corrutinas.
+
+    Mantiene como mucho 'size' sesiones (cookies) abiertas con cada switch,
+    y las presta a quien las pide. Si están todas ocupadas, las llamadas
+    esperan su turno en orden de llegada:
+
+    >>> async with switch.Pool(Config(), size=2, verify=False) as pool:
+    >>>     async with pool.session("sw1") as session:
+    >>>         async with session.get("/vlans") as response:
+    >>>             print(await response.json())
+
+    Cada switch tiene sus propias sesiones para cada juego de credenciales
+    (usuario, password y versión de la API), y sólo se prestan a quien las
+    pide con esas mismas credenciales.
+
+    Las sesiones que llevan más de 'idle' segundos sin usarse se comprueban
+    antes de entregarlas, y se renuevan si han caducado; las que caducan
+    mientras se usan se renuevan solas, como cualquier AsyncSession. Al
+    cerrar el pool se hace logout de todas ellas: de las libres en ese
+    momento, y de las que están en uso cuando se devuelvan.
+    """
+
+    device = AsyncSession.device
+
+    def __init__(self, config: Optional[Settings] = None, size: int = POOL_MEMBERS, verify: bool = True,
+        http: Optional[aiohttp.ClientSession] = None, idle: float = POOL_IDLE) -> None:
+        super().__init__(config, size, verify, http, idle)
+
+    def _open(self, params: Params) -> AsyncSession:
+        return AsyncSession(params.api_host, params.api_version, params.username, params.password,
+            self._verify, http=self._transport())
+
+    async def _valid(self, member: common.AsyncSession) -> bool:
+        return await cast(AsyncSession, member)._valid(member.secret)
+
+    def session(self, api_host: Optional[str] = None, api_version: Optional[str] = None,
+        username: Optional[str] = None, password: Optional[str] = None) -> AsyncContextManager[AsyncSession]:
+        """Presta una sesión con el switch, esperando turno si están todas ocupadas.
+
+        Los parámetros que falten se toman de la sección "switch" de la config.
+        """
+        params = _settings(self._config, api_host, api_version, username, password)
+        return cast(AsyncContextManager[AsyncSession], self._borrow(params))
+
+
+# ------------------------
+# Índice de MACs
+# ------------------------
+
+# Puerto donde se ha visto una MAC: switch (api_host), puerto y VLAN
+Location = namedtuple('Location', ('switch', 'port', 'vlan'))
+
+# Función que recibe cada cambio del índice: hook(mac, ubicaciones anteriores, ubicaciones nuevas)
+MacHook = Callable[[str, Tuple[Location, ...], Tuple[Location, ...]], None]
+
+# Número de switches que se consultan a la vez, por defecto
+MAC_CONCURRENCY = 32
+
+class MacIndex(object):
+
+    """Índice de MACs a los puertos de switch donde se han aprendido.
+
+    Consulta /mac-table en todos los switches del inventario, en paralelo,
+    con las sesiones de un Pool. Cada consulta actualiza sólo las MACs que
+    han cambiado en ese switch, y avisa de cada cambio a los hooks:
+
+    >>> async with switch.Pool(Config(), verify=False) as pool:
+    >>>     index = switch.MacIndex(("sw1", "sw2"), pool)
+    >>>     index.add_hook(lambda mac, before, after: print(mac, before, after))
+    >>>     await index.refresh()
+    >>>     print(index.lookup("00:62:6e:70:4f:1d"))
+
+    Los hooks se llaman cuando el índice ya está actualizado; si uno falla,
+    se registra en el log y se sigue con los demás.
+
+    Las búsquedas no hacen ninguna petición, son un acceso a un diccionario.
+    Una MAC puede aparecer en varios switches (por ejemplo, en los uplinks).
+    El inventario tiene el mismo formato que en aruba.fleet.
+    """
+
+    def __init__(self, inventory: Iterable[Union[str, Mapping[str, Any]]], pool: Pool,
+        concurrency: int = MAC_CONCURRENCY) -> None:
+        self._inventory = [common.inventory_item(item) for item in inventory]
+        self._pool = pool
+        self._concurrency = concurrency
+        self._hooks: List[MacHook] = list()
+        # MAC -> ubicaciones (como dict, para mantener el orden)
+        self._index: Dict[str, Dict[Location, None]] = dict()
+        # Última tabla leída de cada switch: MAC -> ubicaciones
+        self._tables: Dict[str, Dict[str, Set[Location]]] = dict()
+        # Último error al consultar cada switch, o None si la última consulta fue bien
+        self.errors: Dict[str, Optional[Exception]] = dict()
+
+    def add_hook(self, hook: MacHook) -> None:
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook: MacHook) -> None:
+        self._hooks.remove(hook)
+
+    def lookup(self, mac: str) -> Tuple[Location, ...]:
+        """Ubicaciones de la MAC, en cualquier formato (aa:bb:..., aabb.cc..., aabbcc-ddeeff...)"""
+        return tuple(self._index.get(common.normalize_mac(mac), ()))
+
+    def __contains__(self, mac: str) -> bool:
+        return common.normalize_mac(mac) in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def _update(self, host: str, entries: Iterable[Mapping[str, Any]]) -> None:
+        """Sustituye la tabla de un switch, tocando en el índice sólo las MACs que cambian"""
+        table: Dict[str, Set[Location]] = dict()
+        for entry in entries:
+            location = Location(host, str(entry.get("port_id", "")), entry.get("vlan_id", None))
+            table.setdefault(common.normalize_mac(entry.get("mac_address", "")), set()).add(location)
+        previous = self._tables.get(host, dict())
+        self._tables[host] = table
+        changes: List[Tuple[str, Tuple[Location, ...], Tuple[Location, ...]]] = list()
+        for mac in set(previous).union(table):
+            old, new = previous.get(mac, set()), table.get(mac, set())
+            if old == new:
+                continue
+            before = self.lookup(mac)
+            locations = self._index.setdefault(mac, dict())
+            for location in old - new:
+                locations.pop(location, None)
+            for location in new - old:
+                locations[location] = None
+            if not locations:
+                del self._index[mac]
+            changes.append((mac, before, self.lookup(mac)))
+        # Los hooks se llaman con el índice ya actualizado, y sus errores no son del switch
+        for mac, before, after in changes:
+            for hook in tuple(self._hooks):
+                try:
+                    hook(mac, before, after)
+                except Exception:
+                    logging.exception("MacIndex - error en hook para {}".format(mac))
+
+    async def _poll(self, limit: asyncio.Semaphore, item: Mapping[str, Any]) -> None:
+        host = item["api_host"]
+        async with limit:
+            try:
+                async with self._pool.session(host, item.get("api_version", None),
+                    item.get("username", None), item.get("password", None)) as session:
+                    async with session.get("/mac-table") as response:
+                        if response.status != 200:
+                            raise RequestError(session.api_url + "/mac-table", None, None,
+                                response, await response.text())
+                        data = await codec.aload(response)
+                self._update(host, data.get("mac_table_entry_element", ()))
+                self.errors[host] = None
+            except Exception as err:
+                # Si falla, conservo la última tabla leída del switch
+                self.errors[host] = err
+
+    async def refresh(self) -> Dict[str, Exception]:
+        """Consulta todos los switches una vez. Devuelve los errores, por switch"""
+        limit = asyncio.Semaphore(self._concurrency)
+        await asyncio.gather(*(self._poll(limit, item) for item in self._inventory))
+        return { host: err for host, err in self.errors.items() if err is not None }
+
+    async def run(self, interval: float) -> None:
+        """Consulta todos los switches cada 'interval' segundos, hasta que se cancele"""
+        while True:
+            await self.refresh()
+            await asyncio.sleep(interval)
+
+
+# ------------------------
+# Gestión de PoE
+# ------------------------
+
+# Prioridades PoE de los puertos
+PPP_LOW = "PPP_LOW"
+PPP_HIGH = "PPP_HIGH"
+PPP_CRITICAL = "PPP_CRITICAL"
+
+# Cambio de PoE en un puerto: switch, puerto, estado deseado, si se ha aplicado
+# (False en dry_run), y excepción si ha fallado. Si falla el switch entero,
+# se devuelve un único cambio con port None.
+PoeChange = namedtuple('PoeChange', ('switch', 'port', 'enabled', 'applied', 'error'))
+
+# Filtro de puertos, recibe cada elemento de /poe/ports
+PortFilter = Callable[[Mapping[str, Any]], bool]
+
+# Peticiones PUT simultáneas contra un mismo switch, por defecto
+POE_PER_SWITCH = 4
+
+# Cambios de PoE por segundo en un mismo switch, por defecto
+POE_RATE = 10.0
+
+
+def _poe_selected(port: Mapping[str, Any], priority: Optional[str], ports: Optional[Set[str]],
+    where: Optional[PortFilter]) -> bool:
+    if priority is not None and port.get("poe_priority", None) != priority:
+        return False
+    if ports is not None and str(port.get("port_id", "")) not in ports:
+        return False
+    return where is None or where(port)
+
+
+async def poe(session: AsyncSession, enabled: bool, priority: Optional[str] = None,
+    ports: Optional[Iterable[str]] = None, where: Optional[PortFilter] = None,
+    per_switch: int = POE_PER_SWITCH, dry_run: bool = False, rate: Optional[float] = POE_RATE) -> List[PoeChange]:
+    """Activa o desactiva el PoE de los puertos seleccionados de un switch.
+
+    Los puertos se seleccionan por prioridad (PPP_LOW, PPP_HIGH, PPP_CRITICAL),
+    por lista de puertos, o con una función que recibe la entrada de /poe/ports;
+    si se indican varios criterios, el puerto tiene que cumplirlos todos. Los
+    puertos que ya están en el estado deseado no se tocan. El resto se
+    actualizan en paralelo, con como mucho 'per_switch' peticiones a la vez,
+    y empezando como mucho 'rate' por segundo (None para no limitarlas),
+    para no encender o apagar de golpe todos los equipos del switch.
+
+    Con dry_run=True no se cambia nada, sólo se devuelve lo que se cambiaría.
+    """
+    if priority is None and ports is None and where is None:
+        raise ValueError("Must select ports by priority, list or filter")
+    selected = set(str(port) for port in ports) if ports is not None else None
+    async with session.get("/poe/ports") as response:
+        if response.status != 200:
+            raise RequestError(session.api_url + "/poe/ports", None, None, response, await response.text())
+        data = await codec.aload(response)
+    pending = [
+        str(port["port_id"]) for port in data.get("port_poe", ())
+        if _poe_selected(port, priority, selected, where) and bool(port.get("is_poe_enabled", False)) != enabled
+    ]
+    if dry_run:
+        return [PoeChange(session.api_host, port, enabled, False, None) for port in pending]
+    limit = asyncio.Semaphore(per_switch)
+    # Instante en que puede empezar el siguiente cambio
+    slot = [time.monotonic()]
+    async def update(port: str) -> PoeChange:
+        path = "/ports/{}/poe".format(port)
+        body = { "port_id": port, "is_poe_enabled": enabled }
+        async with limit:
+            if rate is not None:
+                now = time.monotonic()
+                start = max(now, slot[0])
+                slot[0] = start + 1.0 / rate
+                if start > now:
+                    await asyncio.sleep(start - now)
+            try:
+                async with session.put(path, json=body) as response:
+                    if response.status != 200:
+                        raise RequestError(session.api_url + path, None, body, response, await response.text())
+                return PoeChange(session.api_host, port, enabled, True, None)
+            except Exception as err:
+                return PoeChange(session.api_host, port, enabled, False, err)
+    return list(await asyncio.gather(*(update(port) for port in pending)))
+
+
+async def poe_all(inventory: Iterable[Union[str, Mapping[str, Any]]], enabled: bool, pool: Pool,
+    priority: Optional[str] = None, ports: Optional[Iterable[str]] = None, where: Optional[PortFilter] = None,
+    concurrency: int = MAC_CONCURRENCY, per_switch: int = POE_PER_SWITCH,
+    dry_run: bool = False, rate: Optional[float] = POE_RATE) -> AsyncIterator[PoeChange]:
+    """Aplica poe() en todos los switches del inventario, en paralelo.
+
+    Las sesiones se toman del pool, y como mucho se procesan 'concurrency'
+    switches a la vez; 'per_switch' y 'rate' limitan cada switch como en
+    poe(). Los cambios se devuelven según termina cada switch, p.ej. para
+    apagar los puertos de baja prioridad de una sede entera:
+
+    >>> async with switch.Pool(Config(), verify=False) as pool:
+    >>>     async for change in switch.poe_all(switches, False, pool, priority=switch.PPP_LOW):
+    >>>         print(change.switch, change.port, change.error or "OK")
+    """
+    limit = asyncio.Semaphore(concurrency)
+    port_list = tuple(ports) if ports is not None else None
+    async def one(item: Union[str, Mapping[str, Any]]) -> List[PoeChange]:
+        data = common.inventory_item(item)
+        host = data["api_host"]
+        async with limit:
+            try:
+                async with pool.session(host, data.get("api_version", None),
+                    data.get("username", None), data.get("password", None)) as session:
+                    return await poe(session, enabled, priority, port_list, where, per_switch, dry_run, rate)
+            except Exception as err:
+                return [PoeChange(host, None, enabled, False, err)]
+    tasks = [asyncio.ensure_future(one(item)) for item in inventory]
+    try:
+        for done in asyncio.as_completed(tasks):
+            for change in await done:
+                yield change
+    finally:
+        # Si se deja de iterar antes de terminar, cancelo lo pendiente
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# ------------------------
+# Comandos CLI
+# ------------------------
+
+# Resultado de un comando CLI: switch, comando, salida (texto) y excepción si ha fallado
+CliResult = namedtuple('CliResult', ('switch', 'command', 'output', 'error'))
+
+# Estado con el que /cli indica que el comando se ha ejecutado bien
+CLI_SUCCESS = "CCS_SUCCESS"
+
+
+async def cli(session: AsyncSession, command: str, timeout: Optional[float] = None) -> str:
+    """Ejecuta un comando CLI en el switch (POST /cli) y devuelve su salida, ya decodificada"""
+    url, body = session.api_url + "/cli", { "cmd": command }
+    async def run() -> Mapping[str, Any]:
+        async with session.post("/cli", json=body) as response:
+            if response.status not in (200, 202):
+                raise RequestError(url, None, body, response, await response.text())
+            return await codec.aload(response)
+    data = await (run() if timeout is None else asyncio.wait_for(run(), timeout))
+    output = data.get("result_base64_encoded", None)
+    if output is None:
+        raise FormatError(url, None, body, cast(str, data), "result_base64_encoded")
+    text = base64.b64decode(output).decode("utf-8", errors="replace")
+    status = data.get("status", CLI_SUCCESS)
+    if status != CLI_SUCCESS:
+        raise CommandError(url, command, status, data.get("error_msg", None) or text)
+    return text
+
+
+async def cli_all(inventory: Iterable[Union[str, Mapping[str, Any]]],
+    commands: Union[Sequence[str], Mapping[str, Sequence[str]]], pool: Pool,
+    concurrency: int = MAC_CONCURRENCY, timeout: Optional[float] = None) -> AsyncIterator[CliResult]:
+    """Ejecuta una lista de comandos CLI en muchos switches a la vez.
+
+    'commands' es la lista de comandos para todos los switches, o un
+    diccionario api_host -> lista de comandos de ese switch (un solo
+    comando puede pasarse como str). En cada switch
+    los comandos se lanzan en orden, uno tras otro, con una sesión del pool;
+    como mucho se procesan 'concurrency' switches a la vez. Los resultados
+    se devuelven según llegan, y 'timeout' limita la duración de cada comando:
+
+    >>> async for result in switch.cli_all(switches, ("show version", "show system"), pool, timeout=10):
+    >>>     print(result.switch, result.command, result.error or result.output)
+
+    Si falla un comando, se sigue con el siguiente; si falla el login, se
+    devuelve el error en todos los comandos del switch.
+    """
+    limit = asyncio.Semaphore(concurrency)
+    results: asyncio.Queue = asyncio.Queue()
+    def pending(host: str) -> Sequence[str]:
+        todo = commands.get(host, ()) if isinstance(commands, Mapping) else commands
+        # Un solo comando como str, no como lista de caracteres
+        return (todo,) if isinstance(todo, str) else todo
+    async def one(item: Union[str, Mapping[str, Any]]) -> None:
+        data = common.inventory_item(item)
+        host = data["api_host"]
+        todo = list(pending(host))
+        async with limit:
+            try:
+                async with pool.session(host, data.get("api_version", None),
+                    data.get("username", None), data.get("password", None)) as session:
+                    while todo:
+                        command = todo[0]
+                        try:
+                            result = CliResult(host, command, await cli(session, command, timeout), None)
+                        except Exception as err:
+                            result = CliResult(host, command, None, err)
+                        todo.pop(0)
+                        results.put_nowait(result)
+            except Exception as err:
+                for command in todo:
+                    results.put_nowait(CliResult(host, command, None, err))
+    items = list(inventory)
+    total = sum(len(pending(common.inventory_item(item)["api_host"])) for item in items)
+    tasks = [asyncio.ensure_future(one(item)) for item in items]
+    try:
+        for _ in range(total):
+            yield await results.get()
+    finally:
+        # Si se deja de iterar antes de terminar, cancelo lo pendiente
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
 if __name__ == "__main__":
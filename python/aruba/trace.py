@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Trazas de cada mensaje NATS y de las peticiones a las APIs que provoca.
+#
+# Cada traza es un árbol de spans: el span raíz suele ser un mensaje NATS
+# (aruba.nats), y sus hijos las peticiones HTTP y los logins de las sesiones.
+# El span activo se guarda en un ContextVar, así que las tareas que se lanzan
+# desde un span (ensure_future, gather...) cuelgan de él automáticamente.
+#
+# Mientras no se llama a configure, span() no hace nada. Con un tracer
+# configurado, todos los spans registran tiempos y estado, pero los cuerpos
+# de mensajes y respuestas sólo se capturan en las trazas muestreadas
+# (una fracción 'sample' de ellas), y sólo entonces se leen o formatean.
+#
+# >>> trace.configure(trace.JsonLines("/tmp/aruba.trace"), sample=0.05)
+# >>> with trace.span("inventario", site="madrid") as span:
+# >>>     async with session.get("/vlans") as response:
+# >>>         ...
+
+import os
+import sys
+import time
+import atexit
+import random
+import threading
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, IO, Iterator, List, Optional, Union, cast
+
+from aruba import codec
+
+# Tamaño máximo (en caracteres) de cada cuerpo capturado
+MAX_PAYLOAD = 4096
+
+# Cuerpo capturado: bytes, texto, cualquier objeto JSON, o una función que
+# lo devuelve (para no calcularlo si la traza no está muestreada)
+Payload = Union[bytes, str, Any, Callable[[], Any]]
+
+
+def _id(size: int) -> str:
+    return os.urandom(size).hex()
+
+
+def _truncate(payload: Any) -> str:
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        text = bytes(payload[:MAX_PAYLOAD]).decode("utf-8", errors="replace")
+    elif isinstance(payload, str):
+        text = payload
+    else:
+        text = codec.dumps_text(payload)
+    return text[:MAX_PAYLOAD]
+
+
+class Span(object):
+
+    """Tramo de una traza: nombre, atributos, duración, estado y cuerpos capturados"""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "sampled", "attributes",
+        "payloads", "start", "duration", "status", "error", "_t0")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], sampled: bool, attributes: Dict[str, Any]) -> None:
+        self.trace_id = trace_id
+        self.span_id = _id(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.sampled = sampled
+        self.attributes = attributes
+        self.payloads: Dict[str, str] = dict()
+        self.start = time.time()
+        self.duration = 0.0
+        self.status = "ok"
+        self.error: Optional[str] = None
+        self._t0 = time.perf_counter()
+
+    def set(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def fail(self, error: Any) -> None:
+        """Marca el span como fallido"""
+        self.status = "error"
+        self.error = str(error)
+
+    def capture(self, key: str, payload: Payload) -> None:
+        """Guarda un cuerpo (petición, respuesta...), sólo si la traza está muestreada"""
+        if not self.sampled:
+            return
+        if callable(payload):
+            payload = payload()
+        if payload is not None:
+            self.payloads[key] = _truncate(payload)
+
+    def asdict(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = {
+            "trace": self.trace_id,
+            "span": self.span_id,
+            "parent": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": self.duration * 1000,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+        if self.error is not None:
+            data["error"] = self.error
+        if self.payloads:
+            data["payloads"] = self.payloads
+        return data
+
+
+# Destino de los spans terminados
+Exporter = Callable[[Span], None]
+
+
+class JsonLines(object):
+
+    """Exporta cada span terminado como una línea JSON, a un fichero o a un stream.
+
+    Las líneas se acumulan en memoria y las escribe un hilo aparte, en lotes:
+    cada 'interval' segundos, o antes si se juntan 'batch' líneas. Así el
+    bucle de eventos no espera a que se escriba cada span. close() (que se
+    llama también al salir del proceso) escribe las que queden pendientes.
+    """
+
+    def __init__(self, target: Union[str, IO[bytes]] = "-", interval: float = 1.0, batch: int = 1000) -> None:
+        self.interval = interval
+        self.batch = batch
+        self._lock = threading.Lock()
+        self._ready = threading.Condition()
+        self._pending: List[bytes] = list()
+        self._closed = False
+        self._owned = isinstance(target, str) and target != "-"
+        if self._owned:
+            self.stream: IO[bytes] = open(os.path.expanduser(cast(str, target)), "ab")
+        elif isinstance(target, str):
+            self.stream = sys.stdout.buffer
+        else:
+            self.stream = target
+        self._writer = threading.Thread(target=self._run, name="aruba-trace", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def __call__(self, span: Span) -> None:
+        line = codec.dumps(span.asdict()) + b"\n"
+        with self._ready:
+            self._pending.append(line)
+            if len(self._pending) >= self.batch:
+                self._ready.notify()
+
+    def _run(self) -> None:
+        closed = False
+        while not closed:
+            with self._ready:
+                if not self._closed and len(self._pending) < self.batch:
+                    self._ready.wait(self.interval)
+                closed = self._closed
+            self.flush()
+
+    def flush(self) -> None:
+        """Escribe las líneas pendientes"""
+        # _lock mantiene el orden de los lotes si se llama a la vez que el hilo
+        with self._lock:
+            with self._ready:
+                lines, self._pending = self._pending, list()
+            if lines:
+                self.stream.write(b"".join(lines))
+                self.stream.flush()
+
+    def close(self) -> None:
+        with self._ready:
+            if self._closed:
+                return
+            self._closed = True
+            self._ready.notify()
+        self._writer.join()
+        atexit.unregister(self.close)
+        if self._owned:
+            self.stream.close()
+
+
+class Tracer(object):
+
+    """Decide qué trazas se muestrean, y envía los spans terminados al exporter"""
+
+    def __init__(self, exporter: Exporter, sample: float = 0.01) -> None:
+        self.exporter = exporter
+        self.sample = sample
+
+    def sampled(self) -> bool:
+        return self.sample >= 1 or random.random() < self.sample
+
+    def export(self, span: Span) -> None:
+        self.exporter(span)
+
+
+# Tracer global. Mientras sea None, no se generan spans.
+TRACER: Optional[Tracer] = None
+
+_CURRENT: ContextVar[Optional[Span]] = ContextVar("aruba_span", default=None)
+
+
+def configure(exporter: Exporter, sample: float = 0.01) -> Tracer:
+    """Activa las trazas. 'sample' es la fracción de trazas en las que se capturan los cuerpos"""
+    global TRACER
+    TRACER = Tracer(exporter, sample)
+    return TRACER
+
+
+def disable() -> None:
+    """Desactiva las trazas"""
+    global TRACER
+    TRACER = None
+
+
+def current() -> Optional[Span]:
+    """Span activo en este contexto, si hay alguno"""
+    return _CURRENT.get()
+
+
+def detach() -> None:
+    """Desvincula la tarea actual del span activo.
+
+    Para llamarlo al principio de las tareas de fondo (refrescos, polls...)
+    que se lanzan desde un span pero no forman parte de su traza. Cada tarea
+    tiene su propia copia del contexto, así que no afecta a quien la lanzó.
+    """
+    _CURRENT.set(None)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+    """Abre un span, hijo del activo (o raíz de una traza nueva si no hay ninguno).
+
+    Devuelve None si las trazas no están activadas. Si el bloque lanza una
+    excepción, el span se marca como fallido.
+    """
+    tracer = TRACER
+    if tracer is None:
+        yield None
+        return
+    parent = _CURRENT.get()
+    if parent is None:
+        opened = Span(name, _id(16), None, tracer.sampled(), attributes)
+    else:
+        opened = Span(name, parent.trace_id, parent.span_id, parent.sampled, attributes)
+    token = _CURRENT.set(opened)
+    try:
+        yield opened
+    except BaseException as err:
+        opened.fail(repr(err))
+        raise
+    finally:
+        _CURRENT.reset(token)
+        opened.duration = time.perf_counter() - opened._t0
+        tracer.export(opened)
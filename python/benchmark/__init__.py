@@ -0,0 +1,12 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmarks de la libreria aruba contra servidores locales que simulan
+# los dispositivos, para poder medir rendimiento sin hardware real.
+#
+# Cada módulo se ejecuta de forma independiente, p.ej:
+#
+# python -m benchmark.transport
+# python -m benchmark.suite --latency 0.02
+# python -m benchmark.codec
+# python -m benchmark.loops
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Micro-benchmark de la codificación JSON, con mensajes parecidos a los reales:
+#
+# - Una página de /session de ClearPass (100 sesiones).
+# - La respuesta de /insight/endpoint/mac/{mac} de un endpoint.
+# - Un lote de 50 endpoints para nats-coa.
+#
+# Compara "antes" (json.dumps(...).encode() y json.loads(data.decode())) con
+# aruba.codec, que usa orjson si está instalado. Para medir aruba.codec con
+# el backend de la stdlib: ARUBA_CODEC=json python -m benchmark.codec
+#
+# Uso: python -m benchmark.codec [-n REPETICIONES]
+
+import json
+import time
+import argparse
+
+from typing import Any, Callable, Dict, List
+
+from aruba import codec
+from benchmark import mocks
+
+
+def session_page(count: int = 100) -> bytes:
+    """Página de /session, con los campos que devuelve ClearPass"""
+    items: List[Dict[str, Any]] = list()
+    for item in mocks._sessions(count):
+        item = dict(item)
+        item.update({
+            "acctsessionid": "{:016X}".format(int(item["id"]) * 7919),
+            "username": "user{}@corp.example.com".format(item["id"]),
+            "framedipaddress": "10.1.{}.{}".format(int(item["id"]) % 254, 1 + int(item["id"]) % 253),
+            "nasporttype": "Ethernet" if item["ssid"].startswith("__wired") else "Wireless-802.11",
+            "state": "active" if item["acctstoptime"] is None else "closed",
+            "acctinputoctets": int(item["id"]) * 1024,
+            "acctoutputoctets": int(item["id"]) * 4096,
+            "_links": { "self": { "href": "https://cppm.example.com/api/session/{}".format(item["id"]) } },
+        })
+        items.append(item)
+    return json.dumps({
+        "_embedded": { "items": items },
+        "_links": {
+            "self": { "href": "https://cppm.example.com/api/session?offset=0&limit={}".format(count) },
+            "next": { "href": "https://cppm.example.com/api/session?offset={}&limit={}".format(count, count) },
+        },
+    }).encode("utf-8")
+
+
+def insight() -> bytes:
+    """Respuesta de Insight para un endpoint"""
+    return json.dumps({
+        "mac": "0200000004d2",
+        "mac_vendor": "Axis Communications AB",
+        "hostname": "camara-parking-2",
+        "ip": "10.1.4.211",
+        "static_ip": False,
+        "device_category": "Camera",
+        "device_family": "Axis",
+        "device_name": "Axis P3245-LVE",
+        "conflict": False,
+        "fingerprint": {
+            "dhcp_option55": "1,3,6,12,15,28,42,43",
+            "dhcp_option60": "AXIS,Network Camera,P3245-LVE,10.5.1",
+            "http_user_agent": "AXIS/10.5.1",
+        },
+        "added_at": 1561975200,
+        "updated_at": 1562061600,
+        "owner": None,
+    }).encode("utf-8")
+
+
+def coa_batch(count: int = 50) -> bytes:
+    """Lote de endpoints para nats-coa"""
+    return json.dumps({
+        "host": "cppm.example.com",
+        "user": "coa",
+        "pass": "secret",
+        "threat": True,
+        "items": [{ "endpoint_mac": item["mac_address"], "nas_ip": item["nasipaddress"] } for item in mocks._sessions(count)],
+    }).encode("utf-8")
+
+
+def rate(count: int, func: Callable[[], Any]) -> float:
+    """Operaciones por segundo"""
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", type=int, default=2000, help="Repeticiones de cada operación")
+    args = parser.parse_args()
+    print("Backend de aruba.codec: {}".format(codec.BACKEND))
+    for name, data in (("session (100)", session_page()), ("insight", insight()), ("coa (50)", coa_batch())):
+        obj = json.loads(data.decode("utf-8"))
+        before = rate(args.count, lambda: json.loads(data.decode("utf-8")))
+        after = rate(args.count, lambda: codec.loads(data))
+        print("{:16s} loads  antes {:10.0f}/s   después {:10.0f}/s   x{:.1f}   ({} bytes)".format(name, before, after, after / before, len(data)))
+        before = rate(args.count, lambda: json.dumps(obj).encode("utf-8"))
+        after = rate(args.count, lambda: codec.dumps(obj))
+        print("{:16s} dumps  antes {:10.0f}/s   después {:10.0f}/s   x{:.1f}".format(name, before, after, after / before))
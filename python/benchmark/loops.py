@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Compara el bucle de eventos de asyncio con el de uvloop, en las mismas
+# pruebas de aruba.nats contra servidores simulados y sin latencia simulada
+# (para que pese el coste del bucle y no la espera):
+#
+# - Mensajes por segundo de una nats.App que responde con el mismo mensaje.
+# - Peticiones por segundo al handler de nats-what, servido por una nats.App.
+# - CoAs por segundo de nats-coa, en lotes.
+#
+# Los servidores simulados corren en el mismo bucle que los clientes, así
+# que las cifras incluyen los dos extremos. Los bucles se alternan durante
+# varias rondas y se queda el mejor resultado de cada uno, para que no
+# influya el orden. Si uvloop no está instalado (pip install uvloop), sólo
+# se mide asyncio.
+#
+# Uso: python -m benchmark.loops [--count N] [--concurrency N] [--rounds N]
+
+import time
+import argparse
+import contextlib
+import importlib.util
+
+from contextlib import AsyncExitStack
+from typing import Any, Dict
+
+from nats.aio.client import Client as NATS # type: ignore
+
+from aruba import nats
+from benchmark import mocks, natsd, suite
+
+# Desactivo el log de certificado autofirmado.
+import logging
+logging.captureWarnings(True)
+
+
+async def echo(natsURL: str, count: int, concurrency: int) -> float:
+    """Mensajes por segundo que responde una nats.App con un handler que no hace nada"""
+    async def handler(topic: str, msg: bytes) -> bytes:
+        return msg
+    async with AsyncExitStack() as stack:
+        app = nats.App(natsURL, contextlib.nullcontext)
+        await app.start()
+        stack.push_async_callback(app.stop)
+        await app.subscribe("bench.echo", handler)
+        client = NATS()
+        await client.connect(natsURL)
+        stack.push_async_callback(client.close)
+        async def ask() -> None:
+            await client.request("bench.echo", b"ping", timeout=30)
+        return await suite._gather(count, concurrency, ask)
+
+
+async def measure(args: argparse.Namespace) -> Dict[str, float]:
+    """Ejecuta las pruebas en el bucle actual. Devuelve operaciones por segundo de cada una"""
+    rates: Dict[str, float] = dict()
+    async with AsyncExitStack() as stack:
+        cpass = mocks.clearpass_app(0.0, sessions=args.sessions)
+        host = await stack.enter_async_context(mocks.serve(cpass))
+        natsURL, _ = await stack.enter_async_context(natsd.serve())
+        config: Dict[str, Any] = {
+            "clearpass": { "grant_type": "client_credentials", "api_host": host,
+                "client_id": "bench", "client_secret": "bench" },
+        }
+        rates["nats.App echo (msg/s)"] = await echo(natsURL, args.count, args.concurrency)
+        start = time.perf_counter()
+        samples = await suite.what_latency(natsURL, config, args.count // 10, args.concurrency)
+        rates["nats-what (req/s)"] = len(samples) / (time.perf_counter() - start)
+        rates["nats-coa lotes de {} (CoA/s)".format(args.batch)] = await suite.coa_throughput(
+            natsURL, config, cpass, args.count, args.batch)
+    return rates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", type=int, default=5000, help="Mensajes por prueba (la décima parte en nats-what)")
+    parser.add_argument("-c", "--concurrency", type=int, default=32, help="Peticiones simultáneas")
+    parser.add_argument("--batch", type=int, default=50, help="Endpoints por mensaje en la prueba de nats-coa")
+    parser.add_argument("--sessions", type=int, default=200, help="Sesiones RADIUS en el ClearPass simulado")
+    parser.add_argument("-r", "--rounds", type=int, default=3, help="Rondas por bucle (se queda la mejor)")
+    args = parser.parse_args()
+    loops = { "asyncio": False }
+    if importlib.util.find_spec("uvloop") is None:
+        print("uvloop no está instalado (pip install uvloop), sólo se mide asyncio")
+    else:
+        loops["uvloop"] = True
+    results: Dict[str, Dict[str, float]] = { loop: dict() for loop in loops }
+    for _ in range(args.rounds):
+        for loop, uvloop in loops.items():
+            for name, rate in (nats.run(measure(args), uvloop=uvloop) or dict()).items():
+                results[loop][name] = max(rate, results[loop].get(name, 0.0))
+    for name, rate in results["asyncio"].items():
+        line = "{:32s} asyncio {:10.1f}".format(name, rate)
+        if "uvloop" in results:
+            fast = results["uvloop"][name]
+            line += "   uvloop {:10.1f}   x{:.2f}".format(fast, fast / rate)
+        print(line)
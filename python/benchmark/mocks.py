@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Servidores HTTPS locales que simulan las APIs de switch, controladora
+# y ClearPass, con una latencia configurable en cada respuesta.
+
+import os
+import ssl
+import json
+import base64
+import time
+import random
+import asyncio
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from aiohttp import web
+from contextlib import contextmanager, asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Mapping, Optional
+
+_context: Optional[ssl.SSLContext] = None
+
+
+def context() -> ssl.SSLContext:
+    """Contexto TLS de servidor, con un certificado autofirmado generado al vuelo"""
+    global _context
+    if _context is None:
+        folder = tempfile.mkdtemp(prefix="aruba-bench-")
+        cert, key = os.path.join(folder, "cert.pem"), os.path.join(folder, "key.pem")
+        try:
+            subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+                "-keyout", key, "-out", cert, "-days", "1", "-subj", "/CN=localhost"],
+                check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            _context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            _context.load_cert_chain(cert, key)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+    return _context
+
+
+class Counters(object):
+
+    """Peticiones recibidas por un servidor simulado, por ruta"""
+
+    def __init__(self) -> None:
+        self.hits: Dict[str, int] = dict()
+
+    def hit(self, name: str) -> None:
+        self.hits[name] = self.hits.get(name, 0) + 1
+
+    def __getitem__(self, name: str) -> int:
+        return self.hits.get(name, 0)
+
+
+# Claves del estado que cada app simulada deja accesible a los tests
+COUNTERS = web.AppKey("counters", Counters)
+SESSIONS = web.AppKey("sessions", List[Dict[str, Any]])
+MACS = web.AppKey("macs", List[Dict[str, Any]])
+POE = web.AppKey("poe", Dict[str, Dict[str, Any]])
+
+
+def _delayed(latency: float, counters: Counters, name: str, handler: Callable) -> Callable:
+    """Añade la latencia simulada, y cuenta las peticiones a cada ruta"""
+    async def wrapper(request: web.Request) -> web.StreamResponse:
+        counters.hit(name)
+        # Leo el cuerpo antes de esperar, por si el cliente corta por timeout
+        await request.read()
+        if latency > 0:
+            await asyncio.sleep(latency)
+        return await handler(request)
+    return wrapper
+
+
+@asynccontextmanager
+async def serve(app: web.Application, port: int = 0) -> AsyncIterator[str]:
+    """Sirve la aplicación por HTTPS en localhost, devuelve host:puerto"""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        site = web.TCPSite(runner, "127.0.0.1", port, ssl_context=context())
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1] # type: ignore
+        yield "127.0.0.1:{}".format(port)
+    finally:
+        await runner.cleanup()
+
+
+def _json(data: Any, status: int = 200) -> web.Response:
+    return web.json_response(data, status=status)
+
+
+# ------------------------
+# Switch (ArubaOS-Switch)
+# ------------------------
+
+def switch_app(latency: float = 0.0, vlans: int = 16, macs: int = 48) -> web.Application:
+    """API REST /rest/v4 de un switch: login-sessions, system/status, vlans, mac-table, PoE y cli.
+
+    La tabla de MACs está en app[MACS] y el estado PoE de los puertos en
+    app[POE], y se pueden modificar entre consultas.
+    """
+    counters = Counters()
+    cookies: Dict[str, bool] = dict()
+    def authorized(request: web.Request) -> bool:
+        return request.headers.get("Cookie", "") in cookies
+    async def login(request: web.Request) -> web.Response:
+        await request.json()
+        cookie = "sessionId={}".format(random.getrandbits(64))
+        cookies[cookie] = True
+        return _json({ "uri": "/login-sessions", "cookie": cookie }, 201)
+    async def logout(request: web.Request) -> web.Response:
+        cookies.pop(request.headers.get("Cookie", ""), None)
+        return web.Response(status=204)
+    async def status(request: web.Request) -> web.Response:
+        if not authorized(request):
+            return _json({ "message": "Authentication failed" }, 401)
+        return _json({ "name": "bench", "serial_number": "SG00000000", "firmware_version": "WC.16.10.0000" })
+    async def mac_table(request: web.Request) -> web.Response:
+        if not authorized(request):
+            return _json({ "message": "Authentication failed" }, 401)
+        return _json({
+            "collection_result": { "total_elements_count": len(app[MACS]), "filtered_elements_count": len(app[MACS]) },
+            "mac_table_entry_element": app[MACS],
+        })
+    async def poe_ports(request: web.Request) -> web.Response:
+        if not authorized(request):
+            return _json({ "message": "Authentication failed" }, 401)
+        return _json({ "port_poe": list(app[POE].values()) })
+    async def put_poe(request: web.Request) -> web.Response:
+        if not authorized(request):
+            return _json({ "message": "Authentication failed" }, 401)
+        port = app[POE].get(request.match_info["port"], None)
+        if port is None:
+            return _json({ "message": "Invalid port" }, 404)
+        port["is_poe_enabled"] = bool((await request.json())["is_poe_enabled"])
+        return _json(port)
+    async def cli(request: web.Request) -> web.Response:
+        if not authorized(request):
+            return _json({ "message": "Authentication failed" }, 401)
+        command = (await request.json())["cmd"]
+        ok = command.startswith("show ")
+        output = "{} output\n".format(command) if ok else "Invalid input: {}\n".format(command)
+        return _json({ "cmd": command, "result_base64_encoded": base64.b64encode(output.encode()).decode(),
+            "status": "CCS_SUCCESS" if ok else "CCS_FAILURE", "error_msg": "" if ok else output.strip() }, 202)
+    async def get_vlans(request: web.Request) -> web.Response:
+        if not authorized(request):
+            return _json({ "message": "Authentication failed" }, 401)
+        return _json({ "vlan_element": [
+            { "vlan_id": vid, "name": "VLAN{}".format(vid), "status": "VS_PORT_BASED" }
+            for vid in range(1, vlans + 1)
+        ]})
+    app = web.Application()
+    app[COUNTERS] = counters
+    app.router.add_post("/rest/v4/login-sessions", _delayed(latency, counters, "login", login))
+    app.router.add_delete("/rest/v4/login-sessions", _delayed(latency, counters, "logout", logout))
+    app.router.add_get("/rest/v4/system/status", _delayed(latency, counters, "status", status))
+    app.router.add_get("/rest/v4/vlans", _delayed(latency, counters, "vlans", get_vlans))
+    app.router.add_get("/rest/v4/mac-table", _delayed(latency, counters, "mac-table", mac_table))
+    app.router.add_get("/rest/v4/poe/ports", _delayed(latency, counters, "poe", poe_ports))
+    app.router.add_put("/rest/v4/ports/{port}/poe", _delayed(latency, counters, "port-poe", put_poe))
+    app.router.add_post("/rest/v4/cli", _delayed(latency, counters, "cli", cli))
+    app[POE] = {
+        str(port): { "port_id": str(port), "is_poe_enabled": True,
+            "poe_priority": ("PPP_LOW", "PPP_LOW", "PPP_HIGH", "PPP_CRITICAL")[port % 4] }
+        for port in range(1, 25)
+    }
+    app[MACS] = [
+        { "mac_address": "02{:02x}00-00{:04x}".format(i % 4, i), "port_id": str(1 + i % 24), "vlan_id": 1 + i % vlans }
+        for i in range(macs)
+    ]
+    return app
+
+
+# ------------------------
+# Controladora (AOS 8 MM/MD)
+# ------------------------
+
+def controller_app(latency: float = 0.0, aps: int = 500) -> web.Application:
+    """API de una MM/MD en :4343: login, logout, /configuration/object y showcommand"""
+    counters = Counters()
+    uids: Dict[str, bool] = dict()
+    ap_prov = [
+        { "ap_name": "AP-{:04d}".format(i), "ap_group": "default", "mac": "00:1a:1e:00:{:02x}:{:02x}".format(i // 256, i % 256) }
+        for i in range(aps)
+    ]
+    async def login(request: web.Request) -> web.Response:
+        await request.post()
+        uid = "{:032x}".format(random.getrandbits(128))
+        uids[uid] = True
+        return _json({ "_global_result": { "status": "0", "status_str": "You've logged in successfully.", "UIDARUBA": uid } })
+    async def logout(request: web.Request) -> web.Response:
+        return _json({ "_global_result": { "status": "0", "status_str": "You've logged out successfully." } })
+    async def get_object(request: web.Request) -> web.Response:
+        if request.query.get("UIDARUBA", "") not in uids:
+            return _json({ "_global_result": { "status": "1", "status_str": "Invalid session" } }, 401)
+        name = request.match_info["name"]
+        return _json({ "_data": { name: ap_prov if name == "ap_prov" else [] } })
+    async def showcommand(request: web.Request) -> web.Response:
+        if request.query.get("UIDARUBA", "") not in uids:
+            return _json({ "_global_result": { "status": "1", "status_str": "Invalid session" } }, 401)
+        command = request.query.get("command", "")
+        if command == "show user-table":
+            return _json({
+                "Users": [
+                    { "IP": "10.1.0.{}".format(i % 254 + 1), "MAC": "02:00:00:00:{:02x}:{:02x}".format(i // 256, i % 256),
+                      "Name": "user{}".format(i), "Role": "authenticated", "AP name": ap["ap_name"] }
+                    for i, ap in enumerate(ap_prov)
+                ],
+                "_data": ["User Entries: {}/{}".format(len(ap_prov), len(ap_prov))],
+                "_meta": ["IP", "MAC", "Name", "Role", "Age(d:h:m)", "AP name"],
+            })
+        if command.startswith("show "):
+            return _json({ "_data": ["{} output".format(command)] })
+        return _json({ "_global_result": { "status": "1", "status_str": "Invalid command" } })
+    app = web.Application()
+    app[COUNTERS] = counters
+    app.router.add_post("/v1/api/login", _delayed(latency, counters, "login", login))
+    app.router.add_get("/v1/api/logout", _delayed(latency, counters, "logout", logout))
+    app.router.add_get("/v1/configuration/object/{name}", _delayed(latency, counters, "object", get_object))
+    app.router.add_get("/v1/configuration/showcommand", _delayed(latency, counters, "showcommand", showcommand))
+    return app
+
+
+# ------------------------
+# ClearPass
+# ------------------------
+
+def _matches(item: Mapping[str, Any], query: Mapping[str, Any]) -> bool:
+    """Evalúa un filtro de ClearPass ($exists, $gt, $gte, $lt, $lte, $contains, $in, $or, $and)"""
+    for key, cond in query.items():
+        if key == "$or":
+            if not any(_matches(item, sub) for sub in cond):
+                return False
+            continue
+        if key == "$and":
+            if not all(_matches(item, sub) for sub in cond):
+                return False
+            continue
+        value = item.get(key, None)
+        if not isinstance(cond, dict):
+            if value != cond:
+                return False
+            continue
+        for op, arg in cond.items():
+            if op == "$exists" and (value is not None) != bool(arg):
+                return False
+            if op in ("$gt", "$gte", "$lt", "$lte") and value is None:
+                return False
+            if op == "$gt" and not value > arg:
+                return False
+            if op == "$gte" and not value >= arg:
+                return False
+            if op == "$lt" and not value < arg:
+                return False
+            if op == "$lte" and not value <= arg:
+                return False
+            if op == "$contains" and (value is None or str(arg) not in str(value)):
+                return False
+            if op == "$in" and value not in arg:
+                return False
+    return True
+
+
+def _sessions(count: int, open_ratio: float = 0.5) -> List[Dict[str, Any]]:
+    """Genera una tabla de sesiones RADIUS, la mitad abiertas, con varios NAS"""
+    now = int(time.time())
+    items = list()
+    for i in range(count):
+        mac = "02{:010x}".format(i)
+        start = now - (i * 37) % 43200
+        items.append({
+            "id": str(100000 + i),
+            "mac_address": mac,
+            "callingstationid": mac,
+            "nasipaddress": "10.0.{}.1".format(i % 4),
+            "nasportid": str(1 + i % 48),
+            "ssid": "__wired_{}".format(i % 4) if i % 3 == 0 else "corp",
+            "acctstarttime": start,
+            "acctstoptime": None if (i % 100) < open_ratio * 100 else start + 600,
+        })
+    return items
+
+
+def clearpass_app(latency: float = 0.0, sessions: int = 1000, expires_in: int = 28800) -> web.Application:
+    """API de ClearPass: oauth, session, endpoint e insight"""
+    counters = Counters()
+    tokens: Dict[str, bool] = dict()
+    table = _sessions(sessions)
+    by_id = { item["id"]: item for item in table }
+    def authorized(request: web.Request) -> bool:
+        return request.headers.get("Authorization", "")[len("Bearer "):] in tokens
+    async def oauth(request: web.Request) -> web.Response:
+        data = await request.json()
+        if data.get("grant_type", None) != "client_credentials":
+            return _json({ "detail": "unsupported grant" }, 400)
+        token = "{:040x}".format(random.getrandbits(160))
+        tokens[token] = True
+        return _json({ "access_token": token, "expires_in": expires_in, "token_type": "Bearer", "scope": None })
+    async def get_sessions(request: web.Request) -> web.Response:
+        if not authorized(request):
+            return _json({ "detail": "Unauthorized" }, 401)
+        offset = int(request.query.get("offset", "0"))
+        limit = int(request.query.get("limit", "25"))
+        query = json.loads(request.query.get("filter", "{}"))
+        items = [item for item in table if _matches(item, query)]
+        sort = request.query.get("sort", None)
+        if sort:
+            field = sort.lstrip("+-")
+            items.sort(key=lambda item: item.get(field, None) or 0, reverse=sort.startswith("-"))
+        page = items[offset:offset + limit]
+        links: Dict[str, Any] = { "self": { "href": str(request.url) } }
+        if offset + limit < len(items):
+            links["next"] = { "href": str(request.url.update_query(offset=offset + limit)) }
+        return _json({ "_embedded": { "items": page }, "_links": links })
+    async def disconnect(request: web.Request) -> web.Response:
+        if not authorized(request):
+            return _json({ "detail": "Unauthorized" }, 401)
+        await request.json()
+        # Como el ClearPass real, no se puede desconectar una sesión que ya ha terminado
+        item = by_id.get(request.match_info["id"], None)
+        if item is None or item["acctstoptime"] is not None:
+            return _json({ "detail": "Session not found" }, 404)
+        return _json({ "error": 0, "message": "Success" })
+    async def patch_endpoint(request: web.Request) -> web.Response:
+        if not authorized(request):
+            return _json({ "detail": "Unauthorized" }, 401)
+        data = await request.json()
+        return _json({ "mac_address": request.match_info["mac"], "attributes": data.get("attributes", {}) })
+    async def insight(request: web.Request) -> web.Response:
+        if not authorized(request):
+            return _json({ "detail": "Unauthorized" }, 401)
+        mac = request.match_info["mac"]
+        number = int(mac[-4:], 16)
+        return _json({
+            "mac": mac,
+            "device_category": ("Camera", "Computer", "SmartDevice", "VoIP Phone")[number % 4],
+            "device_family": ("Axis", "Windows", "Android", "Aruba")[number % 4],
+            "device_name": "device-{}".format(number),
+            "ip": "10.1.{}.{}".format(number // 254 % 254, 1 + number % 254),
+            "updated_at": int(time.time()),
+        })
+    app = web.Application()
+    app[COUNTERS] = counters
+    app[SESSIONS] = table
+    app.router.add_post("/api/oauth", _delayed(latency, counters, "oauth", oauth))
+    app.router.add_get("/api/session", _delayed(latency, counters, "session", get_sessions))
+    app.router.add_post("/api/session/{id}/disconnect", _delayed(latency, counters, "disconnect", disconnect))
+    app.router.add_patch("/api/endpoint/mac-address/{mac}", _delayed(latency, counters, "endpoint", patch_endpoint))
+    app.router.add_get("/api/insight/endpoint/mac/{mac}", _delayed(latency, counters, "insight", insight))
+    return app
+
+
+@contextmanager
+def threaded(app: web.Application, port: int = 0) -> Iterator[str]:
+    """Sirve la aplicación desde un hilo con su propio bucle, para benchmarks síncronos"""
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    host: List[str] = list()
+    stop: List[asyncio.Event] = list()
+    async def run() -> None:
+        # El evento se crea dentro del bucle del hilo, no en el del llamante
+        stop.append(asyncio.Event())
+        async with serve(app, port) as address:
+            host.append(address)
+            started.set()
+            await stop[0].wait()
+    thread = threading.Thread(target=loop.run_until_complete, args=(run(),), daemon=True)
+    thread.start()
+    started.wait()
+    try:
+        yield host[0]
+    finally:
+        loop.call_soon_threadsafe(stop[0].set)
+        thread.join()
+        loop.close()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Servidor NATS mínimo, en proceso, para benchmarks sin gnatsd.
+#
+# Implementa el subconjunto del protocolo que usan los clientes asyncio:
+# INFO, CONNECT, PING/PONG, SUB (con queue groups), UNSUB, PUB y MSG,
+# con comodines '*' y '>' en las suscripciones.
+
+import json
+import random
+import asyncio
+
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+
+def _match(pattern: str, subject: str) -> bool:
+    ptoks, stoks = pattern.split("."), subject.split(".")
+    for index, ptok in enumerate(ptoks):
+        if ptok == ">":
+            return len(stoks) > index
+        if index >= len(stoks) or (ptok != "*" and ptok != stoks[index]):
+            return False
+    return len(ptoks) == len(stoks)
+
+
+class _Sub(object):
+
+    def __init__(self, client: "_Client", sid: str, subject: str, queue: Optional[str]) -> None:
+        self.client = client
+        self.sid = sid
+        self.subject = subject
+        self.queue = queue
+        self.remaining: Optional[int] = None
+
+
+class _Client(object):
+
+    def __init__(self, server: "Server", reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.subs: Dict[str, _Sub] = dict()
+
+    def send(self, data: bytes) -> None:
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    async def run(self) -> None:
+        info = { "server_id": "aruba-bench", "version": "2.0.0", "proto": 1, "headers": False,
+            "max_payload": 1048576, "host": "127.0.0.1", "port": self.server.port }
+        self.send("INFO {}\r\n".format(json.dumps(info)).encode())
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                await self._command(line.rstrip(b"\r\n").decode())
+                await self.writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for sub in tuple(self.subs.values()):
+                self.server.unsubscribe(sub)
+            self.writer.close()
+
+    async def _command(self, line: str) -> None:
+        parts = line.split()
+        if not parts:
+            return
+        op = parts[0].upper()
+        if op == "PING":
+            self.send(b"PONG\r\n")
+        elif op == "SUB":
+            queue = parts[2] if len(parts) == 4 else None
+            sub = _Sub(self, parts[-1], parts[1], queue)
+            self.subs[sub.sid] = sub
+            self.server.subscribe(sub)
+        elif op == "UNSUB":
+            sub = self.subs.get(parts[1], None)
+            if sub is not None:
+                if len(parts) > 2:
+                    sub.remaining = int(parts[2])
+                else:
+                    self.server.unsubscribe(sub)
+        elif op == "PUB":
+            size = int(parts[-1])
+            reply = parts[2] if len(parts) == 4 else None
+            payload = await self.reader.readexactly(size + 2)
+            self.server.publish(parts[1], reply, payload[:-2])
+        # CONNECT, PONG y demás comandos no necesitan respuesta
+
+
+class Server(object):
+
+    """Servidor NATS en proceso. Usar con 'async with serve() as url'"""
+
+    def __init__(self) -> None:
+        self.port = 0
+        self.subs: List[_Sub] = list()
+        self.published = 0
+
+    def subscribe(self, sub: _Sub) -> None:
+        self.subs.append(sub)
+
+    def unsubscribe(self, sub: _Sub) -> None:
+        if sub in self.subs:
+            self.subs.remove(sub)
+        sub.client.subs.pop(sub.sid, None)
+
+    def publish(self, subject: str, reply: Optional[str], payload: bytes) -> None:
+        self.published += 1
+        groups: Dict[str, List[_Sub]] = dict()
+        targets: List[_Sub] = list()
+        for sub in self.subs:
+            if _match(sub.subject, subject):
+                if sub.queue is None:
+                    targets.append(sub)
+                else:
+                    groups.setdefault(sub.queue, list()).append(sub)
+        # Cada queue group recibe el mensaje en uno solo de sus miembros
+        targets.extend(random.choice(members) for members in groups.values())
+        for sub in targets:
+            header = "MSG {} {} {}{}\r\n".format(subject, sub.sid, (reply + " ") if reply else "", len(payload))
+            sub.client.send(header.encode() + payload + b"\r\n")
+            if sub.remaining is not None:
+                sub.remaining -= 1
+                if sub.remaining <= 0:
+                    self.unsubscribe(sub)
+
+
+@asynccontextmanager
+async def serve() -> AsyncIterator[Tuple[str, Server]]:
+    """Lanza el servidor en localhost, devuelve (url, servidor)"""
+    server = Server()
+    clients: List[asyncio.Task] = list()
+    async def accept(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        clients.append(asyncio.ensure_future(_Client(server, reader, writer).run()))
+    listener = await asyncio.start_server(accept, "127.0.0.1", 0)
+    server.port = listener.sockets[0].getsockname()[1]
+    try:
+        yield "nats://127.0.0.1:{}".format(server.port), server
+    finally:
+        listener.close()
+        for task in clients:
+            task.cancel()
+        await asyncio.gather(*clients, return_exceptions=True)
+        await listener.wait_closed()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark completo contra servidores simulados (benchmark.mocks y
+# benchmark.natsd), con una latencia configurable en cada respuesta HTTP:
+#
+# - Latencia de login en switch, controladora y ClearPass.
+# - Peticiones por segundo con sesiones asíncronas, en paralelo.
+# - Latencia p50/p99 del handler de nats-what, de petición a respuesta.
+# - CoAs por segundo procesados por nats-coa, de uno en uno y por lotes.
+#
+# La controladora simulada escucha en el puerto 4343 (fijo en aruba.controller);
+# si está ocupado, se omiten sus pruebas.
+#
+# Uso: python -m benchmark.suite [--latency SEG] [--count N] [--concurrency N] [--uvloop]
+
+import io
+import os
+import json
+import time
+import asyncio
+import argparse
+import importlib.util
+
+from contextlib import AsyncExitStack, redirect_stdout
+from types import ModuleType
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, cast
+
+from nats.aio.client import Client as NATS # type: ignore
+
+from aruba import clearpass, common, controller, nats, switch
+from benchmark import mocks, natsd
+
+# Desactivo el log de certificado autofirmado.
+import logging
+logging.captureWarnings(True)
+
+# Fábrica de sesiones asíncronas para cada tipo de dispositivo
+Factory = Callable[[Dict[str, Any], Any], common.AsyncSession]
+
+FACTORIES: Dict[str, Factory] = {
+    "switch": lambda config, http: switch.async_session(config, verify=False, http=http),
+    "controller": lambda config, http: controller.async_session(config, verify=False, http=http),
+    # Sin caché de tokens, para medir un login completo cada vez
+    "clearpass": lambda config, http: clearpass.async_session(config, verify=False, http=http, tokens=None),
+}
+
+# Ruta que se consulta en cada dispositivo para medir peticiones por segundo
+PATHS = {
+    "switch": "/vlans",
+    "controller": "/object/ap_prov",
+    "clearpass": "/session",
+}
+
+
+def load_service(service: str) -> ModuleType:
+    """Carga el main.py de uno de los servicios (nats-what, nats-coa) como módulo.
+
+    Los directorios de los servicios no son paquetes (llevan guión), así que
+    es la forma de usarlos desde los benchmarks y las pruebas.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", service, "main.py")
+    spec = importlib.util.spec_from_file_location(service.replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module) # type: ignore
+    return module
+
+
+def _percentile(samples: Sequence[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _report(name: str, samples: Sequence[float]) -> None:
+    print("{:32s} p50 {:8.2f} ms   p99 {:8.2f} ms   ({} muestras)".format(name,
+        _percentile(samples, 0.50) * 1000, _percentile(samples, 0.99) * 1000, len(samples)))
+
+
+async def _gather(count: int, concurrency: int, task: Callable[[], Awaitable[None]]) -> float:
+    """Ejecuta 'count' veces la tarea, con 'concurrency' a la vez. Devuelve ops/s"""
+    limit = asyncio.Semaphore(concurrency)
+    async def one() -> None:
+        async with limit:
+            await task()
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(count)))
+    return count / (time.perf_counter() - start)
+
+
+async def login_latency(device: str, config: Dict[str, Any], count: int) -> List[float]:
+    """Tiempo de login (lo que tarda en entrar el async with), de uno en uno"""
+    samples: List[float] = list()
+    async with common.async_transport(verify=False) as http:
+        for _ in range(count):
+            session = FACTORIES[device](config, http)
+            start = time.perf_counter()
+            await session.__aenter__()
+            samples.append(time.perf_counter() - start)
+            await session.__aexit__(None, None, None)
+    return samples
+
+
+async def throughput(device: str, config: Dict[str, Any], count: int, concurrency: int) -> float:
+    """Peticiones por segundo sobre una única sesión asíncrona"""
+    async with FACTORIES[device](config, None) as session:
+        async def get() -> None:
+            async with session.get(PATHS[device]) as response:
+                await response.read()
+                if response.status != 200:
+                    raise ValueError("{} {} -> {}".format(device, PATHS[device], response.status))
+        return await _gather(count, concurrency, get)
+
+
+async def what_latency(natsURL: str, config: Dict[str, Any], count: int, concurrency: int) -> List[float]:
+    """Latencia del handler de nats-what, servido por una nats.App, medida desde el cliente que pregunta por NATS"""
+    what = load_service("nats-what")
+    samples: List[float] = list()
+    async with AsyncExitStack() as stack:
+        app = nats.App(natsURL, lambda: clearpass.async_session(config, verify=False), verify=False)
+        await app.start()
+        stack.push_async_callback(app.stop)
+        insight = clearpass.EndpointInsight(cast(clearpass.AsyncSession, app.prodSession))
+        await app.subscribe("bench.what", what.googleEnumerate(app, insight, None))
+        client = NATS()
+        await client.connect(natsURL)
+        stack.push_async_callback(client.close)
+        async def ask() -> None:
+            start = time.perf_counter()
+            await client.request("bench.what", json.dumps({ "queryResult": {} }).encode("utf-8"), timeout=30)
+            samples.append(time.perf_counter() - start)
+        await _gather(count, concurrency, ask)
+    return samples
+
+
+async def coa_throughput(natsURL: str, config: Dict[str, Any], app: Any, count: int, batch: int = 1) -> float:
+    """CoAs por segundo que completa nats-coa, contados en el ClearPass simulado.
+
+    Con batch > 1, se envían lotes de 'batch' endpoints en cada mensaje.
+    """
+    coa = load_service("nats-coa")
+    counters: mocks.Counters = app[mocks.COUNTERS]
+    sessions = [item for item in app[mocks.SESSIONS] if item["acctstoptime"] is None]
+    section = config["clearpass"]
+    messages: List[bytes] = list()
+    expected = 0
+    for first in range(0, count, batch):
+        items = [{
+            "endpoint_mac": item["mac_address"],
+            "nas_ip": item["nasipaddress"],
+            "threat": bool(index % 2),
+        } for index, item in ((index, sessions[index % len(sessions)]) for index in range(first, min(count, first + batch)))]
+        message: Dict[str, Any] = {
+            "host": section["api_host"],
+            "user": section["client_id"],
+            "pass": section["client_secret"],
+        }
+        if batch > 1:
+            message["items"] = items
+        else:
+            message.update(items[0])
+        messages.append(json.dumps(message).encode("utf-8"))
+        # nats-coa descarta las MACs repetidas dentro de un lote
+        expected += len(set(item["endpoint_mac"] for item in items))
+    target = counters["disconnect"] + expected
+    # nats-coa escribe una línea por mensaje, la descarto (también al drenar la conexión)
+    with redirect_stdout(io.StringIO()):
+        async with AsyncExitStack() as stack:
+            http = await stack.enter_async_context(common.async_transport(verify=False))
+            caches = coa.Caches(http, stack)
+            server, client = NATS(), NATS()
+            await server.connect(natsURL)
+            # drain espera a que terminen los handlers que aún están en curso
+            stack.push_async_callback(server.drain)
+            await client.connect(natsURL)
+            stack.push_async_callback(client.close)
+            async def handler(msg: Any) -> None:
+                await coa.message_handler(caches, msg)
+            await server.subscribe("bench.coa", cb=handler)
+            await server.flush()
+            start = time.perf_counter()
+            for data in messages:
+                await client.publish("bench.coa", data)
+            await client.flush()
+            while counters["disconnect"] < target:
+                await asyncio.sleep(0.01)
+            return expected / (time.perf_counter() - start)
+
+
+async def main(args: argparse.Namespace) -> None:
+    async with AsyncExitStack() as stack:
+        cpass = mocks.clearpass_app(args.latency, sessions=args.sessions)
+        hosts: Dict[str, Optional[str]] = {
+            "switch": await stack.enter_async_context(mocks.serve(mocks.switch_app(args.latency))),
+            "clearpass": await stack.enter_async_context(mocks.serve(cpass)),
+            "controller": None,
+        }
+        try:
+            address = await stack.enter_async_context(mocks.serve(mocks.controller_app(args.latency), 4343))
+            hosts["controller"] = address.split(":")[0]
+        except OSError as err:
+            print("Controladora omitida, puerto 4343 no disponible: {}".format(err))
+        natsURL, _ = await stack.enter_async_context(natsd.serve())
+        config: Dict[str, Any] = {
+            "switch": { "api_host": hosts["switch"], "username": "bench", "password": "bench", "api_version": "v4" },
+            "controller": { "api_host": hosts["controller"], "username": "bench", "password": "bench" },
+            "clearpass": { "grant_type": "client_credentials", "api_host": hosts["clearpass"],
+                "client_id": "bench", "client_secret": "bench" },
+        }
+        print("Latencia simulada: {:.1f} ms".format(args.latency * 1000))
+        for device in ("switch", "controller", "clearpass"):
+            if hosts[device] is not None:
+                _report("login {}".format(device), await login_latency(device, config, args.logins))
+        for device in ("switch", "controller", "clearpass"):
+            if hosts[device] is not None:
+                rate = await throughput(device, config, args.count, args.concurrency)
+                print("{:32s} {:8.1f} req/s".format("GET {} {}".format(device, PATHS[device]), rate))
+        _report("nats-what handler", await what_latency(natsURL, config, args.count, args.concurrency))
+        rate = await coa_throughput(natsURL, config, cpass, args.count)
+        print("{:32s} {:8.1f} CoA/s".format("nats-coa", rate))
+        if args.batch > 1:
+            rate = await coa_throughput(natsURL, config, cpass, args.count, args.batch)
+            print("{:32s} {:8.1f} CoA/s".format("nats-coa lotes de {}".format(args.batch), rate))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-l", "--latency", type=float, default=0.005, help="Latencia simulada de cada respuesta HTTP, en segundos")
+    parser.add_argument("-n", "--count", type=int, default=500, help="Número de operaciones por prueba")
+    parser.add_argument("-c", "--concurrency", type=int, default=16, help="Operaciones simultáneas")
+    parser.add_argument("--logins", type=int, default=20, help="Número de logins por dispositivo")
+    parser.add_argument("--batch", type=int, default=50, help="Endpoints por mensaje en la prueba de lotes de nats-coa")
+    parser.add_argument("--sessions", type=int, default=1000, help="Sesiones RADIUS en el ClearPass simulado")
+    parser.add_argument("--uvloop", action="store_true", help="Usar el bucle de eventos de uvloop, si está instalado")
+    args = parser.parse_args()
+    nats.run(main(args), uvloop=args.uvloop)
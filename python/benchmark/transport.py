@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Compara peticiones por segundo contra un switch simulado en HTTPS:
+#
+# - "antes": requests.get a nivel de módulo, una conexión TLS nueva por llamada.
+# - "después": session.get, sobre el pool keep-alive de aruba.common.Session.
+#
+# Uso: python -m benchmark.transport [-n PETICIONES]
+
+import time
+import argparse
+import requests
+
+from aruba import switch
+from benchmark import mocks
+
+# Desactivo el log de certificado autofirmado.
+import logging
+logging.captureWarnings(True)
+
+
+def before(session: switch.Session, count: int) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        response = requests.get(session.api_url + "/vlans", headers=session.headers(), verify=False)
+        response.raise_for_status()
+    return count / (time.perf_counter() - start)
+
+
+def after(session: switch.Session, count: int) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        response = session.get("/vlans")
+        response.raise_for_status()
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", type=int, default=500, help="Número de peticiones por prueba")
+    args = parser.parse_args()
+    with mocks.threaded(mocks.switch_app()) as api_host:
+        config = { "switch": { "api_host": api_host, "username": "bench", "password": "bench", "api_version": "v4" } }
+        with switch.session(config, verify=False) as session:
+            slow = before(session, args.count)
+            fast = after(session, args.count)
+    print("requests.get (sin pool): {:8.1f} req/s".format(slow))
+    print("session.get (keep-alive): {:8.1f} req/s".format(fast))
+    print("mejora: x{:.1f}".format(fast / slow))
@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 
 import sys
-import requests
 import json
 
 from aruba import Config, controller
@@ -21,7 +20,7 @@ with controller.session(Config(), verify=False) as session:
 
     # Solo tenemos que hacer lo que queremos hacer!
     # El context-manager se ocupa de lo demás
-    response = requests.get(session.api_url + "/object/ap_prov", headers=session.headers(), params=session.params({ "config-path": "/md" }), verify=False)
+    response = session.get("/object/ap_prov", params={ "config-path": "/md" })
     if response.status_code != 200:
         print("Error leyendo APs: ", response.status_code, response.text)
         sys.exit(-1)
@@ -2,10 +2,9 @@
 # -*- coding: utf-8 -*-
 
 import sys
-import requests
 import json
 
-from aruba import Config, clearpass
+from aruba import Config, RequestError, clearpass
 
 # Ejemplo de conexión básica, con módulo Aruba.
 # Realiza una conexión REST a un Clearpass
@@ -20,10 +19,12 @@ logging.captureWarnings(True)
 with clearpass.session(Config(), verify=False) as session:
 
     # Solo tenemos que hacer lo que queremos hacer!
-    # El context-manager se ocupa de lo demás
-    response = requests.get(session.api_url + "/guest", verify=False, headers=session.headers())
-    if response.status_code != 200:
-        print("Error leyendo Guests: ", response.status_code, response.text)
+    # El context-manager se ocupa de lo demás, y clearpass.items
+    # recorre todas las páginas de la colección.
+    try:
+        for guest in clearpass.items(session, "/guest"):
+            print(json.dumps(guest, indent=4))
+    except RequestError as err:
+        print("Error leyendo Guests: ", err.status_code, err.text)
         sys.exit(-1)
-    print(json.dumps(response.json(), indent=4))
 
@@ -5,21 +5,26 @@
 # Requisitos:
 #
 # pip3 install aiohttp
-# pip3 install cchardet
 # pip3 install aiodns
-# pip3 install asyncio-nats-client
+# pip3 install nats-py
+# pip3 install uvloop (opcional, con --uvloop)
 
+import os
 import sys
-import json
+import hashlib
 import argparse
 import asyncio
 import traceback
+import functools
 import aiohttp
 
+from collections import OrderedDict
+from contextlib import AsyncExitStack, asynccontextmanager
 from nats.aio.client import Client as NATS, Msg # type: ignore
-from typing import Mapping, Optional, Any
+from typing import AsyncIterator, Dict, List, Mapping, Optional, Tuple, Any, cast
 
-from aruba import Config, clearpass
+from aruba import clearpass, codec, nats, trace
+from aruba.common import normalize_mac
 
 # Desactivo el log de certificado autofirmado.
 import logging
@@ -35,11 +40,144 @@ Sample = {
   "threat": True,
 }
 
-async def onReceive(http: aiohttp.ClientSession, data: Mapping[str, Any]) -> Optional[str]:
-  """Cambia los atributos de threat severity y status del endpoint, y le envia un CoA al nas_ip"""
+# Ejemplo de peticion por lotes: varios endpoints en un solo mensaje. Cada
+# elemento puede llevar su propio "threat"; si no, se usa el del mensaje, y
+# si no está en ninguno de los dos, el elemento no se procesa (da error).
+# Se responde (si el mensaje tiene reply) con el resultado de cada elemento.
+BatchSample = {
+  "host": "cppm-address",
+  "user": "cppm-api-user",
+  "pass": "cppm-api-key",
+  "threat": True,
+  "items": [
+    { "endpoint_mac": "endpoint MAC address", "nas_ip": "NAS IP address for CoA" },
+  ],
+}
+
+# Número de endpoints de un lote que se procesan a la vez, por defecto
+CONCURRENCY = 16
+
+# Queue group de NATS. Si hay varias instancias (o workers), cada mensaje
+# lo procesa sólo una de ellas.
+QUEUE = "nats-coa"
+
+# Número máximo de ClearPass (host, usuario, secreto) con sesión abierta a la vez
+CACHES = 16
+
+class _Entry(object):
+  """Sesión y caché de un ClearPass, con los mensajes que la están usando"""
+
+  def __init__(self) -> None:
+    self.stack = AsyncExitStack()
+    self.ready: Optional[asyncio.Future] = None
+    self.users = 0
+    self.evicted = False
+
+class Caches(object):
+  """Sesión y caché de sesiones activas de cada ClearPass, por (host, usuario, secreto).
+
+  El secreto forma parte de la clave como huella (no en claro), así que un
+  mensaje con un secreto incorrecto no reutiliza la sesión abierta con el
+  bueno: abre la suya, y falla al autenticarse.
+
+  Se abren la primera vez que llega un mensaje para ese ClearPass, así que
+  el CoA encuentra el id de sesión en memoria en lugar de consultar
+  /session en cada mensaje. Se mantienen como mucho 'size' a la vez: al
+  pasarse, se cierra la que lleva más tiempo sin usarse (en cuanto terminen
+  los mensajes que la estén usando). Las que queden se cierran con 'stack'.
+  """
+
+  def __init__(self, http: aiohttp.ClientSession, stack: AsyncExitStack,
+    tokens: clearpass.TokenCache = clearpass.TOKENS, size: int = CACHES) -> None:
+    self.http = http
+    self.tokens = tokens
+    self.size = size
+    self.entries: "OrderedDict[Tuple[str, str, str], _Entry]" = OrderedDict()
+    stack.push_async_callback(self.close)
+
+  async def _open(self, cfg: Mapping[str, Any], stack: AsyncExitStack) -> Tuple[clearpass.AsyncSession, clearpass.SessionCache]:
+    # La sesión y la caché se comparten entre mensajes, no son de la traza del primero
+    trace.detach()
+    try:
+      session = await stack.enter_async_context(clearpass.async_session(cfg, verify=False, http=self.http, tokens=self.tokens))
+      cache = await stack.enter_async_context(clearpass.SessionCache(session))
+    except BaseException:
+      await stack.aclose()
+      raise
+    return session, cache
+
+  async def _close(self, entry: _Entry) -> None:
+    try:
+      await entry.stack.aclose()
+    except Exception:
+      logging.exception("Caches - error cerrando sesion")
+
+  def _evict(self) -> List[_Entry]:
+    """Saca de la caché las que sobran, y devuelve las que ya se pueden cerrar"""
+    idle: List[_Entry] = list()
+    while len(self.entries) > self.size:
+      _, entry = self.entries.popitem(last=False)
+      entry.evicted = True
+      if entry.users == 0:
+        idle.append(entry)
+    return idle
+
+  @asynccontextmanager
+  async def use(self, cfg: Mapping[str, Any]) -> AsyncIterator[Tuple[clearpass.AsyncSession, clearpass.SessionCache]]:
+    """Sesión y caché del ClearPass de la configuración, mientras dura el bloque"""
+    creds = cfg["clearpass"]
+    secret = hashlib.blake2b(creds["client_secret"].encode("utf-8"), digest_size=16).hexdigest()
+    key = (creds["api_host"], creds["client_id"], secret)
+    entry = self.entries.get(key, None)
+    if entry is None:
+      entry = _Entry()
+      entry.ready = asyncio.ensure_future(self._open(cfg, entry.stack))
+      self.entries[key] = entry
+      # Si falla, lo descarto para reintentarlo con el siguiente mensaje
+      def failed(done: asyncio.Future, entry: _Entry = entry) -> None:
+        if (done.cancelled() or done.exception()) and self.entries.get(key, None) is entry:
+          del self.entries[key]
+      entry.ready.add_done_callback(failed)
+    else:
+      self.entries.move_to_end(key)
+    entry.users += 1
+    try:
+      for idle in self._evict():
+        await self._close(idle)
+      yield await asyncio.shield(cast(asyncio.Future, entry.ready))
+    finally:
+      entry.users -= 1
+      if entry.evicted and entry.users == 0:
+        await self._close(entry)
 
-  # Fake config object. Solo soportamos client_credentials
-  cfg = {
+  async def close(self) -> None:
+    """Cierra todas las sesiones (las que están en uso, cuando terminen)"""
+    entries, self.entries = list(self.entries.values()), OrderedDict()
+    for entry in entries:
+      entry.evicted = True
+      if entry.users == 0:
+        await self._close(entry)
+
+async def findSession(session: clearpass.AsyncSession, endpoint_mac: str, nas_ip: str) -> Optional[str]:
+  """Busca en ClearPass la última sesión del endpoint en el NAS, si no está en la caché"""
+  query = {
+    "filter": codec.dumps_text({
+      "callingstationid": endpoint_mac,
+    }),
+    "sort": "-acctstarttime",
+    "limit": 1,
+  }
+  async with session.get("/session", params=query) as response:
+    if response.status != 200:
+        raise ValueError("Error localizando sesion: ({}) {}".format(response.status, await response.text()))
+    for item in (await codec.aload(response))["_embedded"]["items"]:
+        if nas_ip in item["nasipaddress"]:
+            return item["id"]
+  return None
+
+def config(data: Mapping[str, Any]) -> Dict[str, Any]:
+  """Fake config object. Solo soportamos client_credentials"""
+  return {
     "clearpass": {
       "grant_type": "client_credentials",
       "api_host": data["host"],
@@ -47,105 +185,203 @@ async def onReceive(http: aiohttp.ClientSession, data: Mapping[str, Any]) -> Opt
       "client_secret": data["pass"],
     },
   }
-  nas_ip = data["nas_ip"]
-  endpoint_mac = data["endpoint_mac"]
-  threat = data["threat"]
-
-  # Inicio una sesión con el clearpass que está en el fichero de configuración.
-  # Para cambiar las credenciales: python -m aruba.clearpass
-  with clearpass.session(cfg, verify=False) as session:
-
-      # Modifico el nivel de amenaza del endpoint
-      update = {
-        "attributes": {
-          "Threat Severity": "Critical",
-          "Threat Status": "In Progress",
-        },
-      }
-      if not threat:
-        update = {
-          "attributes": {
-            "Threat Severity": "Low",
-            "Threat Status": "Resolved",
-          },
-        }
-      async with http.patch(session.api_url + "/endpoint/mac-address/{}".format(endpoint_mac), headers=session.headers(), json=update) as response:
-        if response.status != 200:
-            return "Error actualizando endpoint: ({}) {}".format(response.status, await response.text())
-
-      # Encuentro la última sesión en el switch
-      query = {
-        "filter": json.dumps({
-          "callingstationid": endpoint_mac,
-        }),
-        "sort": "-acctstarttime",
-        "limit": 1,
-      }
-      session_id = ""
-      async with http.get(session.api_url + "/session", headers=session.headers(), params=query) as response:
-        if response.status != 200:
-            return "Error localizando sesion: ({}) {}".format(response.status, await response.text())
-        for item in (await response.json())["_embedded"]["items"]:
-            if nas_ip in item["nasipaddress"]:
-                session_id = item["id"]
-                break
-
-      # Fuerzo un reconnect de esa sesión
-      confirm = { "confirm_disconnect": True }
-      async with http.post(session.api_url+"/session/{}/disconnect".format(session_id), headers=session.headers(), json=confirm) as response:
-        if response.status != 200:
-            return "Error desconectando sesion: ({}) {}".format(response.status, await response.text())
-
-      # return None si no hay error
-      return None
-
-async def message_handler(http: aiohttp.ClientSession, msg: Msg) -> None:
-  """Gestiona mensajes recibidos"""
+
+async def coa(session: clearpass.AsyncSession, cache: clearpass.SessionCache,
+  endpoint_mac: str, nas_ip: str, threat: bool) -> Optional[str]:
+  """Cambia los atributos de threat severity y status del endpoint, y le envia un CoA al nas_ip"""
+
+  # Modifico el nivel de amenaza del endpoint
+  update = {
+    "attributes": {
+      "Threat Severity": "Critical",
+      "Threat Status": "In Progress",
+    },
+  }
+  if not threat:
+    update = {
+      "attributes": {
+        "Threat Severity": "Low",
+        "Threat Status": "Resolved",
+      },
+    }
+  async with session.patch("/endpoint/mac-address/{}".format(endpoint_mac), json=update) as response:
+    if response.status != 200:
+        return "Error actualizando endpoint: ({}) {}".format(response.status, await response.text())
+
+  # Encuentro la última sesión en el switch. Si acaba de empezar, puede que
+  # aún no esté en la caché, y entonces la busco en el ClearPass.
+  item = cache.find(endpoint_mac, nas_ip)
+  session_id = item["id"] if item is not None else None
+  cached = session_id is not None
+  if session_id is None:
+    try:
+      session_id = await findSession(session, endpoint_mac, nas_ip)
+    except ValueError as err:
+      return str(err)
+  if session_id is None:
+    return "No hay sesión activa de {} en {}".format(endpoint_mac, nas_ip)
+
+  # Fuerzo un reconnect de esa sesión
+  error = await disconnect(session, session_id)
+  if error is not None and cached:
+    # La sesión de la caché puede haber terminado ya: busco la última en el ClearPass
+    try:
+      fresh = await findSession(session, endpoint_mac, nas_ip)
+    except ValueError as err:
+      return str(err)
+    if fresh is not None and fresh != session_id:
+      error = await disconnect(session, fresh)
+
+  # return None si no hay error
+  return error
+
+async def disconnect(session: clearpass.AsyncSession, session_id: str) -> Optional[str]:
+  """Envía un CoA de desconexión a la sesión. Devuelve el error, si lo hay"""
+  confirm = { "confirm_disconnect": True }
+  async with session.post("/session/{}/disconnect".format(session_id), json=confirm) as response:
+    if response.status != 200:
+        return "Error desconectando sesion: ({}) {}".format(response.status, await response.text())
+  return None
+
+async def onReceive(caches: Caches, data: Mapping[str, Any]) -> Optional[str]:
+  """Procesa un mensaje con un único endpoint"""
+  async with caches.use(config(data)) as (session, cache):
+    return await coa(session, cache, data["endpoint_mac"], data["nas_ip"], data["threat"])
+
+async def onBatch(caches: Caches, data: Mapping[str, Any], concurrency: int = CONCURRENCY) -> List[Dict[str, Any]]:
+  """Procesa un lote de endpoints en paralelo, devuelve el resultado de cada uno.
+
+  Las MACs repetidas sólo se procesan una vez (la primera), y el resto se
+  marcan como duplicadas. Los endpoints sin "threat" (ni propio ni del
+  mensaje) dan error: no se pone en cuarentena nada que no se haya pedido.
+  """
+  limit = asyncio.Semaphore(concurrency)
+  async def one(session: clearpass.AsyncSession, cache: clearpass.SessionCache,
+    item: Mapping[str, Any], threat: bool) -> Optional[str]:
+    async with limit:
+      try:
+        return await coa(session, cache, item["endpoint_mac"], item["nas_ip"], threat)
+      except Exception as err:
+        return "Excepcion procesando endpoint: {}".format(err)
+  results: List[Dict[str, Any]] = list()
+  todo: List[Tuple[Mapping[str, Any], bool]] = list()
+  seen = set()
+  for item in data["items"]:
+    result = { "endpoint_mac": item.get("endpoint_mac", None), "nas_ip": item.get("nas_ip", None) }
+    results.append(result)
+    if result["endpoint_mac"] is None or result["nas_ip"] is None:
+      result.update({ "status": "error", "error": "Faltan endpoint_mac o nas_ip" })
+      continue
+    threat = item.get("threat", data.get("threat", None))
+    if not isinstance(threat, bool):
+      result.update({ "status": "error", "error": "Falta el campo threat, o no es true / false" })
+      continue
+    mac = normalize_mac(result["endpoint_mac"])
+    if mac in seen:
+      result["status"] = "duplicate"
+      continue
+    seen.add(mac)
+    todo.append((item, threat))
+  async with caches.use(config(data)) as (session, cache):
+    errors = await asyncio.gather(*(one(session, cache, item, threat) for item, threat in todo))
+  pending = [result for result in results if "status" not in result]
+  for result, error in zip(pending, errors):
+    result["status"] = "ok" if error is None else "error"
+    if error is not None:
+      result["error"] = error
+  return results
+
+async def message_handler(caches: Caches, msg: Msg, concurrency: int = CONCURRENCY) -> Optional[bytes]:
+  """Gestiona mensajes recibidos. Devuelve la respuesta, para los mensajes con reply"""
+  # Cada mensaje es una traza, con las peticiones al ClearPass colgando de ella
+  with trace.span("nats", topic=msg.subject) as span:
+    if span is not None:
+      span.capture("request", msg.data)
+    reply = await handle(caches, msg, concurrency)
+    if span is not None:
+      span.capture("reply", reply)
+    return reply
+
+async def handle(caches: Caches, msg: Msg, concurrency: int) -> Optional[bytes]:
   try:
-    subject, data = msg.subject, json.loads(msg.data.decode())
+    subject, data = msg.subject, codec.loads(msg.data)
+    if "items" in data:
+      for key in ("host", "user", "pass"):
+        if not key in data:
+          print("Recibido lote mal formado '{}': {}".format(subject, data))
+          return codec.dumps({ "error": "Falta el campo {}".format(key) })
+      print("Recibido lote de {} endpoints".format(len(data["items"])))
+      results = await onBatch(caches, data, concurrency)
+      print("Lote completado: {} errores".format(sum(1 for item in results if item["status"] == "error")))
+      return codec.dumps({ "results": results })
     for key in Sample:
       if not key in data:
         print("Recibido mensaje mal formado '{}': {}".format(subject, data))
-        return
+        return codec.dumps({ "error": "Falta el campo {}".format(key) })
     print("Recibido mensaje bien formado: {}".format(data))
-    result = await onReceive(http, data)
+    result = await onReceive(caches, data)
     if result is None:
       print("Cambio completado")
-    else:
-      print("Error cambiando rol al sensor: {}".format(result))
+      return codec.dumps({ "status": "ok" })
+    print("Error cambiando rol al sensor: {}".format(result))
+    return codec.dumps({ "status": "error", "error": result })
   except:
     print("Excepcion promesando mensaje: {}".format(traceback.format_exc()))
+    return codec.dumps({ "status": "error", "error": "Se ha producido un error" })
 
-async def process(loop: asyncio.AbstractEventLoop, url: str, topic: str) -> None:
-  """Process messages coming from the topic"""
+async def process(url: str, topic: str, concurrency: int = CONCURRENCY,
+  queue: str = QUEUE, tokens: clearpass.TokenCache = clearpass.TOKENS) -> None:
+  """Process messages coming from the topic, until cancelled"""
   nc = NATS()
-  await nc.connect(url, loop=loop)
+  await nc.connect(url)
   print("Conexión establecida a url {}".format(url))
   try:
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(verify_ssl=False)) as http:
-      @asyncio.coroutine
-      def handler(msg):
-        return message_handler(http, msg)
-      sid = await nc.subscribe(topic, cb=handler)
-      print("Suscripción a topico {}: {}".format(topic, sid))
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as http, AsyncExitStack() as stack:
+      caches = Caches(http, stack, tokens)
+      async def handler(msg):
+        reply = await message_handler(caches, msg, concurrency)
+        if msg.reply and reply is not None:
+          await nc.publish(msg.reply, reply)
+      sub = await nc.subscribe(topic, queue=queue, cb=handler)
+      print("Suscripción a topico {}: {}".format(topic, sub.subject))
       try:
         while True:
-          await asyncio.sleep(1000, loop=loop)
+          await asyncio.sleep(1000)
       finally:
         print("Eliminando suscripcion a topico {}".format(topic))
-        await nc.unsubscribe(sid)
+        await sub.unsubscribe()
   finally:
     print("Cerrando conexion a URL {}".format(url))
     await nc.close()
 
+def worker(args: argparse.Namespace, index: int) -> None:
+  """Ejecuta el servicio. Con --workers, cada proceso ejecuta uno, compartiendo el token de ClearPass"""
+  if args.trace is not None:
+    # Un fichero por worker, para que no se mezclen las líneas
+    path = args.trace if args.workers <= 1 or args.trace == "-" else "{}.{}".format(args.trace, index)
+    trace.configure(trace.JsonLines(path), sample=args.trace_sample)
+  tokens = clearpass.SharedTokenCache() if args.workers > 1 else clearpass.TOKENS
+  nats.run(process(args.url, args.topic, args.concurrency, args.queue, tokens), uvloop=args.uvloop)
+
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
   parser.add_argument("url", help="URL del servidor gnatsd al que conectar")
   parser.add_argument("topic", help="Nombre del topic al que suscribirse")
+  parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="Endpoints de un lote que se procesan a la vez")
+  parser.add_argument("--queue", default=QUEUE, help="Queue group de NATS")
+  parser.add_argument("--trace", default=None, help="Fichero donde guardar las trazas (JSON lines, '-' para stdout)")
+  parser.add_argument("--trace-sample", type=float, default=0.01, help="Fracción de trazas en las que se guardan los mensajes")
+  parser.add_argument("--workers", type=int, default=1, help="Número de procesos (0 = uno por core)")
+  parser.add_argument("--uvloop", action="store_true", help="Usar el bucle de eventos de uvloop, si está instalado")
+  parser.add_argument("--metrics-port", type=int, default=None, help="Puerto en el que publicar métricas para Prometheus")
   args = parser.parse_args()
   if args.url == "" or args.topic == "":
     print("URL y topic no pueden estar vacios")
     sys.exit(-1)
-  loop = asyncio.get_event_loop()
-  loop.run_until_complete(process(loop, args.url, args.topic))
-  loop.close()
+  if args.workers == 0:
+    args.workers = os.cpu_count() or 1
+  # Las métricas las publica el Supervisor, también con un solo worker
+  if args.workers > 1 or args.metrics_port is not None:
+    nats.Supervisor(functools.partial(worker, args), args.workers, metricsPort=args.metrics_port).run()
+  else:
+    worker(args, 0)
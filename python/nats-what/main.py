@@ -5,69 +5,63 @@
 # Requisitos:
 #
 # pip3 install aiohttp
-# pip3 install cchardet
 # pip3 install aiodns
-# pip3 install asyncio-nats-client
+# pip3 install nats-py
+# pip3 install uvloop (opcional, con --uvloop)
 
+import os
 import sys
-import json
 import argparse
 import asyncio
 import traceback
-import aiohttp
 import time
 import logging
+import functools
 
-from typing import Sequence, Tuple, Any, Dict, cast
-from aruba import clearpass, nats, common
+from typing import AsyncIterator, List, Optional, Sequence, Tuple, Any, Dict, cast
+from aruba import clearpass, codec, nats, trace
 
 
-# Obtiene la lista de sesiones vivas
-async def getSessions(cppmSession: common.Session, httpSession: aiohttp.ClientSession, nas_ips: Sequence[str]) -> Tuple[Any]:
-    cppmURL = cppmSession.api_url + "/session"
-    query = {
-        "sort": "-acctstarttime",
-        "limit": 25,
+# Antigüedad máxima (segundos) de una sesión sin acctstoptime para considerarla viva
+MAX_AGE = 28800
+
+# Obtiene las sesiones vivas, la más reciente de cada MAC, según van llegando.
+# Los filtros de sesión abierta, antigüedad y NAS se aplican en el ClearPass,
+# y se recorren todas las páginas del resultado.
+async def getSessions(cppmSession: clearpass.AsyncSession, nas_ips: Optional[Sequence[str]]) -> AsyncIterator[Dict[str, Any]]:
+    query: Dict[str, Any] = {
+        "acctstoptime": { "$exists": False },
+        "acctstarttime": { "$gt": int(time.time() - MAX_AGE) },
     }
-    result: Dict[str, Any] = dict()
-    async with httpSession.get(cppmURL, headers=cppmSession.headers(), params=cppmSession.params(query)) as response:
-        if response.status != 200:
-            raise ValueError("Error localizando sesion: ({}) {}".format(response.status, await response.text()))
-        logging.debug("getSessions - sesiones obtenidas: {}".format(await response.text()))
-        items = (await response.json())["_embedded"]["items"]
-        # Me quedo con la sesion mas reciente de cada MAC
-        now = time.time()
-        for item in items:
-            mac = item.get("mac_address", "")
-            ini = int(item.get("acctstarttime", "0"))
-            end = item.get("acctstoptime", None)
-            nas = item.get("nasipaddress", "")
-            if (end is None) and (now - ini < 28800) and (mac not in result) and coincide_nas(nas, nas_ips):
-                result[mac] = item
-    return cast(Tuple[Any], tuple(result.values()))
-
-# Comprueba si el NAS coincide con alguno de los prefijos dados
-def coincide_nas(nas_ip: str, prefijos: Sequence[str]) -> bool:
+    if nas_ips is not None:
+        query["$or"] = [{ "nasipaddress": { "$contains": p } } for p in nas_ips]
+    seen = set()
+    async for item in clearpass.aitems(cppmSession, "/session", filter=query, sort="-acctstarttime"):
+        mac = item.get("mac_address", "")
+        # $contains busca en cualquier parte de la IP, compruebo el prefijo
+        if (mac not in seen) and coincide_nas(item.get("nasipaddress", ""), nas_ips):
+            seen.add(mac)
+            yield item
+
+# Comprueba si el NAS coincide con alguno de los prefijos dados
+def coincide_nas(nas_ip: str, prefijos: Optional[Sequence[str]]) -> bool:
     return (prefijos is None) or any(nas_ip.startswith(p) for p in prefijos)
 
-# Endpoints
-async def getEndpoints(cppmSession: common.Session, httpSession: aiohttp.ClientSession, macs: Sequence[str]) -> Tuple[Any]:
-    logging.debug("getEndpoints - Resolviendo endpoints para macs {}".format(macs))
-
-    # Funcion auxiliar para convertir una lista de promesas, en un array de valores.
-    async def gather(iterable):
-        return await asyncio.gather(*tuple(iterable))
-
-    endpoints = await gather(
-        httpSession.get(cppmSession.api_url + "/insight/endpoint/mac/{}".format(mac),
-            headers=cppmSession.headers(),
-            params=cppmSession.params())
-        for mac in macs)
-
-    for text in await gather(ep.text() for ep in endpoints):
-        logging.debug("getEndpoints - información de endpoint: {}".format(text))
-
-    return await gather(ep.json() for ep in endpoints)
+# Sesiones vivas y sus endpoints. La información de cada endpoint se pide
+# a Insight en cuanto llega su sesión, sin esperar al resto de páginas.
+async def getDevices(cppmSession: clearpass.AsyncSession, insight: clearpass.EndpointInsight,
+    nas_ips: Optional[Sequence[str]]) -> Tuple[List[Dict[str, Any]], Tuple[Any, ...]]:
+    sesiones: List[Dict[str, Any]] = list()
+    pending: List[asyncio.Future] = list()
+    try:
+        async for session in getSessions(cppmSession, nas_ips):
+            logging.debug("getDevices - resolviendo endpoint %s", session["mac_address"])
+            sesiones.append(session)
+            pending.append(asyncio.ensure_future(insight.get(session["mac_address"])))
+        return sesiones, tuple(await asyncio.gather(*pending))
+    finally:
+        for task in pending:
+            task.cancel()
 
 # Combina información de sesión y endpoint
 def mergeData(sesiones: Sequence[Any], endpoints: Sequence[Any]) -> str:
@@ -93,65 +87,93 @@ def mergeData(sesiones: Sequence[Any], endpoints: Sequence[Any]) -> str:
     return mensaje
 
 # Gestiona las peticiones de Google
-def googleEnumerate(app: nats.App, nas_ips: Sequence[str]) -> nats.AsyncCallback:
+def googleEnumerate(app: nats.App, insight: clearpass.EndpointInsight, nas_ips: Optional[Sequence[str]]) -> nats.AsyncCallback:
   async def handler(topic: str, msg: bytes) -> bytes:
     mensaje = ""
     try:
-      # No se usa, pero ahí está...
-      logging.debug("Recibida peticion: {}".format(json.loads(msg.decode('utf-8'))))
+      # La petición no se usa. Si hace falta verla, está en las trazas (--trace)
       # Obtenemos la información
-      if app.prodSession is None or app.httpSession is None:
-        raise ValueError("CPPM and HTTP Sessions must not be None")
-      sesiones = await getSessions(app.prodSession, app.httpSession, nas_ips)
-      macs = tuple(s["mac_address"] for s in sesiones)
-      endpoints = await getEndpoints(app.prodSession, app.httpSession, macs)
+      if app.prodSession is None:
+        raise ValueError("CPPM Session must not be None")
+      cppmSession = cast(clearpass.AsyncSession, app.prodSession)
+      sesiones, endpoints = await getDevices(cppmSession, insight, nas_ips)
       # Y generamos el mensaje
       mensaje = mergeData(sesiones, endpoints)
       logging.debug(f"Mensaje generado: {mensaje}")
     except:
       logging.error(traceback.format_exc())
       mensaje = "Se ha producido un error"
-    return json.dumps({
+    return codec.dumps({
       "fulfillmentText": mensaje,
       "payload": { "google": { "expectUserResponse": False } },
-    }).encode('utf-8')
+    })
   return handler
 
 
-if __name__ == "__main__":
-
+def logs() -> None:
   #fileHandler = RotatingFileHandler("nats-what.log", maxBytes=512*1024, backupCount=5)
   fileHandler = logging.StreamHandler(sys.stdout)
   logging.captureWarnings(True)
   logging.basicConfig(level=logging.DEBUG, handlers=(fileHandler,))
 
+# Ejecuta el servicio. Con --workers, cada proceso ejecuta uno, todos en el
+# mismo queue group de NATS y compartiendo el token de ClearPass.
+def worker(args: argparse.Namespace, index: int) -> None:
+  logs()
+  # Fake config object. Solo soportamos client_credentials
+  cfg = {
+    "clearpass": {
+      "grant_type": "client_credentials",
+      "api_host": args.cppm,
+      "client_id": args.user,
+      "client_secret": args.secret,
+    },
+  }
+  if args.trace is not None:
+    # Un fichero por worker, para que no se mezclen las líneas
+    path = args.trace if args.workers <= 1 or args.trace == "-" else "{}.{}".format(args.trace, index)
+    trace.configure(trace.JsonLines(path), sample=args.trace_sample)
+  tokens = clearpass.SharedTokenCache() if args.workers > 1 else clearpass.TOKENS
+
+  # Con varios workers, las métricas las publica el supervisor
+  app = nats.App(args.url, (lambda: clearpass.async_session(cfg, verify=False, tokens=tokens)), verify=False,
+    metricsPort=args.metrics_port if args.workers <= 1 else None)
+  async def setup(app: nats.App) -> None:
+    insight = clearpass.EndpointInsight(cast(clearpass.AsyncSession, app.prodSession), ttl=args.ttl)
+    # La respuesta no depende del contenido del mensaje, así que las peticiones
+    # que llegan a la vez comparten una sola consulta al ClearPass.
+    coalesce = nats.Coalesce(key=lambda topic, msg: topic, ttl=args.coalesce_ttl)
+    await app.subscribe(args.topic, googleEnumerate(app, insight, args.nas_ip), coalesce=coalesce)
+  nats.run(app.serve(setup), uvloop=args.uvloop)
+
+
+if __name__ == "__main__":
+
+  logs()
   parser = argparse.ArgumentParser()
   parser.add_argument("url", help="URL del servidor gnatsd al que conectar")
   parser.add_argument("topic", help="Nombre del topic al que suscribirse")
   parser.add_argument("cppm", help="Dirección IP del servidor ClearPass")
   parser.add_argument("user", help="Nombre del usuario api")
   parser.add_argument("secret", help="Client_secret del usuario api")
+  parser.add_argument("--ttl", type=float, default=300, help="Segundos que se guarda la información de cada endpoint")
+  parser.add_argument("--coalesce-ttl", type=float, default=0, help="Segundos que se reutiliza la respuesta para otras peticiones")
+  parser.add_argument("--metrics-port", type=int, default=None, help="Puerto en el que publicar métricas para Prometheus")
+  parser.add_argument("--trace", default=None, help="Fichero donde guardar las trazas (JSON lines, '-' para stdout)")
+  parser.add_argument("--trace-sample", type=float, default=0.01, help="Fracción de trazas en las que se guardan los mensajes")
+  parser.add_argument("--uvloop", action="store_true", help="Usar el bucle de eventos de uvloop, si está instalado")
+  parser.add_argument("--workers", type=int, default=1, help="Número de procesos (0 = uno por core)")
   parser.add_argument("nas_ip", nargs="*", help="IP del NAS (todo o parte)")
   args = parser.parse_args()
   if args.url == "" or args.topic == "" or args.cppm == "" or args.user == "" or args.secret == "":
     print("Ninguno de los parametros pueden estar vacios")
     sys.exit(-1)
-  # Fake config object. Solo soportamos client_credentials
-  cfg = {
-    "clearpass": {
-      "grant_type": "client_credentials",
-      "api_host": args.cppm,
-      "client_id": args.user,
-      "client_secret": args.secret,
-    },
-  }
   if len(args.nas_ip) == 0:
     args.nas_ip = None
+  if args.workers == 0:
+    args.workers = os.cpu_count() or 1
 
-  loop = asyncio.get_event_loop()
-  app = nats.App(args.url, (lambda: clearpass.session(cfg, verify=False)), verify=False)
-  async def bootstrap():
-    await app.start()
-    await app.subscribe(args.topic, googleEnumerate(app, args.nas_ip))
-  loop.run_until_complete(bootstrap())
-  app.forever()
+  if args.workers > 1:
+    nats.Supervisor(functools.partial(worker, args), args.workers, metricsPort=args.metrics_port).run()
+  else:
+    worker(args, 0)
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import requests
 import sys
 from aruba import Config, switch
 import json
@@ -21,7 +20,7 @@ with switch.session(Config(), verify=False) as session:
 
     # Solo tenemos que hacer lo que queremos hacer!
     # El context-manager se ocupa de lo demás
-    response = requests.get(session.api_url + "/vlans", verify=False, headers=session.headers())
+    response = session.get("/vlans")
     if response.status_code != 200:
         print("Error leyendo VLANs: ", response.status_code, response.text)
         sys.exit(-1)
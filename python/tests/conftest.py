@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Pruebas de la librería aruba. Se lanzan desde el directorio python:
+#
+# python -m pytest tests
+
+import os
+import sys
+import asyncio
+
+from contextlib import AsyncExitStack
+from typing import Any, Awaitable, Callable, Dict
+
+import pytest
+
+# Para importar aruba y benchmark sin instalarlos
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from benchmark import mocks
+
+
+@pytest.fixture
+def serve() -> Callable[..., Any]:
+    """Sirve una app simulada de benchmark.mocks y ejecuta test(host) en el mismo bucle.
+
+    >>> def test_algo(serve):
+    >>>     async def test(host):
+    >>>         ...
+    >>>     result = serve(mocks.switch_app(), test)
+
+    Devuelve el resultado de test. Con un puerto fijo ('port'), si está
+    ocupado se salta la prueba.
+    """
+    def run(app: Any, test: Callable[[str], Awaitable[Any]], port: int = 0) -> Any:
+        async def main() -> Any:
+            async with AsyncExitStack() as stack:
+                try:
+                    host = await stack.enter_async_context(mocks.serve(app, port))
+                except OSError as err:
+                    if port == 0:
+                        raise
+                    pytest.skip("Puerto {} no disponible: {}".format(port, err))
+                return await test(host)
+        return asyncio.run(main())
+    return run
+
+
+@pytest.fixture
+def switch_config() -> Callable[[str], Dict[str, Any]]:
+    """Configuración para usar el switch simulado en 'host'"""
+    return lambda host: { "switch": { "api_host": host, "username": "test", "password": "test", "api_version": "v4" } }
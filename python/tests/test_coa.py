@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Sesiones de ClearPass que comparten los mensajes de nats-coa
+
+import aiohttp
+
+from contextlib import AsyncExitStack
+
+from aruba import clearpass
+from benchmark import mocks, suite
+
+coa = suite.load_service("nats-coa")
+
+
+def _with_caches(serve, app, test, size=coa.CACHES):
+    """Ejecuta test(host, caches) contra el ClearPass simulado, con una caché de tokens propia"""
+    async def run(host):
+        async with AsyncExitStack() as stack:
+            http = await stack.enter_async_context(aiohttp.ClientSession())
+            return await test(host, coa.Caches(http, stack, clearpass.TokenCache(), size=size))
+    return serve(app, run)
+
+
+def test_caches_keyed_by_secret(serve):
+    app = mocks.clearpass_app()
+    async def test(host, caches):
+        good = coa.config({ "host": host, "user": "coa", "pass": "good" })
+        bad = coa.config({ "host": host, "user": "coa", "pass": "bad" })
+        async with caches.use(good) as (first, _), caches.use(good) as (again, _), caches.use(bad) as (other, _):
+            return first, again, other, app[mocks.COUNTERS]["oauth"]
+    first, again, other, logins = _with_caches(serve, app, test)
+    assert first is again
+    assert other is not first
+    assert logins == 2
+
+
+def test_caches_evict_least_recently_used(serve):
+    async def test(host, caches):
+        users = [coa.config({ "host": host, "user": "coa", "pass": str(index) }) for index in range(3)]
+        opened = list()
+        for cfg in (users[0], users[1], users[0], users[2]):
+            async with caches.use(cfg) as (_, cache):
+                opened.append(cache)
+        return opened, [cache._task is None for cache in opened], len(caches.entries)
+    opened, closed, entries = _with_caches(serve, mocks.clearpass_app(), test, size=2)
+    assert entries == 2
+    assert opened[0] is opened[2]
+    # La de users[1] es la que lleva más tiempo sin usarse: se cierra, y deja de consultar el ClearPass
+    assert closed == [False, True, False, False]
+
+
+def test_coa_retries_stale_cached_session(serve):
+    app = mocks.clearpass_app(sessions=10)
+    async def test(host, caches):
+        item = app[mocks.SESSIONS][0]
+        async with caches.use(coa.config({ "host": host, "user": "coa", "pass": "coa" })) as (session, cache):
+            # La caché aún tiene una sesión que ya ha terminado en el ClearPass
+            cache.find = lambda mac, nas_ip: { "id": "stale" }
+            error = await coa.coa(session, cache, item["mac_address"], item["nasipaddress"], True)
+        return error, app[mocks.COUNTERS]["disconnect"]
+    error, disconnects = _with_caches(serve, app, test)
+    assert error is None
+    assert disconnects == 2
+
+
+def test_batch_requires_threat(serve):
+    app = mocks.clearpass_app(sessions=10)
+    async def test(host, caches):
+        items = [{ "endpoint_mac": item["mac_address"], "nas_ip": item["nasipaddress"] } for item in app[mocks.SESSIONS][:2]]
+        items[1]["threat"] = False
+        results = await coa.onBatch(caches, { "host": host, "user": "coa", "pass": "coa", "items": items })
+        return results, app[mocks.COUNTERS]["endpoint"]
+    results, patched = _with_caches(serve, app, test)
+    assert [result["status"] for result in results] == ["error", "ok"]
+    assert "threat" in results[0]["error"]
+    assert patched == 1
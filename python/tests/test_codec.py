@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Decodificación de respuestas vacías, igual con requests y con aiohttp
+
+import asyncio
+
+import aiohttp
+import pytest
+import requests
+
+from aiohttp import web
+
+from aruba import codec
+
+
+def test_empty_body_fails_in_both(serve):
+    async def empty(request: web.Request) -> web.Response:
+        return web.Response(body=b"", content_type="application/json")
+    app = web.Application()
+    app.router.add_get("/empty", empty)
+    async def test(host):
+        url = "https://{}/empty".format(host)
+        async with aiohttp.ClientSession() as http:
+            with pytest.raises(ValueError):
+                async with http.get(url, ssl=False) as response:
+                    await codec.aload(response)
+        response = await asyncio.get_running_loop().run_in_executor(None, lambda: requests.get(url, verify=False))
+        with pytest.raises(ValueError):
+            codec.load(response)
+    serve(app, test)
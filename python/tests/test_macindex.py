@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Índice de MACs (switch.MacIndex) y sus hooks
+
+from aruba import switch
+
+
+def _entries(*macs, port="1/1"):
+    return [{ "mac_address": mac, "port_id": port, "vlan_id": 10 } for mac in macs]
+
+
+def test_update_tracks_changes():
+    index = switch.MacIndex((), pool=None)
+    changes = list()
+    index.add_hook(lambda mac, before, after: changes.append((mac, len(before), len(after))))
+    index._update("sw1", _entries("00:00:00:00:00:01", "00:00:00:00:00:02"))
+    assert len(index) == 2
+    changes.clear()
+    index._update("sw1", _entries("00:00:00:00:00:02", "00:00:00:00:00:03"))
+    assert sorted(changes) == [("000000000001", 1, 0), ("000000000003", 0, 1)]
+    assert index.lookup("0000.0000.0003") == (switch.Location("sw1", "1/1", 10),)
+    assert "00:00:00:00:00:01" not in index
+
+
+def test_failing_hook_does_not_break_update():
+    index = switch.MacIndex((), pool=None)
+    seen = list()
+    def failing(mac, before, after):
+        raise RuntimeError("hook roto")
+    index.add_hook(failing)
+    index.add_hook(lambda mac, before, after: seen.append(mac))
+    index._update("sw1", _entries("00:00:00:00:00:01", "00:00:00:00:00:02"))
+    # El índice se aplica entero, y el resto de hooks reciben todos los cambios
+    assert len(index) == 2
+    assert sorted(seen) == ["000000000001", "000000000002"]
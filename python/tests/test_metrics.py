@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Registro de métricas y sus hooks
+
+from aruba import metrics
+
+
+def test_failing_hook_is_isolated():
+    registry = metrics.Registry()
+    seen = list()
+    def broken(name, labels, value):
+        raise RuntimeError("hook roto")
+    registry.add_hook(broken)
+    registry.add_hook(lambda name, labels, value: seen.append((name, value)))
+    registry.inc("requests_total", { "device": "switch" })
+    registry.observe("request_seconds", { "device": "switch" }, 0.1)
+    assert seen == [("requests_total", 1), ("request_seconds", 0.1)]
+    assert 'requests_total{device="switch"} 1' in registry.prometheus()
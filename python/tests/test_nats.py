@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Control de flujo y coalescencia de aruba.nats, contra el servidor NATS simulado
+
+import asyncio
+
+from typing import Any, Callable, Dict, List
+
+from nats.aio.client import Client as NATS # type: ignore
+
+from aruba import nats
+from benchmark import natsd
+
+
+def _burst(limits: nats.Limits, count: int, coalesce: Any = None,
+    payload: Callable[[int], bytes] = lambda index: str(index).encode()) -> Dict[str, Any]:
+    """Envía 'count' peticiones de golpe a un topic cuyo handler espera hasta que se le libera.
+
+    Devuelve las respuestas, las llamadas al handler y los contadores del topic.
+    """
+    async def run() -> Dict[str, Any]:
+        release = asyncio.Event()
+        calls: List[bytes] = list()
+        async def handler(topic: str, msg: bytes) -> bytes:
+            calls.append(msg)
+            await release.wait()
+            return b"done:" + msg
+        async with natsd.serve() as (url, _):
+            async with nats.suscription(url) as suscr:
+                async with suscr.topic("test", handler, limits, coalesce):
+                    client = NATS()
+                    await client.connect(url)
+                    try:
+                        requests = [asyncio.ensure_future(client.request("test", payload(index), timeout=5))
+                            for index in range(count)]
+                        # Las respuestas "busy" llegan sin liberar al handler
+                        await asyncio.sleep(0.3)
+                        early = sum(1 for req in requests if req.done())
+                        release.set()
+                        replies = [reply.data for reply in await asyncio.gather(*requests)]
+                    finally:
+                        await client.close()
+                    return { "replies": replies, "early": early, "calls": calls, "stats": suscr.stats["test"] }
+    return asyncio.run(run())
+
+
+def test_reply_busy_counts_idle_workers():
+    result = _burst(nats.Limits(maxInFlight=2, maxPending=3, overflow=nats.REPLY_BUSY), 10)
+    # 2 en proceso y 3 en espera, el resto se rechaza
+    assert result["replies"].count(b"busy") == 5
+    assert result["early"] == 5
+    assert len(result["calls"]) == 5
+    assert result["stats"].rejected == 5
+
+
+def test_drop_oldest_answers_dropped_messages():
+    result = _burst(nats.Limits(maxInFlight=2, maxPending=3, overflow=nats.DROP_OLDEST), 10)
+    # Todas las peticiones tienen respuesta, las descartadas con "busy"
+    assert result["replies"].count(b"busy") == 5
+    assert result["stats"].dropped == 5
+    # Se procesan cinco (tantas como caben), entre ellas siempre las tres últimas
+    assert len(result["calls"]) == 5
+    assert {b"7", b"8", b"9"} <= set(result["calls"])
+
+
+def test_block_processes_everything():
+    result = _burst(nats.Limits(maxInFlight=2, maxPending=3, overflow=nats.BLOCK), 10)
+    assert result["replies"] == [b"done:" + str(index).encode() for index in range(10)]
+    assert result["stats"].blocked >= 1
+    assert result["stats"].processed == 10
+
+
+def test_unsubscribe_cancels_workers_without_reply():
+    async def run() -> Dict[str, Any]:
+        started = asyncio.Event()
+        async def handler(topic: str, msg: bytes) -> bytes:
+            started.set()
+            await asyncio.Event().wait()
+            return msg
+        async with natsd.serve() as (url, _):
+            async with nats.suscription(url) as suscr:
+                client = NATS()
+                await client.connect(url)
+                try:
+                    async with suscr.topic("test", handler, nats.Limits(maxInFlight=2)):
+                        requests = [asyncio.ensure_future(client.request("test", b"x", timeout=1)) for _ in range(2)]
+                        await started.wait()
+                    workers = [task for task in asyncio.all_tasks() if task.get_coro().__qualname__.endswith("_sink.<locals>.worker")]
+                    replies = await asyncio.gather(*requests, return_exceptions=True)
+                finally:
+                    await client.close()
+                return { "workers": workers, "replies": replies }
+    result = asyncio.run(run())
+    assert result["workers"] == []
+    # Ni una traza de CancelledError como respuesta
+    assert all(isinstance(reply, Exception) for reply in result["replies"])
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Gestión de PoE (switch.poe) contra el switch simulado
+
+import asyncio
+
+import pytest
+
+from aruba import switch
+from benchmark import mocks
+
+
+class _Clock(object):
+
+    """Reloj falso para switch.poe: las esperas no esperan, y se apunta cuándo terminarían"""
+
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.wakeups = list()
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = _Clock()
+    real = asyncio.sleep
+    async def sleep(delay, result=None):
+        target = fake.now + delay
+        if delay > 0:
+            fake.wakeups.append(target)
+        await real(0)
+        fake.now = max(fake.now, target)
+        return result
+    monkeypatch.setattr(switch, "time", fake)
+    monkeypatch.setattr(asyncio, "sleep", sleep)
+    return fake
+
+
+def _poe(serve, switch_config, **kwargs):
+    app = mocks.switch_app()
+    async def test(host):
+        async with switch.async_session(switch_config(host), verify=False) as session:
+            changes = await switch.poe(session, False, priority=switch.PPP_LOW, **kwargs)
+            again = await switch.poe(session, False, priority=switch.PPP_LOW, dry_run=True)
+        return changes, again, app[mocks.COUNTERS]["port-poe"]
+    return serve(app, test)
+
+
+def test_poe_is_rate_limited(serve, switch_config, clock):
+    changes, again, puts = _poe(serve, switch_config, rate=20)
+    assert len(changes) == 12 and all(change.applied for change in changes)
+    assert puts == 12
+    # 12 cambios a 20 por segundo: el primero empieza ya, y los demás cada 0.05 segundos
+    assert sorted(clock.wakeups) == pytest.approx([index / 20 for index in range(1, 12)])
+    # Los puertos ya apagados no se vuelven a tocar
+    assert again == []
+
+
+def test_poe_without_rate_limit(serve, switch_config, clock):
+    changes, _, _ = _poe(serve, switch_config, rate=None)
+    assert len(changes) == 12
+    assert clock.wakeups == []
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Pool de sesiones de switch y comandos CLI en muchos switches
+
+from aruba import switch
+from benchmark import mocks
+
+
+def _with_pool(serve, switch_config, test, app=None):
+    """Ejecuta test(host, pool) con un pool sobre el switch simulado"""
+    async def run(host):
+        async with switch.Pool(switch_config(host), size=2, verify=False) as pool:
+            return await test(host, pool)
+    return serve(app if app is not None else mocks.switch_app(), run)
+
+
+def test_pool_keeps_credentials_apart(serve, switch_config):
+    async def test(host, pool):
+        async with pool.session(host, username="alice", password="a") as first:
+            pass
+        async with pool.session(host, username="bob", password="b") as second:
+            pass
+        async with pool.session(host, username="alice", password="a") as third:
+            pass
+        members = (pool.stats(host, "alice").members, pool.stats(host, "bob").members)
+        return first, second, third, members
+    first, second, third, members = _with_pool(serve, switch_config, test)
+    assert first is third
+    assert second is not first
+    assert members == (1, 1)
+
+
+def test_cli_all_accepts_single_command(serve, switch_config):
+    async def test(host, pool):
+        single = [result async for result in switch.cli_all((host,), "show version", pool)]
+        mapped = [result async for result in switch.cli_all((host,), { host: "show system" }, pool)]
+        return single, mapped
+    single, mapped = _with_pool(serve, switch_config, test)
+    assert [(result.command, result.output) for result in single] == [("show version", "show version output\n")]
+    assert [result.command for result in mapped] == ["show system"]
+
+
+def test_close_logs_out_busy_members(serve, switch_config):
+    app = mocks.switch_app()
+    async def test(host, pool):
+        async with pool.session(host):
+            async with pool.session(host):
+                pass
+            await pool.close()
+            # La libre sale al cerrar, la ocupada sigue abierta hasta que se devuelve
+            during = app[mocks.COUNTERS]["logout"]
+        after = app[mocks.COUNTERS]["logout"]
+        try:
+            async with pool.session(host):
+                pass
+            refused = False
+        except RuntimeError:
+            refused = True
+        return during, after, refused, pool.stats(host).members
+    during, after, refused, members = _with_pool(serve, switch_config, test, app)
+    assert (during, after) == (1, 2)
+    assert refused
+    assert members == 0
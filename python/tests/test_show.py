@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Comandos show en muchas controladoras, con y sin pool de sesiones. La
+# controladora simulada escucha en el puerto 4343, fijo en aruba.controller.
+
+from aruba import controller
+from benchmark import mocks
+
+
+def test_show_all_reuses_pool_sessions(serve):
+    app = mocks.controller_app(aps=5)
+    async def test(host):
+        config = { "controller": { "username": "test", "password": "test" } }
+        commands = ("show user-table", "show version")
+        async with controller.Pool(config, verify=False) as pool:
+            for _ in range(3):
+                results = [result async for result in controller.show_all(("127.0.0.1",), commands, config=config, pool=pool)]
+                assert [result.error for result in results] == [None, None]
+            pooled = app[mocks.COUNTERS]["login"]
+        results = [result async for result in controller.show_all(("127.0.0.1",), commands, config=config, verify=False)]
+        assert [result.error for result in results] == [None, None]
+        return pooled, app[mocks.COUNTERS]["login"] - pooled, app[mocks.COUNTERS]["logout"]
+    pooled, unpooled, logouts = serve(app, test, 4343)
+    assert pooled == 1
+    assert unpooled == 1
+    assert logouts == 2
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Diferencias entre lecturas de /configuration/object (controller.Snapshots)
+
+import json
+
+from aruba import controller
+
+
+def _raw(*entries):
+    return json.dumps({ "_data": { "ap_prov": list(entries) } }).encode("utf-8")
+
+
+def _update(snapshots, *entries):
+    return snapshots.update("https://md/object/ap_prov", "ap_prov", "/md", _raw(*entries))
+
+
+def test_diff_by_identity():
+    snapshots = controller.Snapshots()
+    first = _update(snapshots, { "profile-name": "a", "vlan": 1 }, { "profile-name": "b", "vlan": 2 })
+    assert sorted(first.added) == ["a", "b"]
+    # Respuesta idéntica: no hay cambios
+    assert not _update(snapshots, { "profile-name": "a", "vlan": 1 }, { "profile-name": "b", "vlan": 2 })
+    diff = _update(snapshots, { "profile-name": "a", "vlan": 3 }, { "profile-name": "c", "vlan": 2 })
+    assert list(diff.modified) == ["a"]
+    assert list(diff.added) == ["c"]
+    assert list(diff.removed) == ["b"]
+
+
+def test_colliding_keys_are_kept_apart():
+    snapshots = controller.Snapshots()
+    first = _update(snapshots, { "profile-name": "a", "vlan": 1 }, { "profile-name": "a", "vlan": 2 })
+    assert len(first.added) == 2
+    assert len(snapshots.entries("ap_prov", "/md")) == 2
+    # Cambia una de las dos: se ve como una eliminada y otra añadida, y la otra no cambia
+    diff = _update(snapshots, { "profile-name": "a", "vlan": 1 }, { "profile-name": "a", "vlan": 5 })
+    assert [entry["vlan"] for entry in diff.removed.values()] == [2]
+    assert [entry["vlan"] for entry in diff.added.values()] == [5]
+    assert not diff.modified
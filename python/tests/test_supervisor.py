@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Métricas que suma el Supervisor de los workers (con nombres propios,
+# para no mezclarlas con las del REGISTRY global del proceso de pruebas)
+
+from aruba import codec, metrics, nats
+
+
+def _dump(supervisor: nats.Supervisor, index: int, served: int, inFlight: int) -> None:
+    registry = metrics.Registry()
+    registry.inc("test_served_total", { "topic": "t", "result": "ok" }, served)
+    registry.set("test_in_flight", { "topic": "t" }, inFlight)
+    with open(supervisor._path(index), "wb") as f:
+        f.write(codec.dumps(registry.snapshot()))
+
+
+def _values(supervisor: nats.Supervisor):
+    lines = supervisor.metrics().prometheus().splitlines()
+    served = [line for line in lines if line.startswith("test_served_total{")]
+    inFlight = [line for line in lines if line.startswith("test_in_flight{")]
+    return served, inFlight
+
+
+def test_restart_keeps_counters(tmp_path):
+    supervisor = nats.Supervisor(lambda index: None, processes=2)
+    supervisor._metricsDir = str(tmp_path)
+    _dump(supervisor, 0, 5, 3)
+    _dump(supervisor, 1, 1, 1)
+    assert _values(supervisor)[0] == ['test_served_total{result="ok",topic="t"} 6']
+    # El worker 0 se reinicia: su sucesor aún no ha volcado nada
+    supervisor._retire(0)
+    served, inFlight = _values(supervisor)
+    assert served == ['test_served_total{result="ok",topic="t"} 6']
+    assert inFlight == ['test_in_flight{topic="t"} 1']
+    # Y luego vuelca sus propios contadores, que empiezan de cero
+    _dump(supervisor, 0, 2, 2)
+    served, inFlight = _values(supervisor)
+    assert served == ['test_served_total{result="ok",topic="t"} 8']
+    assert inFlight == ['test_in_flight{topic="t"} 3']
+
+
+def test_retire_without_dump(tmp_path):
+    supervisor = nats.Supervisor(lambda index: None, processes=1)
+    supervisor._metricsDir = str(tmp_path)
+    supervisor._retire(0)
+    assert _values(supervisor) == ([], [])
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Caché de tokens de ClearPass: claves, renovación y reparto entre procesos
+
+import time
+import asyncio
+
+from aruba import clearpass
+from benchmark import mocks
+
+
+def _session(secret: str, password: str = "", grant_type: str = "client_credentials") -> clearpass.AsyncSession:
+    return clearpass.AsyncSession(grant_type, "cppm", "client", secret, "user", password)
+
+
+def test_key_depends_on_secret_and_password():
+    assert _session("good")._key() == _session("good")._key()
+    assert _session("good")._key() != _session("WRONG")._key()
+    assert _session("good", "p1", "password")._key() != _session("good", "p2", "password")._key()
+
+
+def test_wrong_secret_does_not_get_cached_token():
+    tokens = clearpass.TokenCache()
+    calls = []
+    def fetch(secret):
+        async def fetch():
+            calls.append(secret)
+            return ("token-" + secret, 3600)
+        return fetch
+    async def run():
+        good, bad = _session("good"), _session("WRONG")
+        first = await tokens.aget(good._key(), fetch("good"))
+        second = await tokens.aget(bad._key(), fetch("WRONG"))
+        return first, second
+    assert asyncio.run(run()) == ("token-good", "token-WRONG")
+    assert calls == ["good", "WRONG"]
+
+
+def test_shared_file_does_not_store_secret(tmp_path):
+    path = str(tmp_path / "tokens")
+    tokens = clearpass.SharedTokenCache(path)
+    key = _session("s3cr3t-value")._key()
+    assert tokens.get(key, lambda: ("token", 3600)) == "token"
+    with open(path, "rb") as f:
+        content = f.read()
+    assert b"s3cr3t-value" not in content
+    # Otro proceso (otra caché sobre el mismo fichero) reutiliza el token con la misma clave, y no con otra
+    other = clearpass.SharedTokenCache(path)
+    assert other.get(key, lambda: ("new", 3600)) == "token"
+    assert other.get(_session("WRONG")._key(), lambda: ("new", 3600)) == "new"
+
+
+def _config(host: str):
+    return { "clearpass": { "grant_type": "client_credentials", "api_host": host,
+        "client_id": "client", "client_secret": "secret" } }
+
+
+def test_refresh_keeps_valid_token(serve):
+    app = mocks.clearpass_app(sessions=10)
+    async def test(host):
+        tokens = clearpass.TokenCache()
+        async with clearpass.async_session(_config(host), verify=False, tokens=tokens) as session:
+            token = session.secret
+            await session.refresh()
+            assert session.secret == token
+        return app[mocks.COUNTERS]["oauth"]
+    assert serve(app, test) == 1
+
+
+def test_requests_renew_token_before_expiry(serve):
+    app = mocks.clearpass_app(sessions=10, expires_in=1)
+    async def test(host):
+        tokens = clearpass.TokenCache(renew_ratio=0.3)
+        async with clearpass.async_session(_config(host), verify=False, tokens=tokens) as session:
+            seen = { session.secret }
+            for _ in range(12):
+                async with session.get("/session") as response:
+                    assert response.status == 200
+                seen.add(session.secret)
+                await asyncio.sleep(0.1)
+        return len(seen), app[mocks.COUNTERS]["oauth"]
+    renewed, logins = serve(app, test)
+    # Cada 0.3 segundos se renueva en segundo plano, y las peticiones recogen el token nuevo
+    assert renewed >= 3
+    assert logins == renewed
+
+
+def test_rejected_tokens_are_pruned(tmp_path):
+    tokens = clearpass.SharedTokenCache(str(tmp_path / "tokens"))
+    key = _session("secret")._key()
+    assert tokens.get(key, lambda: ("short", 0.2)) == "short"
+    tokens.invalidate(key, "short")
+    # El token rechazado no se vuelve a tomar del fichero
+    assert tokens.get(key, lambda: ("long", 3600)) == "long"
+    assert "short" in tokens._rejected
+    time.sleep(0.3)
+    tokens.invalidate(key, "long")
+    assert list(tokens._rejected) == ["long"]
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Exportación de spans a JSON lines
+
+import io
+import json
+import time
+
+from aruba import trace
+
+
+def _spans(count: int):
+    return [trace.Span("span-{}".format(index), "0" * 32, None, False, {}) for index in range(count)]
+
+
+def test_jsonlines_writes_in_batches():
+    stream = io.BytesIO()
+    exporter = trace.JsonLines(stream, interval=60, batch=1000)
+    for span in _spans(3):
+        exporter(span)
+    # Nada se escribe desde el bucle, hasta el siguiente lote
+    assert stream.getvalue() == b""
+    exporter.close()
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [line["name"] for line in lines] == ["span-0", "span-1", "span-2"]
+
+
+def test_jsonlines_flushes_full_batch():
+    stream = io.BytesIO()
+    exporter = trace.JsonLines(stream, interval=60, batch=2)
+    try:
+        for span in _spans(2):
+            exporter(span)
+        deadline = time.monotonic() + 5
+        while stream.getvalue().count(b"\n") < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert stream.getvalue().count(b"\n") == 2
+    finally:
+        exporter.close()